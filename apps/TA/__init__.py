@@ -9,6 +9,17 @@ HORIZONS = [PERIODS_1HR, PERIODS_4HR, PERIODS_24HR] = [12, 48, 288]  # num of 5
 PRICE_INDEXES = ['open_price', 'close_price', 'low_price', 'high_price', 'midpoint_price', 'mean_price', 'price_variance',]
 VOLUME_INDEXES = ['open_volume', 'close_volume', 'low_volume', 'high_volume',]
 
+# store price and volume sorted sets as packed binary (see TimeseriesStorage.compact_storage)
+# existing keys must be flushed or restored when switching this on
+COMPACT_STORAGE = os.environ.get('TA_COMPACT_STORAGE', 'false').lower() == 'true'
+
+# how storages notify TA subscribers of new values: "pubsub" (PUBLISH) or "stream" (XADD to a consumer group)
+EVENT_TRANSPORT = os.environ.get('TA_EVENT_TRANSPORT', 'pubsub').lower()
+
+# directory of the on-disk archive of values older than redis retention (see storages/utils/archive.py)
+# leave unset to disable archiving and the query fallback
+ARCHIVE_DIR = os.environ.get('TA_ARCHIVE_DIR', '')
+
 deployment_type = os.environ.get('DEPLOYMENT_TYPE', 'LOCAL')
 if deployment_type == 'LOCAL':
     logging.basicConfig(level=logging.DEBUG)
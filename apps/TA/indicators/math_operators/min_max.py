@@ -0,0 +1,158 @@
+from collections import deque
+
+from apps.TA.storages.abstract.indicator_subscriber import IndicatorSubscriber
+from apps.TA.storages.abstract.streaming_indicator import StreamingIndicatorStorage
+from apps.TA.storages.data.price import PriceStorage
+from settings.redis_db import database
+
+# push the newest price onto a monotonic queue kept in a redis list of "score:value" members
+# KEYS: queue list, PriceStorage sorted set of the stream index
+# ARGV: score, periods, 1 for min or 0 for max, 1 if the price members are compact binary
+# returns the window extreme, or nil if the queue must be rebuilt from history
+# (missing, not updated for the previous score, or the same score resampled again)
+PUSH_MONOTONIC_QUEUE_SCRIPT = """
+local score = tonumber(ARGV[1])
+local periods = tonumber(ARGV[2])
+local is_min = ARGV[3] == '1'
+
+local function parse(member)
+    local member_score, member_value = string.match(member, '^([^:]+):(.+)$')
+    return tonumber(member_score), tonumber(member_value)
+end
+
+local tail = redis.call('LINDEX', KEYS[1], -1)
+if not tail or parse(tail) ~= score - 1 then
+    return false
+end
+
+local prices = redis.call('ZRANGEBYSCORE', KEYS[2], ARGV[1], ARGV[1])
+if #prices == 0 then
+    return false
+end
+local value
+if ARGV[4] == '1' then
+    value = struct.unpack('<d', prices[#prices])
+else
+    value = tonumber(string.match(prices[#prices], '^([^:]+):'))
+end
+
+-- an old value can never be the window extreme again once a better or equal value arrives
+while true do
+    tail = redis.call('LINDEX', KEYS[1], -1)
+    if not tail then break end
+    local _, tail_value = parse(tail)
+    if (is_min and tail_value >= value) or (not is_min and tail_value <= value) then
+        redis.call('RPOP', KEYS[1])
+    else
+        break
+    end
+end
+redis.call('RPUSH', KEYS[1], string.format('%.17g', score) .. ':' .. string.format('%.17g', value))
+
+while parse(redis.call('LINDEX', KEYS[1], 0)) <= score - periods do
+    redis.call('LPOP', KEYS[1])
+end
+
+local _, head_value = parse(redis.call('LINDEX', KEYS[1], 0))
+return string.format('%.17g', head_value)
+"""
+push_monotonic_queue_script = database.register_script(PUSH_MONOTONIC_QUEUE_SCRIPT)
+
+
+class MinStorage(StreamingIndicatorStorage):
+    # example sorted_set_key = "BTC_USDT:binance:MinStorage:240"
+    # the window is a monotonic queue of "score:value" members in a redis list, the window extreme is always first
+    # eg. "BTC_USDT:binance:MinStorage:240:queue"
+    # the queue is updated in place by a lua script and never read back whole,
+    # each value enters and leaves the queue once, so updates are amortized O(1)
+
+    class_periods_list = [20, ]
+    is_min = True
+
+    @classmethod
+    def is_dominated(cls, old_value: float, new_value: float) -> bool:
+        # an old value can never be the window min again once a lower or equal value arrives
+        return old_value >= new_value if cls.is_min else old_value <= new_value
+
+    def get_queue_key(self, periods: int = 0) -> str:
+        return self.compile_db_key(
+            key=self.__class__.__name__,
+            key_prefix=f'{self.ticker}:{self.exchange}',
+            key_suffix=f'{periods or self.periods}:queue'
+        )
+
+    def push_to_queue(self, periods: int, client=None):
+        """
+        :param client: optional redis pipeline to add the script call to
+        :return: the window extreme as bytes, None if the queue must be rebuilt, or the pipeline
+        """
+        price_key = PriceStorage.compile_db_key(key=PriceStorage.__name__,
+                                                key_prefix=f'{self.ticker}:{self.exchange}',
+                                                key_suffix=self.stream_index)
+        return push_monotonic_queue_script(keys=[self.get_queue_key(periods), price_key], args=[
+            self.score_from_timestamp(self.unix_timestamp), periods,
+            int(self.is_min), int(bool(PriceStorage.compact_storage)),
+        ], client=client or database)
+
+    def state_from_history(self, values, scores, periods: int) -> dict:
+        if len(values) < periods:
+            return {}
+        queue = deque()
+        for score, value in zip(scores[-periods:], values[-periods:]):
+            while queue and self.is_dominated(queue[-1][1], float(value)):
+                queue.pop()
+            queue.append((float(score), float(value)))
+        while queue[0][0] <= float(scores[-1]) - periods:
+            queue.popleft()
+        return {'queue': queue}
+
+    def value_from_state(self, state: dict, periods: int) -> str:
+        return str(state['queue'][0][1])
+
+    def prefetch(self, periods_list: list):
+        # the queues are pushed in one round trip, compute_value() only rebuilds those returning None
+        pipeline = database.pipeline(transaction=False)
+        for periods in periods_list:
+            self.push_to_queue(periods, client=pipeline)
+        self.prefetched = dict(zip(periods_list, pipeline.execute()))
+
+    def compute_value(self, periods: int = 0) -> str:
+        periods = periods or self.periods
+        prefetched = getattr(self, 'prefetched', {})
+        extreme_value = prefetched.pop(periods) if periods in prefetched else self.push_to_queue(periods)
+        if extreme_value is not None:
+            return str(float(extreme_value))
+
+        # recovery path, rebuild the queue from PriceStorage history
+        state = self.recover_state(periods)
+        if not state or not state['score'] == self.score_from_timestamp(self.unix_timestamp):
+            return ""  # no price for this timestamp yet
+
+        pipeline = getattr(self, 'state_pipeline', None)
+        redis_client = pipeline if pipeline is not None else database.pipeline()
+        redis_client.delete(self.get_queue_key(periods))
+        redis_client.rpush(self.get_queue_key(periods), *[
+            f'{score!r}:{value!r}' for score, value in state['queue']
+        ])
+        if pipeline is None:
+            redis_client.execute()
+        return self.value_from_state(state, periods)
+
+
+class MaxStorage(MinStorage):
+    # example sorted_set_key = "BTC_USDT:binance:MaxStorage:240"
+    is_min = False
+
+
+class MinSubscriber(IndicatorSubscriber):
+    classes_subscribing_to = [
+        PriceStorage
+    ]
+    storage_class = MinStorage
+
+
+class MaxSubscriber(IndicatorSubscriber):
+    classes_subscribing_to = [
+        PriceStorage
+    ]
+    storage_class = MaxStorage
@@ -0,0 +1,49 @@
+from apps.TA.storages.abstract.indicator_subscriber import IndicatorSubscriber
+from apps.TA.storages.abstract.streaming_indicator import StreamingIndicatorStorage
+from apps.TA.storages.data.price import PriceStorage
+
+
+class RsiStorage(StreamingIndicatorStorage):
+    # example sorted_set_key = "BTC_USDT:binance:RsiStorage:168"
+    # state is wilder's average gain and loss and the last value
+
+    class_periods_list = [14, ]
+
+    def recovery_periods(self, periods: int) -> int:
+        # seed with simple averages, then warm up long enough for the seed to fade
+        return periods * 4 + 1
+
+    def state_from_history(self, values, scores, periods: int) -> dict:
+        if len(values) < periods + 1:
+            return {}
+        changes = values[1:] - values[:-1]
+        gains, losses = changes.clip(min=0), (-changes).clip(min=0)
+
+        state = {
+            'avg_gain': float(gains[:periods].mean()),
+            'avg_loss': float(losses[:periods].mean()),
+            'last_value': float(values[-1]),
+        }
+        for gain, loss in zip(gains[periods:], losses[periods:]):
+            state['avg_gain'] = (state['avg_gain'] * (periods - 1) + float(gain)) / periods
+            state['avg_loss'] = (state['avg_loss'] * (periods - 1) + float(loss)) / periods
+        return state
+
+    def update_state(self, state: dict, value: float, score: float, dropped_value: float, periods: int) -> dict:
+        change = value - state['last_value']
+        state['avg_gain'] = (state['avg_gain'] * (periods - 1) + max(change, 0)) / periods
+        state['avg_loss'] = (state['avg_loss'] * (periods - 1) + max(-change, 0)) / periods
+        state['last_value'] = value
+        return state
+
+    def value_from_state(self, state: dict, periods: int) -> str:
+        if not state['avg_loss']:
+            return str(100.0 if state['avg_gain'] else 50.0)
+        return str(100 - 100 / (1 + state['avg_gain'] / state['avg_loss']))
+
+
+class RsiSubscriber(IndicatorSubscriber):
+    classes_subscribing_to = [
+        PriceStorage
+    ]
+    storage_class = RsiStorage
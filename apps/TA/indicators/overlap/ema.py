@@ -0,0 +1,37 @@
+from apps.TA.storages.abstract.indicator_subscriber import IndicatorSubscriber
+from apps.TA.storages.abstract.streaming_indicator import StreamingIndicatorStorage
+from apps.TA.storages.data.price import PriceStorage
+
+
+class EmaStorage(StreamingIndicatorStorage):
+    # example sorted_set_key = "BTC_USDT:binance:EmaStorage:240"
+    # state is the last ema value
+
+    class_periods_list = [20, 50, 200]
+
+    def recovery_periods(self, periods: int) -> int:
+        # seed with an sma, then warm up long enough for the seed to fade
+        return periods * 4
+
+    def state_from_history(self, values, scores, periods: int) -> dict:
+        if len(values) < periods:
+            return {}
+        alpha = 2 / (periods + 1)
+        ema = float(values[:periods].mean())
+        for value in values[periods:]:
+            ema += alpha * (float(value) - ema)
+        return {'ema': ema}
+
+    def update_state(self, state: dict, value: float, score: float, dropped_value: float, periods: int) -> dict:
+        state['ema'] += (2 / (periods + 1)) * (value - state['ema'])
+        return state
+
+    def value_from_state(self, state: dict, periods: int) -> str:
+        return str(state['ema'])
+
+
+class EmaSubscriber(IndicatorSubscriber):
+    classes_subscribing_to = [
+        PriceStorage
+    ]
+    storage_class = EmaStorage
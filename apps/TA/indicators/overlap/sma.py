@@ -0,0 +1,30 @@
+from apps.TA.storages.abstract.indicator_subscriber import IndicatorSubscriber
+from apps.TA.storages.abstract.streaming_indicator import StreamingIndicatorStorage
+from apps.TA.storages.data.price import PriceStorage
+
+
+class SmaStorage(StreamingIndicatorStorage):
+    # example sorted_set_key = "BTC_USDT:binance:SmaStorage:240"
+    # state is the sum of values in the window
+
+    class_periods_list = [20, 50, 200]
+    needs_dropped_value = True
+
+    def state_from_history(self, values, scores, periods: int) -> dict:
+        if len(values) < periods:
+            return {}
+        return {'sum': float(values[-periods:].sum())}
+
+    def update_state(self, state: dict, value: float, score: float, dropped_value: float, periods: int) -> dict:
+        state['sum'] += value - dropped_value
+        return state
+
+    def value_from_state(self, state: dict, periods: int) -> str:
+        return str(state['sum'] / periods)
+
+
+class SmaSubscriber(IndicatorSubscriber):
+    classes_subscribing_to = [
+        PriceStorage
+    ]
+    storage_class = SmaStorage
@@ -6,9 +6,9 @@ from django.core.management.base import BaseCommand
 
 from apps.TA import PRICE_INDEXES
 from apps.TA.storages.abstract.timeseries_storage import TimeseriesStorage
-from apps.common.utilities.multithreading import start_new_thread, run_all_multithreaded
+from apps.TA.storages.data.price import PriceStorage
+from apps.common.utilities.multithreading import start_new_thread, run_all_in_executor
 from apps.TA.storages.utils import missing_data
-from settings.redis_db import database
 
 logger = logging.getLogger(__name__)
 
@@ -39,54 +39,58 @@ def fill_data_gaps(SQL_fill=False, force_fill=False):
         for exchange in ["binance", ]:  # ["binance", "poloniex", "bittrex"]:
             for index in ['close_volume', 'open_price', 'high_price', 'low_price', 'close_price']:
 
-                for key in database.keys(f"{ticker}*{exchange}*PriceStorage*{index}*"):
-                    [ticker, exchange, storage_class, index] = key.decode("utf-8").split(":")
+                for key in PriceStorage.iter_registered_keys(match=f"{ticker}:{exchange}:PriceStorage:{index}"):
+                    [ticker, exchange, storage_class, index] = key.split(":")
 
                     ugly_tuple = (ticker, exchange, index, bool(SQL_fill))
                     method_params.append(ugly_tuple)
 
     logger.info(f"{len(method_params)} tickers ready to fill gaps")
 
-    results = run_all_multithreaded(condensed_fill_redis_gaps, method_params)
-    missing_scores_count = sum([len(result) for result in results])
+    # gap scans are numpy work, spread the tickers across cores
+    timings = []
+    results = run_all_in_executor(condensed_fill_redis_gaps, method_params, backend="process", timings=timings)
+    if timings:
+        logger.info(f"gap scans took {sum(timings):.1f}s in total, slowest ticker {max(timings):.1f}s")
+    missing_scores_count = sum([missing_data.count_run_scores(result) for result in results])
 
     logger.warning(f"{missing_scores_count} scores could not be recovered and are still missing.")
 
     # if SQL_fill:
-    #     results = run_all_multithreaded(condensed_fill_SQL_gaps, method_params)
-    #     missing_scores_count = sum([len(result) for result in results])
+    #     results = run_all_in_executor(condensed_fill_SQL_gaps, method_params, backend="process")
+    #     missing_scores_count = sum([missing_data.count_run_scores(result) for result in results])
     #     logger.warning(f"{missing_scores_count} scores could not be recovered and are still missing.")
 
     if force_fill:
         logger.warning("STARTING FORCE FILL OF THESE VALUES...")
         logger.warning("!! THERE'S NO GOING BACK FROM HERE. DATA MAY WILL BE PERMAMENTLY CORRUPTED !!")
-        for missing_scores in results:
-            missing_data.force_plug_pv_storage_data_gaps(ticker, exchange, index, missing_scores)
+        run_all_in_executor(condensed_force_plug_gaps, [
+            (ticker, exchange, index, missing_scores_runs)
+            for (ticker, exchange, index, _), missing_scores_runs in zip(method_params, results)
+        ], backend="process", ordered=False)
 
 
 def refill_pv_storages():
     from apps.TA.storages.abstract.timeseries_storage import TimeseriesStorage
-    from apps.TA.storages.utils.pv_resampling import generate_pv_storages
+    from apps.TA.storages.utils.pv_resampling import resample_pv_storages
     from apps.TA.storages.utils.memory_cleaner import clear_pv_history_values
+    from apps.TA.storages.data.pv_history import PriceVolumeHistoryStorage
 
     start_score = int(TimeseriesStorage.score_from_timestamp(datetime(2018, 1, 1).timestamp()))
     end_score = int(TimeseriesStorage.score_from_timestamp(datetime.now().timestamp()))  # 206836 is Dec 20
 
-    tei_processed = {}
-
-    for key in database.keys("*PriceVolumeHistoryStorage*"):
-        logger.info("running pv refill for " + str(key))
-        [ticker, exchange, object_class, index] = key.decode("utf-8").split(":")
+    # all indexes of a ticker and exchange are resampled together, so only go through each pair once
+    tickers_exchanges = []
+    for key in PriceVolumeHistoryStorage.iter_registered_keys():
+        [ticker, exchange, object_class, index] = key.split(":")
+        if (ticker, exchange) not in tickers_exchanges:
+            tickers_exchanges.append((ticker, exchange))
 
+    for ticker, exchange in tickers_exchanges:
+        logger.info(f"running pv refill for {ticker}:{exchange}")
         for score in range(start_score, end_score):
-            generate_pv_storages(ticker, exchange, index, score)
-
-            if not (ticker + exchange) in tei_processed:
-                tei_processed[ticker + exchange] = []  # initialize with 0 indexes
-
-            tei_processed[ticker + exchange].append(index)  # add indexes
-            if len(tei_processed[ticker + exchange]) >= 5:  # vol + price hloc
-                clear_pv_history_values(ticker, exchange, score)
+            resample_pv_storages(ticker, exchange, score)
+            clear_pv_history_values(ticker, exchange, score)  # vol + price hloc are all resampled now
 
 
 def condensed_fill_redis_gaps(ugly_tuple):
@@ -97,3 +101,8 @@ def condensed_fill_redis_gaps(ugly_tuple):
 def condensed_fill_SQL_gaps(ugly_tuple):
     (ticker, exchange, index, back_to_the_backlog) = ugly_tuple
     return missing_data.find_pv_storage_data_gaps(ticker, exchange, index, back_to_the_backlog=True)
+
+
+def condensed_force_plug_gaps(ugly_tuple):
+    (ticker, exchange, index, missing_scores_runs) = ugly_tuple
+    return missing_data.force_plug_pv_storage_data_gaps(ticker, exchange, index, missing_scores_runs)
@@ -1,29 +1,48 @@
 import logging
-import time
 from datetime import datetime, timedelta
 
+import numpy as np
 from django.core.management.base import BaseCommand
 
-from apps.TA.storages.abstract.ticker_subscriber import timestamp_is_near_5min
-from apps.TA.storages.data.pv_history import PriceVolumeHistoryStorage, default_price_indexes
-from apps.common.utilities.multithreading import run_all_multithreaded
-from settings import BTC, USDT, BINANCE
+from apps.TA import PRICE_INDEXES
+from apps.TA.storages.abstract.timeseries_storage import TimeseriesStorage
+from apps.TA.storages.data.price import PriceStorage
+from apps.TA.storages.data.volume import VolumeStorage
+from apps.TA.storages.utils.pv_resampling import resample_values, save_pv_histories_to_redis
+from apps.common.utilities.multithreading import run_all_multithreaded, run_all_in_executor
+from settings import BTC, USDT, BINANCE, SOURCE_CHOICES, COUNTER_CURRENCY_CHOICES
 from settings.redis_db import database
 from apps.indicator.models.price_history import PriceHistory
 
 logger = logging.getLogger(__name__)
 
+RESTORE_CHUNK_SIZE = 20000  # PriceHistory rows fetched per server-side cursor round trip
+RESTORE_PIPELINE_SIZE = 10000  # commands written per redis round trip
+
+# (PriceHistory field, PriceVolumeHistoryStorage index) in the order of values_list()
+RESTORE_FIELDS = [("open_p", "open_price"), ("high", "high_price"), ("low", "low_price"),
+                  ("close", "close_price"), ("volume", "close_volume"), ]
+
 
 class Command(BaseCommand):
     help = 'Run Redis Data Restore from SQL'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--bulk', action='store_true', default=False,
+                            help='resample straight into PriceStorage and VolumeStorage, without pub/sub')
+        parser.add_argument('--processes', type=int, default=4,
+                            help='number of tickers restored in parallel in bulk mode')
+
     def handle(self, *args, **options):
         logger.info("Starting TA restore script...")
 
         start_datetime = datetime(2019, 3, 1)
         end_datetime = datetime.today()
 
-        restore_db_to_redis(start_datetime, end_datetime)
+        if options['bulk']:
+            bulk_restore_db_to_redis(start_datetime, end_datetime, processes=options['processes'])
+        else:
+            restore_db_to_redis(start_datetime, end_datetime)
 
         from apps.TA.management.commands.TA_fill_gaps import fill_data_gaps
         fill_data_gaps(SQL_fill=True, force_fill=False)
@@ -75,64 +94,132 @@ def restore_db_to_redis(start_datetime, end_datetime):
 
 
 
-### PULL PRICE HISTORY RECORDS FROM CORE PRICE HISTORY DATABASE ###
-def save_pv_histories_to_redis(ph_object, pipeline=None):
-    if ph_object.source is not BINANCE or ph_object.counter_currency not in [BTC, USDT]:
-        return pipeline or [0]
-
-    using_local_pipeline = (not pipeline)
-
-    if using_local_pipeline:
-        pipeline = database.pipeline()  # transaction=False
-
-    ticker = f'{ph_object.transaction_currency}_{ph_object.get_counter_currency_display()}'
-    exchange = str(ph_object.get_source_display())
-    unix_timestamp = int(ph_object.timestamp.timestamp())
-
-    # SAVE VALUES IN REDIS USING PriceVolumeHistoryStorage OBJECT
-    # CREATE OBJECT FOR STORAGE
-    pv_storage = PriceVolumeHistoryStorage(
-        ticker=ticker,
-        exchange=exchange,
-        timestamp=unix_timestamp
-    )
-
-    publish_close_price = timestamp_is_near_5min(unix_timestamp)
+def get_restore_querysets(start_datetime, end_datetime) -> list:
+    # same PriceHistory selection as restore_db_to_redis()
+    time_range = dict(timestamp__gte=start_datetime, timestamp__lt=end_datetime, source=BINANCE)  # Binance only for now
+    return [
+        PriceHistory.objects.filter(transaction_currency__in=["BTC", "ETH"], counter_currency__in=[USDT], **time_range),
+        PriceHistory.objects.filter(counter_currency__in=[BTC], **time_range),
+    ]
 
-    if ph_object.volume and ph_object.volume > 0:
-        pv_storage.index = "close_volume"
-        pv_storage.value = ph_object.volume
-        pipeline = pv_storage.save(publish=publish_close_price, pipeline=pipeline)
 
-    if ph_object.open_p and ph_object.open_p > 0:
-        pv_storage.index = "open_price"
-        pv_storage.value = ph_object.open_p
-        pipeline = pv_storage.save(publish=False, pipeline=pipeline)
-
-    if ph_object.high and ph_object.high > 0:
-        pv_storage.index = "high_price"
-        pv_storage.value = ph_object.high
-        pipeline = pv_storage.save(publish=False, pipeline=pipeline)
-
-    if ph_object.low and ph_object.low > 0:
-        pv_storage.index = "low_price"
-        pv_storage.value = ph_object.low
-        pipeline = pv_storage.save(publish=False, pipeline=pipeline)
-
-    # always run 'close_price' index last
-    # why? when it saves, it triggers price storage to resample
-    # after resampling history indexes are deleted
-    # so all others should be available for resampling before being deleted
-
-    if ph_object.close and ph_object.close > 0:
-        pv_storage.index = "close_price"
-        pv_storage.value = ph_object.close
-        pipeline = pv_storage.save(publish=True, pipeline=pipeline)
-
-    if using_local_pipeline:
-        return pipeline.execute()
-    else:
-        return pipeline
-
-
-### END PULL OF PRICE HISTORY RECORDS ###
\ No newline at end of file
+def bulk_restore_db_to_redis(start_datetime, end_datetime, processes: int = 4) -> int:
+    """
+    restore PriceStorage and VolumeStorage from PriceHistory, one ticker per process
+    rows are streamed with a server-side cursor, resampled with numpy and written in large pipelines
+    nothing is published, so indicators are not computed for the restored periods
+    (streaming indicators rebuild their state from the restored history on the next live value)
+    :return: number of values written to redis
+    """
+    if start_datetime > end_datetime:  # please go forward in time :)
+        return 0
+
+    restore_params = []
+    for queryset in get_restore_querysets(start_datetime, end_datetime):
+        for (transaction_currency, counter_currency) in queryset.order_by().values_list(
+                'transaction_currency', 'counter_currency').distinct():
+            restore_params.append((transaction_currency, counter_currency, start_datetime, end_datetime))
+
+    logger.info(f"bulk restoring {len(restore_params)} tickers with {processes} processes")
+
+    timings = []
+    results = run_all_in_executor(restore_ticker_to_redis, restore_params, backend="process",
+                                  max_workers=max(processes, 1), ordered=False, timings=timings)
+
+    total_results = sum(results)
+    if timings:
+        logger.info(f"slowest ticker took {max(timings):.1f}s")
+    logger.info(f"{total_results} values added to Redis")
+    return total_results
+
+
+def restore_ticker_to_redis(restore_params: tuple) -> int:
+    (transaction_currency, counter_currency, start_datetime, end_datetime) = restore_params
+
+    ticker = f'{transaction_currency}_{dict(COUNTER_CURRENCY_CHOICES)[counter_currency]}'
+    exchange = dict(SOURCE_CHOICES)[BINANCE]
+
+    rows = PriceHistory.objects.filter(
+        source=BINANCE,
+        transaction_currency=transaction_currency,
+        counter_currency=counter_currency,
+        timestamp__gte=start_datetime,
+        timestamp__lt=end_datetime,
+    ).order_by('timestamp').values_list('timestamp', *[field for (field, index) in RESTORE_FIELDS])
+
+    values_count = 0
+    pipeline = database.pipeline(transaction=False)
+    carried_rows, chunk_rows = [], []
+
+    for row in rows.iterator(chunk_size=RESTORE_CHUNK_SIZE):
+        chunk_rows.append(row)
+        if len(chunk_rows) < RESTORE_CHUNK_SIZE:
+            continue
+        # the last period may continue into the next chunk, carry it over
+        carried_rows, chunk_index_values = resample_rows(carried_rows + chunk_rows, keep_last_period=False)
+        chunk_rows = []
+        values_count += save_resampled_values(ticker, exchange, chunk_index_values, pipeline)
+
+    _, chunk_index_values = resample_rows(carried_rows + chunk_rows, keep_last_period=True)
+    values_count += save_resampled_values(ticker, exchange, chunk_index_values, pipeline)
+    pipeline.execute()
+
+    logger.info(f"{values_count} values restored for {ticker} on {exchange}")
+    return values_count
+
+
+def resample_rows(rows: list, keep_last_period: bool = True) -> tuple:
+    """
+    :param rows: list of (timestamp, open_p, high, low, close, volume) in time order
+    :param keep_last_period: resample the last period too, else return its rows to carry over
+    :return: (rows not resampled, list of (timestamp, index_values) for each 5min period)
+    """
+    if not rows:
+        return [], []
+
+    timestamps = np.array([row[0].timestamp() for row in rows])
+    values = np.array([row[1:] for row in rows], dtype=np.float64)  # None becomes nan
+
+    # a value belongs to the 5min period it is closest after, within 29s after the period ends
+    # same window as resample_pv_storages(), without counting the overlap twice
+    scores = (timestamps - TimeseriesStorage.timestamp_from_score(0)) / 300
+    period_scores = np.ceil(scores - (29 / 300))
+
+    period_starts = np.flatnonzero(np.r_[True, period_scores[1:] != period_scores[:-1]])
+    period_ends = np.append(period_starts[1:], len(rows))
+
+    carried_rows = []
+    if not keep_last_period:
+        carried_rows = rows[period_starts[-1]:]
+        period_starts, period_ends = period_starts[:-1], period_ends[:-1]
+
+    resampled = []
+    for start, end in zip(period_starts, period_ends):
+        raw_values = {}
+        for column, (field, index) in enumerate(RESTORE_FIELDS):
+            column_values = values[start:end, column]
+            raw_values[index] = column_values[column_values > 0]  # drops nan and empty values
+        index_values = resample_values(raw_values)
+        if index_values:
+            resampled.append((TimeseriesStorage.timestamp_from_score(period_scores[start]), index_values))
+
+    return carried_rows, resampled
+
+
+def save_resampled_values(ticker: str, exchange: str, resampled: list, pipeline) -> int:
+    price_storage = PriceStorage(ticker=ticker, exchange=exchange, timestamp=TimeseriesStorage.timestamp_from_score(0))
+    volume_storage = VolumeStorage(ticker=ticker, exchange=exchange, timestamp=TimeseriesStorage.timestamp_from_score(0))
+
+    values_count = 0
+    for (timestamp, index_values) in resampled:
+        for index, value in index_values.items():
+            storage = price_storage if index in PRICE_INDEXES else volume_storage
+            storage.unix_timestamp, storage.index, storage.value = timestamp, index, value
+            if not storage.value:
+                continue
+            storage.save(publish=False, pipeline=pipeline)
+            values_count += 1
+            if len(pipeline) >= RESTORE_PIPELINE_SIZE:
+                pipeline.execute()
+
+    return values_count
@@ -1,8 +1,12 @@
 import logging
+import multiprocessing
+import os
+import socket
 import time
 
 from django.core.management.base import BaseCommand
 
+from apps.TA import EVENT_TRANSPORT
 from apps.TA.storages.utils.memory_cleaner import redisCleanup
 from settings.rabbitmq import WorkQueue
 from settings.redis_db import database
@@ -38,33 +42,169 @@ except:
 # Push all updates live
 # Stop using old Aurora database
 
+HEARTBEAT_SECONDS = 5  # how long a worker blocks waiting for a message before checking in
+WORKER_STALE_SECONDS = 300  # restart a worker that has not checked in for a whole 5min period, while idle or handling one event
+EVENT_BATCH_SIZE = 100  # max events per stream read
+RECLAIM_SECONDS = 60  # how often to claim stream events left pending by dead workers
+
+
 class Command(BaseCommand):
     help = 'Run Redis Subscribers for TA'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=int(os.environ.get('TA_WORKERS', 1)),
+                            help='number of worker processes, each handles a shard of tickers')
+
     def handle(self, *args, **options):
         logger.info("Starting TA worker.")
 
-        subscribers = {}
-        for subscriber_class in get_subscriber_classes():
-            subscribers[subscriber_class.__name__] = subscriber_class()
-            logger.debug(f'added subscriber {subscriber_class}')
-            logger.debug(f'new subscriber is {subscribers[subscriber_class.__name__]}')
-
-        for s in subscribers:
-            logger.debug(f'latest channels: {subscribers[s].database.pubsub_channels()}')
-
-        logger.info("Pubsub clients are ready.")
-
-        while True:
-            for class_name in subscribers:
-                # logger.debug(f'checking subscription {class_name}: {subscribers[class_name]}')
-                try:
-                    subscribers[class_name]()  # run subscriber class
-                except Exception as e:
-                    logger.error(str(e))
-                    logger.debug(subscribers[class_name].__dict__)
-
-                time.sleep(0.001)  # be nice to the system :)
+        if options['workers'] > 1:
+            supervise_workers(options['workers'])
+        else:
+            run_worker()
+
+
+def run_worker(shard_index: int = 0, shard_count: int = 1, heartbeat=None):
+    """
+    subscribe all subscriber classes on one pubsub and block waiting for messages
+    :param shard_index: this worker's shard, only tickers in this shard are handled
+    :param shard_count: total number of workers, 1 means handle all tickers
+    :param heartbeat: optional multiprocessing.Value updated with the time each loop
+    """
+    if EVENT_TRANSPORT == "stream":
+        # the consumer group balances events between workers, so no sharding
+        return run_stream_worker(f'{socket.gethostname()}:{shard_index}', heartbeat)
+
+    pubsub = database.pubsub()
+    shard = (shard_index, shard_count) if shard_count > 1 else None
+
+    subscribers = []
+    for subscriber_class in get_subscriber_classes():
+        subscribers.append(subscriber_class(pubsub=pubsub, shard=shard))
+        logger.debug(f'added subscriber {subscriber_class} for shard {shard}')
+
+    logger.debug(f'latest channels: {database.pubsub_channels()}')
+    logger.info(f"Pubsub clients are ready for shard {shard_index} of {shard_count}.")
+
+    while True:
+        check_in(heartbeat)
+
+        data_event = pubsub.get_message(timeout=HEARTBEAT_SECONDS)  # blocks until a message or timeout
+
+        # drain everything else already waiting, so batching subscribers see the whole burst
+        data_events = []
+        while data_event:
+            data_events.append(data_event)
+            data_event = pubsub.get_message()
+
+        dispatch_events(subscribers, data_events, heartbeat)
+
+
+def run_stream_worker(consumer_name: str, heartbeat=None):
+    """
+    read batches of events from the TA event stream as one consumer in the group
+    events are acknowledged only after every subscriber handled them without error
+    :param consumer_name: unique and stable across restarts, so a restarted worker re-reads its pending events
+    :param heartbeat: optional multiprocessing.Value updated with the time each loop
+    """
+    from apps.TA.storages.abstract.event_stream import EventStreamConsumer
+
+    consumer = EventStreamConsumer(consumer_name)
+    subscribers = [subscriber_class(subscribe=False) for subscriber_class in get_subscriber_classes()]
+    logger.info(f"Stream consumer {consumer_name} is ready.")
+
+    last_reclaim_time = time.time()
+    while True:
+        check_in(heartbeat)
+
+        if time.time() - last_reclaim_time > RECLAIM_SECONDS:
+            events = consumer.reclaim(min_idle_ms=RECLAIM_SECONDS * 1000, count=EVENT_BATCH_SIZE)
+            last_reclaim_time = time.time()
+        else:
+            events = consumer.read(count=EVENT_BATCH_SIZE, block_ms=HEARTBEAT_SECONDS * 1000)
+
+        failed_event_ids = {id(data_event) for data_event in dispatch_events(subscribers, [
+            data_event for event_id, data_event in events
+        ], heartbeat)}
+        consumer.ack([
+            event_id for event_id, data_event in events
+            if id(data_event) not in failed_event_ids
+        ])
+
+
+def dispatch_events(subscribers: list, data_events: list, heartbeat=None) -> list:
+    """
+    pass each event to every subscriber subscribed to its channel
+    subscribers with batch_events get all their events in one process_events() call
+    :param heartbeat: optional multiprocessing.Value updated after each handled event or batch,
+    so a worker busy on a long burst is not taken for a stuck one
+    :return: list of the data events that raised an error in any subscriber
+    """
+    data_events = [data_event for data_event in data_events if data_event.get('type') == 'message']
+    failed_events = []
+
+    for subscriber in subscribers:
+        subscriber_events = [
+            data_event for data_event in data_events
+            if data_event['channel'].decode("utf-8") in subscriber.channels
+        ]
+        if subscriber.batch_events:
+            failed_events.extend(subscriber.process_events(subscriber_events))
+            check_in(heartbeat)
+            continue
+
+        for data_event in subscriber_events:
+            try:
+                subscriber.process_event(data_event)
+            except Exception as e:
+                logger.error(str(e))
+                logger.debug(subscriber.__dict__)
+                failed_events.append(data_event)
+            check_in(heartbeat)
+
+    return failed_events
+
+
+def check_in(heartbeat=None):
+    if heartbeat is not None:
+        heartbeat.value = time.time()
+
+
+def supervise_workers(shard_count: int):
+    """
+    fork a worker process per shard and restart any that die or stop checking in
+    """
+    from django.db import connections
+    connections.close_all()  # each forked worker must open its own database connections
+
+    workers = {}
+
+    def start_worker(shard_index):
+        heartbeat = multiprocessing.Value('d', time.time())
+        process = multiprocessing.Process(
+            target=run_worker, args=(shard_index, shard_count, heartbeat),
+            name=f'TA_worker_{shard_index}', daemon=True
+        )
+        process.start()
+        workers[shard_index] = (process, heartbeat)
+        logger.info(f'started TA worker {process.name} with pid {process.pid}')
+
+    for shard_index in range(shard_count):
+        start_worker(shard_index)
+
+    while True:
+        time.sleep(HEARTBEAT_SECONDS)
+
+        for shard_index, (process, heartbeat) in list(workers.items()):
+            if not process.is_alive():
+                logger.error(f'{process.name} exited with code {process.exitcode}, restarting...')
+                start_worker(shard_index)
+
+            elif time.time() - heartbeat.value > WORKER_STALE_SECONDS:
+                logger.error(f'{process.name} has not checked in for {WORKER_STALE_SECONDS}s, restarting...')
+                process.terminate()
+                process.join()
+                start_worker(shard_index)
 
 
     # def new_handle(self, *args, **options):
@@ -86,8 +226,13 @@ def get_subscriber_classes():
     from apps.TA.storages.data.price import PriceSubscriber
     # from apps.TA.storages.data.volume import VolumeSubscriber
     # only PriceStorage:close_price is publishing. All other p and v indexes are muted
+    from apps.TA.indicators.overlap.sma import SmaSubscriber
+    from apps.TA.indicators.overlap.ema import EmaSubscriber
+    from apps.TA.indicators.momentum.rsi import RsiSubscriber
+    from apps.TA.indicators.math_operators.min_max import MinSubscriber, MaxSubscriber
 
     return [
         PriceSubscriber,
         # VolumeSubscriber,  # the PriceSubscriber handles volume resampling
+        SmaSubscriber, EmaSubscriber, RsiSubscriber, MinSubscriber, MaxSubscriber,
     ]
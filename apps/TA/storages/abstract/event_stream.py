@@ -0,0 +1,172 @@
+"""
+Redis Streams transport for TA events, an alternative to pub/sub (set TA_EVENT_TRANSPORT=stream)
+
+events are added to a single stream with XADD and read by the TA_worker consumer group with XREADGROUP
+an event stays pending until it is acknowledged, so events survive worker restarts
+and pending events of a dead consumer are reclaimed by the others
+
+redis-py 2.10 has no stream helpers, so commands are sent with execute_command()
+"""
+import logging
+
+from redis.exceptions import ResponseError
+
+from apps.TA import TAException
+from settings.redis_db import database
+
+logger = logging.getLogger(__name__)
+
+EVENT_STREAM_KEY = "TA_events"  # not named after a storage class, so key patterns like "*PriceStorage*" don't match
+EVENT_STREAM_GROUP = "TA_worker"
+EVENT_STREAM_MAXLEN = 500000  # approximate cap on stream length, about a day of events for all tickers
+MAX_DELIVERIES = 5  # an event failing this many times is acknowledged and dropped
+
+
+class EventStreamException(TAException):
+    pass
+
+
+def add_event(channel: str, data: str, pipeline=None):
+    """
+    :param channel: same as the pub/sub channel, the storage class name eg. "PriceStorage"
+    :param data: json string, same as the pub/sub message data
+    :param pipeline: optional redis pipeline
+    :return: the pipeline, or the new event id
+    """
+    redis_client = pipeline if pipeline is not None else database
+    return redis_client.execute_command(
+        'XADD', EVENT_STREAM_KEY, 'MAXLEN', '~', EVENT_STREAM_MAXLEN, '*',
+        'channel', channel, 'data', data
+    )
+
+
+class EventStreamConsumer:
+    """
+    reads TA events for one consumer in the consumer group
+    events are returned in the same format as pub/sub messages,
+    so they can be passed straight to TickerSubscriber.process_event()
+    """
+
+    def __init__(self, consumer_name: str, group: str = EVENT_STREAM_GROUP, stream_key: str = EVENT_STREAM_KEY):
+        self.consumer_name = consumer_name
+        self.group = group
+        self.stream_key = stream_key
+        self.backlog_id = '0'  # first re-read events this consumer read but never acknowledged, None once done
+
+        try:
+            database.execute_command('XGROUP', 'CREATE', self.stream_key, self.group, '$', 'MKSTREAM')
+            logger.info(f'created consumer group {self.group} on {self.stream_key}')
+        except ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise EventStreamException(str(e))
+
+    @staticmethod
+    def parse_entries(entries) -> list:
+        """
+        :param entries: list of [event_id, [field, value, ...]] as returned by XREADGROUP or XCLAIM
+        :return: list of (event_id, data_event) where data_event matches a pub/sub message
+        """
+        events = []
+        for entry in entries or []:
+            if not entry or not entry[1]:
+                continue  # trimmed from the stream while pending
+            event_id, fields = entry
+            fields = dict(zip(fields[::2], fields[1::2]))
+            events.append((event_id, {
+                'type': 'message',
+                'pattern': None,
+                'channel': fields.get(b'channel'),
+                'data': fields.get(b'data'),
+            }))
+        return events
+
+    def read(self, count: int = 100, block_ms: int = 5000) -> list:
+        """
+        :param count: maximum number of events to return
+        :param block_ms: how long to wait for new events
+        :return: list of (event_id, data_event)
+        """
+        if self.backlog_id is not None:
+            events = self.read_backlog(count)
+            if events:
+                return events
+
+        response = database.execute_command(
+            'XREADGROUP', 'GROUP', self.group, self.consumer_name,
+            'COUNT', count, 'BLOCK', block_ms, 'STREAMS', self.stream_key, '>'
+        )
+        return self.parse_entries(response[0][1] if response else [])
+
+    def read_backlog(self, count: int = 100) -> list:
+        """
+        one pass over the events pending for this consumer, the cursor moves past each batch read
+        so events that fail again are not re-read until they are reclaimed
+        events already delivered MAX_DELIVERIES times are acknowledged and dropped
+        :param count: maximum number of events to return
+        :return: list of (event_id, data_event), empty once the pass is done
+        """
+        while self.backlog_id is not None:
+            response = database.execute_command(
+                'XREADGROUP', 'GROUP', self.group, self.consumer_name,
+                'COUNT', count, 'STREAMS', self.stream_key, self.backlog_id
+            )
+            entries = response[0][1] if response else []
+            if not entries:
+                self.backlog_id = None
+                break
+            self.backlog_id = entries[-1][0]
+
+            # reading pending events counts as a delivery, so this read is included
+            pending = database.execute_command(
+                'XPENDING', self.stream_key, self.group,
+                entries[0][0], entries[-1][0], len(entries), self.consumer_name
+            )
+            dropped_ids = [
+                event_id for event_id, consumer_name, idle_ms, deliveries in pending or []
+                if deliveries > MAX_DELIVERIES
+            ]
+            if dropped_ids:
+                logger.warning(f'dropping {len(dropped_ids)} TA events after {MAX_DELIVERIES} failed deliveries')
+                self.ack(dropped_ids)
+
+            events = [
+                (event_id, data_event) for event_id, data_event in self.parse_entries(entries)
+                if event_id not in dropped_ids
+            ]
+            if events:
+                return events
+        return []
+
+    def ack(self, event_ids: list) -> int:
+        if not event_ids:
+            return 0
+        return database.execute_command('XACK', self.stream_key, self.group, *event_ids)
+
+    def reclaim(self, min_idle_ms: int = 60000, count: int = 100) -> list:
+        """
+        claim events left pending by other consumers (eg. a worker that died)
+        :param min_idle_ms: only claim events pending longer than this
+        :param count: maximum number of pending events to check
+        :return: list of (event_id, data_event) now owned by this consumer
+        """
+        pending = database.execute_command('XPENDING', self.stream_key, self.group, '-', '+', count)
+
+        claim_ids, dropped_ids = [], []
+        for event_id, consumer_name, idle_ms, deliveries in pending or []:
+            if idle_ms < min_idle_ms:
+                continue
+            if deliveries >= MAX_DELIVERIES:
+                dropped_ids.append(event_id)
+            else:
+                claim_ids.append(event_id)
+
+        if dropped_ids:
+            logger.warning(f'dropping {len(dropped_ids)} TA events after {MAX_DELIVERIES} failed deliveries')
+            self.ack(dropped_ids)
+
+        if not claim_ids:
+            return []
+        response = database.execute_command(
+            'XCLAIM', self.stream_key, self.group, self.consumer_name, min_idle_ms, *claim_ids
+        )
+        return self.parse_entries(response)
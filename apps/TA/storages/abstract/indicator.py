@@ -3,6 +3,7 @@ import logging
 from apps.TA import TAException, HORIZONS
 from apps.TA.storages.abstract.ticker import TickerStorage
 from apps.signal.models import Signal
+from settings.redis_db import database
 
 logger = logging.getLogger(__name__)
 
@@ -32,6 +33,8 @@ class IndicatorStorage(TickerStorage):
 
     requisite_pv_indexes = []  # class should override this.
 
+    compact_storage = False  # class may set True if every value is a single number (not "a:b" tuples)
+
     # may only include values in default_price_indexes or default_volume_indexes
     # eg. ["high_price", "low_price", "open_price", "close_price", "close_volume"]
 
@@ -54,6 +57,7 @@ class IndicatorStorage(TickerStorage):
 
         self.db_key_suffix = f':{self.periods}'
         self.value = None
+        self.signal_batch = None
 
     def get_value(self, refresh_from_db=False):
         try:
@@ -97,6 +101,17 @@ class IndicatorStorage(TickerStorage):
         results_dict['periods_key'] = periods_key
         return results_dict
 
+    @classmethod
+    def query_array(cls, *args, **kwargs):
+
+        periods_key = kwargs.get("periods_key", "")
+        key_suffix = kwargs.get("key_suffix", "")
+
+        if periods_key:
+            kwargs["key_suffix"] = f'{periods_key}' + (f':{key_suffix}' if key_suffix else "")
+
+        return super().query_array(*args, **kwargs)
+
     @classmethod
     def get_periods_list(cls):
         periods_list = []
@@ -104,27 +119,53 @@ class IndicatorStorage(TickerStorage):
             periods_list.extend([h * s for h in HORIZONS])
         return set(periods_list)
 
-    def get_denoted_price_array(self, index: str = "close_price", periods: int = 0):
-        from apps.TA.storages.data.price import PriceStorage
-        results_dict = PriceStorage.query(
+    def get_denoted_price_query(self, index: str = "close_price", periods: int = 0) -> dict:
+        # kwargs for PriceStorage.query_array()
+        return dict(
             ticker=self.ticker,
             exchange=self.exchange,
             index=index,
             timestamp=self.unix_timestamp,
             periods_range=periods or self.periods
         )
-        return self.get_values_array_from_query(results_dict, limit=periods)
 
-    def compute_value(self, periods: int = 0) -> str:
+    @staticmethod
+    def limit_price_array(price_array, periods: int = 0):
+        return price_array[-periods:] if periods else price_array
+
+    def get_denoted_price_array(self, index: str = "close_price", periods: int = 0):
+        from apps.TA.storages.data.price import PriceStorage
+        price_array = PriceStorage.query_array(**self.get_denoted_price_query(index, periods))['value']
+        return self.limit_price_array(price_array, periods)
+
+    def get_requisite_price_arrays(self, periods: int = 0) -> dict:
+        from apps.TA.storages.data.price import PriceStorage
+
+        # read all requisite indexes in one round trip
+        price_arrays = PriceStorage.query_many([
+            self.get_denoted_price_query(index, periods) for index in self.requisite_pv_indexes
+        ])
+        return {index: price_array['value'] for index, price_array in zip(self.requisite_pv_indexes, price_arrays)}
+
+    def compute_value_from_price_arrays(self, price_arrays: dict, periods: int = 0) -> str:
+        """
+        :param price_arrays: dict of requisite index to value array, may be longer than periods
+        :param periods: number of periods to compute value for, arrays are sliced to this length
+        :return: computed value as a string
+        """
         periods = periods or self.periods
 
         index_value_arrrays = {}
         for index in self.requisite_pv_indexes:
-            index_value_arrrays[index] = self.get_denoted_price_array(index, periods)
+            index_value_arrrays[index] = self.limit_price_array(price_arrays[index], periods)
             if not len(index_value_arrrays[index]): return ""
 
         return self.compute_value_with_requisite_indexes(index_value_arrrays, periods)
 
+    def compute_value(self, periods: int = 0) -> str:
+        periods = periods or self.periods
+        return self.compute_value_from_price_arrays(self.get_requisite_price_arrays(periods), periods)
+
     def compute_value_with_requisite_indexes(self, requisite_pv_index_arrrays: dict, periods: int = 0) -> str:
         """
         custom class should set cls.requisite_pv_indexes
@@ -143,9 +184,10 @@ class IndicatorStorage(TickerStorage):
         # return str(sma_value)
         return ""
 
-    def compute_and_save(self) -> bool:
+    def compute_and_save(self, pipeline=None, signal_batch=None) -> bool:
         """
-
+        :param pipeline: optional redis pipeline to add the save to
+        :param signal_batch: optional SignalBatch to defer signals to
         :return: True if value saved, else False
         """
 
@@ -156,15 +198,25 @@ class IndicatorStorage(TickerStorage):
 
         self.value = self.compute_value(self.periods)
         if self.value:
-            self.save()
+            self.save(pipeline=pipeline, signal_batch=signal_batch)
         return bool(self.value)
 
     @classmethod
     def compute_and_save_all_values_for_timestamp(cls, ticker, exchange, timestamp):
         new_class_storage = cls(ticker=ticker, exchange=exchange, timestamp=timestamp)
-        for periods in cls.get_periods_list():
+        periods_list = sorted(cls.get_periods_list())
+
+        # read the longest window once, every shorter period is a slice of it
+        price_arrays = new_class_storage.get_requisite_price_arrays(periods_list[-1])
+
+        pipeline, signal_batch = database.pipeline(), SignalBatch()
+        for periods in periods_list:
             new_class_storage.periods = periods
-            new_class_storage.compute_and_save()
+            new_class_storage.value = new_class_storage.compute_value_from_price_arrays(price_arrays, periods)
+            if new_class_storage.value:
+                pipeline = new_class_storage.save(pipeline=pipeline, signal_batch=signal_batch)
+        pipeline.execute()
+        signal_batch.create()
 
     def produce_signal(self):
         """
@@ -183,16 +235,10 @@ class IndicatorStorage(TickerStorage):
             add these optional kwargs:
             strength_value = 1,
             strength_max = 5,
-        :return: signal object (Django model object)
+        :return: signal object (Django model object),
+            or None if the signal was added to self.signal_batch to be created later
         """
-        from apps.TA.storages.data.price import PriceStorage
-        price_results_dict = PriceStorage.query(ticker=self.ticker, exchange=self.exchange)
-        most_recent_price = int(price_results_dict['values'][0])
-        # from apps.TA.storages.data.volume import VolumeStorage
-        # volume_results_dict = VolumeStorage.query(ticker=self.ticker, exchange=self.exchange)
-        # most_recent_volume = float(volume_results_dict ['values'][0])
-
-        return Signal.objects.create(
+        signal_kwargs = dict(
             timestamp=self.unix_timestamp,
             source=self.exchange,
             transaction_currency=self.ticker.split("_")[0],
@@ -202,11 +248,28 @@ class IndicatorStorage(TickerStorage):
 
             signal=self.__class__.__name__.replace("Storage", "").upper(),
             trend=trend,
-            price=most_recent_price,
             **kwargs
         )
 
+        if self.signal_batch is not None:
+            self.signal_batch.add(self.ticker, self.exchange, **signal_kwargs)
+            return None
+
+        from apps.TA.storages.data.price import PriceStorage
+        price_results_dict = PriceStorage.query(ticker=self.ticker, exchange=self.exchange)
+        most_recent_price = int(price_results_dict['values'][0])
+        # from apps.TA.storages.data.volume import VolumeStorage
+        # volume_results_dict = VolumeStorage.query(ticker=self.ticker, exchange=self.exchange)
+        # most_recent_volume = float(volume_results_dict ['values'][0])
+
+        return Signal.objects.create(price=most_recent_price, **signal_kwargs)
+
     def save(self, *args, **kwargs):
+        """
+        :param kwargs: same as TimeseriesStorage.save(), plus optional
+            signal_batch: a SignalBatch to collect signals in, instead of creating them now
+        """
+        signal_batch = kwargs.pop('signal_batch', None)
 
         # check meets basic requirements for saving
         if not all([self.ticker, self.exchange,
@@ -218,12 +281,73 @@ class IndicatorStorage(TickerStorage):
         self.db_key_suffix = f'{str(self.periods)}'
         save_result = super().save(*args, **kwargs)
         try:
+            self.signal_batch = signal_batch
             self.produce_signal()
         except Exception as e:
             logger.error("error producing signal for indicator" + str(e))
+        finally:
+            self.signal_batch = None
         return save_result
 
 
+class SignalBatch:
+    """
+    collects signals produced while saving indicators in a redis pipeline
+    call create() after the pipeline executes to insert them all with one bulk_create
+    """
+
+    def __init__(self):
+        self.pending_signals = []  # list of (ticker, exchange, signal_kwargs)
+
+    def __len__(self):
+        return len(self.pending_signals)
+
+    def add(self, ticker, exchange, **signal_kwargs):
+        self.pending_signals.append((ticker, exchange, signal_kwargs))
+
+    def create(self) -> list:
+        """
+        :return: list of created signal objects (Django model objects)
+        """
+        if not self.pending_signals:
+            return []
+        from apps.TA.storages.data.price import PriceStorage
+
+        # one most recent price per ticker and exchange, read in one round trip
+        tickers_exchanges = list({(ticker, exchange) for ticker, exchange, _ in self.pending_signals})
+        price_arrays = PriceStorage.query_many([
+            dict(ticker=ticker, exchange=exchange) for ticker, exchange in tickers_exchanges
+        ])
+        most_recent_prices = {
+            ticker_exchange: int(price_array['value'][-1])
+            for ticker_exchange, price_array in zip(tickers_exchanges, price_arrays) if len(price_array)
+        }
+
+        signals = [
+            Signal(price=most_recent_prices[(ticker, exchange)], **signal_kwargs)
+            for ticker, exchange, signal_kwargs in self.pending_signals
+            if (ticker, exchange) in most_recent_prices
+        ]
+        self.pending_signals = []
+
+        # bulk_create skips pre_save too, so fill in price and price_change the same way the pre_save receiver does
+        from apps.signal.models.signal import check_has_price
+        for signal in signals:
+            check_has_price(sender=Signal, instance=signal)
+
+        try:
+            signals = Signal.objects.bulk_create(signals)
+        except Exception as e:
+            logger.error("error creating signals for indicators: " + str(e))
+            return []
+
+        # bulk_create skips post_save, so send each signal the same way the post_save receiver does
+        from apps.signal.models.signal import send_signal
+        for signal in signals:
+            send_signal(sender=Signal, instance=signal)
+        return signals
+
+
 """
 ===== EXAMPLE USAGE =====
 
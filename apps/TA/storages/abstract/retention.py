@@ -0,0 +1,198 @@
+"""
+retention policy for TimeseriesStorage classes, run as server-side Lua scripts
+
+a storage class declares its tiers, newest first, eg. for PriceStorage
+    retention_tiers = [RetentionTier("5min", 1, 200 days), RetentionTier("1h", 12, 2 years)]
+
+the first tier is the storage class's own sorted sets
+values older than a tier's retention are rolled up into the next tier, one value per bucket of
+next_tier.periods periods, then deleted. the last tier's expired values are only deleted.
+rolled up values live in "{ticker}:{exchange}:{StorageClass}_{tier}:{index}", eg. "BTC_USDT:binance:PriceStorage_1h:close_price"
+and can be read with TimeseriesStorage.query_array(..., rollup_tier="1h")
+rollup members are always "value:score" strings, query_array() reads them as strings also for compact_storage classes
+
+each key is rolled up and trimmed in one script call, and calls are pipelined in batches
+"""
+import logging
+import time
+from collections import namedtuple
+
+from apps.TA.storages.abstract.timeseries_storage import KEY_REGISTRY_PREFIX
+from settings.redis_db import database
+
+logger = logging.getLogger(__name__)
+
+RetentionTier = namedtuple('RetentionTier', 'name periods seconds')
+
+RETENTION_BATCH_SIZE = 500  # keys per pipelined round trip
+
+# how values of each index are combined into one value per rollup bucket
+INDEX_AGGREGATIONS = {
+    "open_price": "first",
+    "high_price": "max",
+    "low_price": "min",
+    "close_price": "last",
+    "midpoint_price": "mean",
+    "mean_price": "mean",
+    "price_variance": "mean",
+    "open_volume": "first",
+    "high_volume": "max",
+    "low_volume": "min",
+    "close_volume": "last",
+}
+DEFAULT_AGGREGATION = "last"
+
+# KEYS[1] source sorted set
+# KEYS[2] rollup sorted set (optional), KEYS[3] registry set of rollup keys
+# ARGV[1] cutoff score, members scored lower are expired
+# ARGV[2] max score, members scored higher are invalid and deleted
+# ARGV[3] rollup bucket size in periods
+# ARGV[4] aggregation: first, last, min, max, mean
+# ARGV[5] "1" if source members are packed binary (compact storage), else "value:score" strings
+# returns {members expired, rollup values written, members remaining}
+APPLY_RETENTION_SCRIPT = """
+local expired = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', '(' .. ARGV[1], 'WITHSCORES')
+local written = 0
+
+if #KEYS > 1 and #expired > 0 then
+    local bucket_size = tonumber(ARGV[3])
+    local aggregation = ARGV[4]
+    local buckets, bucket_order = {}, {}
+
+    for i = 1, #expired, 2 do
+        local value
+        if ARGV[5] == '1' then
+            value = struct.unpack('<d', expired[i])
+        else
+            value = tonumber(string.match(expired[i], '^([^:]+):'))
+        end
+        if value then
+            local bucket = math.floor(tonumber(expired[i + 1]) / bucket_size) * bucket_size
+            local b = buckets[bucket]
+            if not b then
+                b = {first = value, min = value, max = value, sum = 0, count = 0}
+                buckets[bucket] = b
+                table.insert(bucket_order, bucket)
+            end
+            b.last = value  -- members come in ascending score order
+            if value < b.min then b.min = value end
+            if value > b.max then b.max = value end
+            b.sum = b.sum + value
+            b.count = b.count + 1
+        end
+    end
+
+    for _, bucket in ipairs(bucket_order) do
+        local b = buckets[bucket]
+        local value = b[aggregation]
+        if aggregation == 'mean' then value = b.sum / b.count end
+        local score = string.format('%d', bucket)
+        redis.call('ZREMRANGEBYSCORE', KEYS[2], score, score)
+        redis.call('ZADD', KEYS[2], score, string.format('%.17g', value) .. ':' .. score)
+        written = written + 1
+    end
+    redis.call('SADD', KEYS[3], KEYS[2])
+end
+
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', '(' .. ARGV[1])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '(' .. ARGV[2], '+inf')
+return {#expired / 2, written, redis.call('ZCARD', KEYS[1])}
+"""
+apply_retention_script = database.register_script(APPLY_RETENTION_SCRIPT)
+
+
+def get_tier_name(storage_class, tier_index: int) -> str:
+    # the first tier is the storage class itself
+    if tier_index == 0:
+        return storage_class.get_tier_key_name()
+    return storage_class.get_tier_key_name(storage_class.retention_tiers[tier_index].name)
+
+
+def get_tier_key(key: str, storage_class, tier_index: int) -> str:
+    """
+    :param key: a key of the storage class eg. "BTC_USDT:binance:PriceStorage:close_price"
+    :return: the matching key of the tier eg. "BTC_USDT:binance:PriceStorage_1h:close_price"
+    """
+    [ticker, exchange, class_name, index] = key.split(":")
+    return f'{ticker}:{exchange}:{get_tier_name(storage_class, tier_index)}:{index}'
+
+
+def iter_tier_keys(storage_class, tier_index: int, batch_size: int = RETENTION_BATCH_SIZE):
+    if tier_index == 0:
+        yield from storage_class.iter_registered_keys(batch_size=batch_size)
+        return
+    registry_key = f'{KEY_REGISTRY_PREFIX}:{get_tier_name(storage_class, tier_index)}'
+    for key in database.sscan_iter(registry_key, count=batch_size):
+        yield key.decode("utf-8")
+
+
+def apply_retention_policy(storage_class, now_timestamp: int = None,
+                           future_tolerance_seconds: int = 3600 * 24,
+                           batch_size: int = RETENTION_BATCH_SIZE) -> dict:
+    """
+    roll up and delete expired values for every key of the storage class, tier by tier
+    :param storage_class: a TimeseriesStorage subclass with retention_tiers
+    :param now_timestamp: defaults to now
+    :param future_tolerance_seconds: values dated later than now + this are invalid and deleted
+    :param batch_size: number of keys per pipelined round trip
+    :return: dict of tier name: (values expired, rollup values written)
+    """
+    now_timestamp = now_timestamp or int(time.time())
+    now_score = storage_class.score_from_timestamp(now_timestamp)
+    max_score = storage_class.score_from_timestamp(now_timestamp + future_tolerance_seconds)
+    tiers = storage_class.retention_tiers
+
+    results = {}
+    for tier_index, tier in enumerate(tiers):
+        tier_name = get_tier_name(storage_class, tier_index)
+        next_tier = tiers[tier_index + 1] if tier_index + 1 < len(tiers) else None
+
+        cutoff_score = now_score - storage_class.periods_from_seconds(tier.seconds)
+        if next_tier:
+            # only roll up whole buckets, the rest expires on a later run
+            cutoff_score = (cutoff_score // next_tier.periods) * next_tier.periods
+
+        def apply_batch(keys):
+            pipeline = database.pipeline(transaction=False)
+            for key in keys:
+                script_keys = [key]
+                if next_tier:
+                    script_keys += [
+                        get_tier_key(key, storage_class, tier_index + 1),
+                        f'{KEY_REGISTRY_PREFIX}:{get_tier_name(storage_class, tier_index + 1)}',
+                    ]
+                apply_retention_script(keys=script_keys, args=[
+                    cutoff_score, max_score,
+                    next_tier.periods if next_tier else 1,
+                    INDEX_AGGREGATIONS.get(key.split(":")[-1], DEFAULT_AGGREGATION),
+                    int(bool(tier_index == 0 and storage_class.compact_storage)),
+                ], client=pipeline)
+
+            expired, written, empty_keys = 0, 0, []
+            for key, response in zip(keys, pipeline.execute(raise_on_error=False)):
+                if isinstance(response, Exception):
+                    logger.error(f'{key}: {response}')
+                    continue
+                expired += response[0]
+                written += response[1]
+                if response[2] == 0:
+                    empty_keys.append(key)
+
+            if empty_keys:
+                database.srem(f'{KEY_REGISTRY_PREFIX}:{tier_name}', *empty_keys)
+            return expired, written
+
+        expired, written, keys_batch = 0, 0, []
+        for key in iter_tier_keys(storage_class, tier_index, batch_size=batch_size):
+            keys_batch.append(key)
+            if len(keys_batch) >= batch_size:
+                (batch_expired, batch_written) = apply_batch(keys_batch)
+                expired, written, keys_batch = expired + batch_expired, written + batch_written, []
+        if keys_batch:
+            (batch_expired, batch_written) = apply_batch(keys_batch)
+            expired, written = expired + batch_expired, written + batch_written
+
+        logger.info(f'{tier_name} retention: {expired} values expired, {written} rolled up')
+        results[tier_name] = (expired, written)
+
+    return results
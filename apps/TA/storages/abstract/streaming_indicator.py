@@ -0,0 +1,197 @@
+import copy
+import json
+import logging
+
+from apps.TA.storages.abstract.indicator import IndicatorStorage, SignalBatch
+from settings.redis_db import database
+
+logger = logging.getLogger(__name__)
+
+
+class StreamingIndicatorStorage(IndicatorStorage):
+    """
+    an indicator that keeps a small rolling state per ticker, exchange and periods
+    so each new 5min close updates the value using only the newest PriceStorage point
+    instead of re-reading and recomputing the whole window
+
+    the state is saved in redis next to the indicator sorted set
+    eg. "BTC_USDT:binance:SmaStorage:240:state"
+    if the state is missing, stale, or has been updated recovery_interval times
+    it is rebuilt from PriceStorage history (recovery path)
+    a rolled state keeps the state it was rolled from under 'previous',
+    so a price re-resampled for the same score replaces that score's contribution
+
+    compute_and_save_all_values_for_timestamp() reads the states and prices of all periods in one round trip
+    with prefetch(), and the new states are saved in the same pipeline as the indicator values
+    """
+    class_describer = "streaming_indicator"
+    compact_storage = True  # streaming values are always a single number
+
+    stream_index = "close_price"  # the PriceStorage index the state is built from
+    requisite_pv_indexes = [stream_index, ]
+
+    needs_dropped_value = False  # set True if update_state() needs the value leaving the window
+    recovery_interval = 288  # rebuild from history at least once a day to shed float drift
+
+    def get_state_key(self, periods: int = 0) -> str:
+        return self.compile_db_key(
+            key=self.__class__.__name__,
+            key_prefix=f'{self.ticker}:{self.exchange}',
+            key_suffix=f'{periods or self.periods}:state'
+        )
+
+    def load_state(self, periods: int = 0) -> dict:
+        return self.state_from_json(database.get(self.get_state_key(periods)))
+
+    @staticmethod
+    def state_from_json(state_json) -> dict:
+        return json.loads(state_json.decode("utf-8")) if state_json else {}
+
+    def save_state(self, state: dict, periods: int = 0, pipeline=None):
+        redis_client = pipeline if pipeline is not None else database
+        return redis_client.set(self.get_state_key(periods), json.dumps(state))
+
+    def recovery_periods(self, periods: int) -> int:
+        """
+        number of periods of history needed to rebuild the state
+        override for indicators that need a warm up (eg. EMA, RSI)
+        """
+        return periods
+
+    def state_from_history(self, values, scores, periods: int) -> dict:
+        """
+        override me: build the rolling state from a window of history
+        :param values: numpy array of self.stream_index values, oldest to newest
+        :param scores: numpy array of scores matching the values
+        :param periods: number of periods for the indicator
+        :return: state dict, or empty dict if there is not enough history
+        """
+        return {}
+
+    def update_state(self, state: dict, value: float, score: float, dropped_value: float, periods: int) -> dict:
+        """
+        override me: roll the state forward by one period
+        :param state: state dict as returned by state_from_history() or update_state()
+        :param value: the newest value
+        :param score: the score of the newest value
+        :param dropped_value: the value leaving the window (only if cls.needs_dropped_value)
+        :param periods: number of periods for the indicator
+        :return: new state dict
+        """
+        return state
+
+    def value_from_state(self, state: dict, periods: int) -> str:
+        """
+        override me: compute the indicator value from the state
+        :return: value as a string, or "" if no value is available
+        """
+        return ""
+
+    def recover_state(self, periods: int) -> dict:
+        from apps.TA.storages.data.price import PriceStorage
+        history_array = PriceStorage.query_array(
+            **self.get_denoted_price_query(self.stream_index, self.recovery_periods(periods))
+        )
+        if not len(history_array):
+            return {}
+        state = self.state_from_history(history_array['value'], history_array['score'], periods)
+        if state:
+            state.update({'score': float(history_array['score'][-1]), 'updates': 0})
+        return state
+
+    def get_tick_queries(self, periods: int) -> list:
+        # PriceStorage.query_array() kwargs for the newest value, and for the value leaving the window if needed
+        queries = [dict(self.get_denoted_price_query(self.stream_index), periods_range=0, timestamp_tolerance=0)]
+        if self.needs_dropped_value:
+            queries.append(dict(queries[0], timestamp=self.unix_timestamp - self.seconds_from_periods(periods)))
+        return queries
+
+    def prefetch(self, periods_list: list):
+        """
+        read the state and the newest prices of every periods in one round trip,
+        compute_value() then uses them instead of reading its own
+        """
+        from apps.TA.storages.data.price import PriceStorage
+
+        pipeline, archive_ranges = database.pipeline(transaction=False), []
+        pipeline.mget([self.get_state_key(periods) for periods in periods_list])
+        queries_list = [self.get_tick_queries(periods) for periods in periods_list]
+        for queries in queries_list:
+            for query_kwargs in queries:
+                pipeline = PriceStorage.query_array(pipeline=pipeline, archive_ranges=archive_ranges, **query_kwargs)
+        responses = pipeline.execute()
+
+        price_arrays = iter(PriceStorage.arrays_from_responses(
+            [query_kwargs for queries in queries_list for query_kwargs in queries], responses[1:], archive_ranges
+        ))
+        self.prefetched = {
+            periods: (self.state_from_json(state_json), [next(price_arrays) for _ in queries])
+            for periods, state_json, queries in zip(periods_list, responses[0], queries_list)
+        }
+
+    def roll_state(self, state: dict, periods: int, price_arrays: list = None) -> dict:
+        """
+        :param price_arrays: PriceStorage arrays of get_tick_queries(), read now if not given
+        """
+        from apps.TA.storages.data.price import PriceStorage
+        score = self.score_from_timestamp(self.unix_timestamp)
+
+        if price_arrays is None:
+            price_arrays = PriceStorage.query_many(self.get_tick_queries(periods))
+        if not all([len(price_array) for price_array in price_arrays]):
+            return {}  # newest or dropped value missing, must recover
+
+        dropped_value = float(price_arrays[1]['value'][-1]) if self.needs_dropped_value else None
+        previous_state = {key: value for key, value in state.items() if key != 'previous'}
+        # update_state() may change the state in place, keep previous_state as it was
+        state = self.update_state(copy.deepcopy(previous_state), float(price_arrays[0]['value'][-1]),
+                                  score, dropped_value, periods)
+        if state:
+            state.update({'score': score, 'updates': previous_state['updates'] + 1, 'previous': previous_state})
+        return state
+
+    def compute_value(self, periods: int = 0) -> str:
+        periods = periods or self.periods
+        score = self.score_from_timestamp(self.unix_timestamp)
+        prefetched = getattr(self, 'prefetched', {})
+        state, price_arrays = prefetched.pop(periods) if periods in prefetched else (self.load_state(periods), None)
+
+        if state.get('score') == score:
+            # the price for this score was resampled again, roll from the previous score once more
+            previous_state = state.get('previous') or {}
+            if previous_state.get('score') == score - 1:
+                state = self.roll_state(previous_state, periods, price_arrays) or self.recover_state(periods)
+            else:
+                state = self.recover_state(periods)
+        elif state.get('score') == score - 1 and state.get('updates', 0) < self.recovery_interval:
+            state = self.roll_state(state, periods, price_arrays) or self.recover_state(periods)
+        else:
+            state = self.recover_state(periods)
+
+        if not state or not state['score'] == score:
+            return ""  # no price for this timestamp yet
+
+        self.save_state(state, periods, pipeline=getattr(self, 'state_pipeline', None))
+        return self.value_from_state(state, periods)
+
+    def compute_and_save(self, pipeline=None, signal_batch=None) -> bool:
+        # the new state is saved in the same pipeline as the value
+        self.state_pipeline = pipeline
+        try:
+            return super().compute_and_save(pipeline=pipeline, signal_batch=signal_batch)
+        finally:
+            self.state_pipeline = None
+
+    @classmethod
+    def compute_and_save_all_values_for_timestamp(cls, ticker, exchange, timestamp):
+        # state updates only read the newest points, so skip reading the longest window
+        new_class_storage = cls(ticker=ticker, exchange=exchange, timestamp=timestamp)
+        periods_list = cls.get_periods_list()
+        new_class_storage.prefetch(periods_list)
+
+        pipeline, signal_batch = database.pipeline(), SignalBatch()
+        for periods in periods_list:
+            new_class_storage.periods = periods
+            new_class_storage.compute_and_save(pipeline=pipeline, signal_batch=signal_batch)
+        pipeline.execute()
+        signal_batch.create()
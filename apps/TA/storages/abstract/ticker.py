@@ -57,3 +57,14 @@ class TickerStorage(TimeseriesStorage):
             results_dict['exchange'] = exchange
             results_dict['ticker'] = ticker
         return results_dict
+
+    @classmethod
+    def query_array(cls, *args, **kwargs):
+
+        ticker = kwargs.get("ticker", None)
+        exchange = kwargs.get("exchange", None)
+        if not ticker or not exchange:
+            raise IndicatorException("ticker and exchange both requried for ticker query")
+        kwargs["key_prefix"] = f'{ticker}:{exchange}'
+
+        return super().query_array(*args, **kwargs)
@@ -17,19 +17,89 @@ class TickerSubscriber(ABC):
     classes_subscribing_to = [
         # ...
     ]
+    batch_events = False  # set True to drain all waiting messages and pass them to handle_batch()
 
-    def __init__(self):
+    def __init__(self, pubsub=None, shard: tuple = None, subscribe: bool = True):
+        """
+        :param pubsub: optional pubsub to share with other subscribers, default is a new one
+        :param shard: optional (shard_index, shard_count) to only handle tickers in this shard
+        :param subscribe: set False when events come from another transport (eg. EventStreamConsumer)
+        """
         from settings.redis_db import database
         self.database = database
-        self.pubsub = database.pubsub()
-        logger.info(f'New pubsub for {self.__class__.__name__}')
+        self.shard = shard
+        self.pubsub = None
+        if not subscribe:
+            return
+        if pubsub is None:
+            pubsub = database.pubsub()
+            logger.info(f'New pubsub for {self.__class__.__name__}')
+        self.pubsub = pubsub
         for s_class in self.classes_subscribing_to:
             self.pubsub.subscribe(s_class.__name__)
             logger.info(f'{self.__class__.__name__} subscribed to '
                         f'{s_class.__name__} channel')
 
+    @property
+    def channels(self) -> list:
+        return [s_class.__name__ for s_class in self.classes_subscribing_to]
+
+    def owns_event(self, data) -> bool:
+        if not self.shard:
+            return True
+        from apps.TA.storages.utils.sharding import get_shard
+        [shard_index, shard_count] = self.shard
+        [ticker, exchange] = data["key"].split(":")[:2]
+        return get_shard(ticker, exchange, shard_count) == shard_index
+
     def __call__(self):
+        if not self.batch_events:
+            data_event = self.pubsub.get_message()
+            self.process_event(data_event)
+            return
+
+        data_events = []
         data_event = self.pubsub.get_message()
+        while data_event:
+            data_events.append(data_event)
+            data_event = self.pubsub.get_message()
+        if data_events:
+            failed_events = self.process_events(data_events)
+            if failed_events:
+                raise SubscriberException(f'Error calling {self.__class__.__name__} '
+                                          f'on {len(failed_events)} of {len(data_events)} events')
+
+    def process_events(self, data_events: list) -> list:
+        """
+        handle many events at once, in groups by get_batch_key()
+        :param data_events: list of pub/sub messages (or stream events in the same format)
+        :return: list of the data events in groups that raised an error
+        """
+        batches = {}
+        for data_event in data_events:
+            if not data_event or not data_event.get('type') == 'message':
+                continue
+            try:
+                channel_name = data_event.get('channel').decode("utf-8")
+                event_data = json.loads(data_event.get('data').decode("utf-8"))
+                if not self.owns_event(event_data):
+                    continue  # another worker's shard
+                batch_key = self.get_batch_key(channel_name, event_data)
+            except (KeyError, ValueError, AttributeError) as e:
+                logger.warning(f'unexpected format: {data_event} ' + str(e))
+                continue  # message not in expected format, just ignore
+            batches.setdefault(batch_key, []).append((channel_name, event_data, data_event))
+
+        failed_events = []
+        for batch_key, batch in batches.items():
+            try:
+                self.handle_batch([(channel_name, event_data) for channel_name, event_data, _ in batch])
+            except Exception as e:
+                logger.error(f'Error calling {self.__class__.__name__} on batch {batch_key}: ' + str(e))
+                failed_events.extend([data_event for _, _, data_event in batch])
+        return failed_events
+
+    def process_event(self, data_event):
         if not data_event:
             return
         if not data_event.get('type') == 'message':
@@ -51,6 +121,8 @@ class TickerSubscriber(ABC):
         try:
             channel_name = data_event.get('channel').decode("utf-8")
             event_data = json.loads(data_event.get('data').decode("utf-8"))
+            if not self.owns_event(event_data):
+                return  # another worker's shard
             # logger.debug(f'handling event in {self.__class__.__name__}')
             self.pre_handle(channel_name, event_data)
             self.handle(channel_name, event_data)
@@ -64,6 +136,24 @@ class TickerSubscriber(ABC):
             raise SubscriberException(f'Error calling {self.__class__.__name__}: ' + str(e))
 
 
+    def get_batch_key(self, channel, data) -> tuple:
+        """
+        events with the same key are passed to handle_batch() together
+        :return: (ticker, exchange, score) by default
+        """
+        [ticker, exchange] = data["key"].split(":")[:2]
+        return ticker, exchange, float(data["score"])
+
+    def handle_batch(self, events: list):
+        """
+        overwrite me to handle a group of events at once
+        :param events: list of (channel, data) tuples sharing the same get_batch_key()
+        :return: None
+        """
+        for channel, data in events:
+            self.pre_handle(channel, data)
+            self.handle(channel, data)
+
     def pre_handle(self, channel, data, *args, **kwargs):
         pass
 
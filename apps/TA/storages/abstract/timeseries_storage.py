@@ -1,8 +1,9 @@
 import json
 import logging
+import time
 from datetime import datetime
 import numpy as np
-from apps.TA import TAException, JAN_1_2017_TIMESTAMP
+from apps.TA import TAException, JAN_1_2017_TIMESTAMP, EVENT_TRANSPORT, ARCHIVE_DIR
 from apps.TA.storages.abstract.key_value import KeyValueStorage
 from settings.redis_db import database
 
@@ -17,6 +18,18 @@ class TimeseriesException(TAException):
     pass
 
 
+# fixed-width binary member used by storages in compact mode
+# value as little-endian float64, score as uint32 (keeps each member unique in the sorted set)
+COMPACT_MEMBER_DTYPE = np.dtype([('value', '<f8'), ('score', '<u4')])
+
+# structured array returned by TimeseriesStorage.query_array()
+SCORE_VALUE_DTYPE = np.dtype([('score', '<f8'), ('value', '<f8')])
+
+# every sorted set key saved by a storage class is added to a set named "TA_keys:{StorageClass}"
+# so maintenance jobs can iterate known keys instead of running KEYS over the whole keyspace
+KEY_REGISTRY_PREFIX = "TA_keys"
+
+
 class TimeseriesStorage(KeyValueStorage):
     """
     stores things in a sorted set unique to each ticker and exchange
@@ -25,6 +38,18 @@ class TimeseriesStorage(KeyValueStorage):
     """
     class_describer = "timeseries"
 
+    # set True on a subclass to store members as packed binary instead of "value:score" strings
+    # only for storages with whole number scores (5min periods) and numeric values
+    compact_storage = False
+
+    # list of RetentionTier, newest first, applied by retention.apply_retention_policy()
+    # the first tier is this class's own sorted sets, later tiers hold rolled up values
+    retention_tiers = []
+
+    # set True on a subclass to archive values to disk before they expire from redis
+    # queries older than the first retention tier then read from the archive (see utils/archive.py)
+    archive_storage = False
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
@@ -46,6 +71,63 @@ class TimeseriesStorage(KeyValueStorage):
     def save_own_existance(self, describer_key=""):
         self.describer_key = describer_key or f'{self.__class__.class_describer}:{self.get_db_key()}'
 
+    @classmethod
+    def get_registry_key(cls) -> str:
+        return f'{KEY_REGISTRY_PREFIX}:{cls.__name__}'
+
+    @classmethod
+    def get_registry_backfilled_key(cls) -> str:
+        # set once a full SCAN has registered the keys saved before the registry existed
+        return f'{KEY_REGISTRY_PREFIX}_backfilled:{cls.__name__}'
+
+    @classmethod
+    def backfill_registry(cls, batch_size: int = 500) -> int:
+        """
+        SCAN the keyspace for this class's keys and register them, then mark the registry as backfilled
+        the registry alone misses keys saved before it existed and never saved since (eg. delisted tickers)
+        :return: number of keys found
+        """
+        registry_key = cls.get_registry_key()
+        logger.info(f'backfilling {registry_key}, scanning keyspace for {cls.__name__} keys')
+
+        keys_found = 0
+        keys_batch = []
+        for key in database.scan_iter(match=f'*:{cls.__name__}:*', count=batch_size):
+            keys_batch.append(key)
+            if len(keys_batch) >= batch_size:
+                database.sadd(registry_key, *keys_batch)
+                keys_found += len(keys_batch)
+                keys_batch = []
+        if keys_batch:
+            database.sadd(registry_key, *keys_batch)
+            keys_found += len(keys_batch)
+
+        # only after the SCAN completed, an interrupted backfill runs again next time
+        database.set(cls.get_registry_backfilled_key(), int(time.time()))
+        return keys_found
+
+    @classmethod
+    def iter_registered_keys(cls, match: str = None, batch_size: int = 500):
+        """
+        iterate all sorted set keys saved by this class, without blocking redis like KEYS
+        the first call runs backfill_registry() for keys saved before the registry existed
+        :param match: optional glob pattern on the key eg. "BTC_USDT:binance:*"
+        :param batch_size: number of keys fetched per SSCAN/SCAN call
+        :return: generator of key strings
+        """
+        if not database.exists(cls.get_registry_backfilled_key()):
+            cls.backfill_registry(batch_size=batch_size)
+
+        for key in database.sscan_iter(cls.get_registry_key(), match=match, count=batch_size):
+            yield key.decode("utf-8")
+
+    @classmethod
+    def unregister_keys(cls, keys: list, pipeline=None):
+        if not keys:
+            return pipeline
+        redis_client = pipeline if pipeline is not None else database
+        return redis_client.srem(cls.get_registry_key(), *keys)
+
     @classmethod
     def score_from_timestamp(cls, timestamp) -> float:
         return round((float(timestamp) - JAN_1_2017_TIMESTAMP) / 300, 3)
@@ -71,6 +153,7 @@ class TimeseriesStorage(KeyValueStorage):
               timestamp: int = None,
               timestamp_tolerance: int = 299,
               periods_range: float = 0.01,
+              rollup_tier: str = None,
               *args, **kwargs) -> dict:
         """
         :param key: the exact redis sortedset key (optional)
@@ -79,10 +162,13 @@ class TimeseriesStorage(KeyValueStorage):
         :param timestamp: timestamp for most recent value returned  (optional, default returns latest)
         :param periods_range: number of periods desired in results (optional, default 0, so only return 1 value)
         :param timestamp_tolerance: tolerance in seconds on results within timestamp and period range (optional, defualt=299)
+        :param rollup_tier: name of a later retention tier to read its rolled up values, eg. "1h" (optional)
         :return: dict(values=[], ...)
         """
 
-        sorted_set_key = cls.compile_db_key(key=key, key_prefix=key_prefix, key_suffix=key_suffix)
+        sorted_set_key = cls.compile_db_key(key=key or cls.get_tier_key_name(rollup_tier),
+                                            key_prefix=key_prefix, key_suffix=key_suffix)
+        compact = cls.has_compact_members(rollup_tier)
         # logger.debug(f'query for sorted set key {sorted_set_key}')
         # example key f'{key_prefix}:{cls.__name__}:{key_suffix}'
 
@@ -93,22 +179,22 @@ class TimeseriesStorage(KeyValueStorage):
         if not timestamp:
             query_response = database.zrange(sorted_set_key, -1, -1)
             try:
-                [value, timestamp] = query_response[0].decode("utf-8").split(":")
+                if compact:
+                    [value, timestamp] = [array[0] for array in cls.decode_members(query_response)]
+                else:
+                    [value, timestamp] = query_response[0].decode("utf-8").split(":")
             except:
                 value, timestamp = "unknown", JAN_1_2017_TIMESTAMP
 
             min_score = max_score = cls.score_from_timestamp(timestamp)
 
         else:
-            # compress timestamps to scores
-            target_score = cls.score_from_timestamp(timestamp)
-            score_tolerance = cls.periods_from_seconds(timestamp_tolerance)
-
             # logger.debug(f"querying for key {sorted_set_key} with score {target_score} and back {periods_range} periods")
-
-            min_score, max_score = (target_score - score_tolerance - periods_range), (target_score + score_tolerance)
+            min_score, max_score = cls.get_score_range(timestamp, timestamp_tolerance, periods_range)
 
             query_response = database.zrangebyscore(sorted_set_key, min_score, max_score)
+            if not rollup_tier and cls.archive_fallback_needed(min_score):
+                query_response = cls.get_archived_members(sorted_set_key, min_score, max_score, query_response)
 
         # OLD example query_response = [b'0.06288:1532163247']
         # which came from f'{self.value}:{str(self.unix_timestamp)}'
@@ -135,8 +221,11 @@ class TimeseriesStorage(KeyValueStorage):
             if len(query_response) < periods_range + 1:
                 return_dict["warning"] = "fewer values than query's periods_range"
 
-            values = [value_score.decode("utf-8").split(":")[0] for value_score in query_response]
-            scores = [value_score.decode("utf-8").split(":")[1] for value_score in query_response]
+            if compact:
+                values, scores = cls.decode_members(query_response)
+            else:
+                values = [value_score.decode("utf-8").split(":")[0] for value_score in query_response]
+                scores = [value_score.decode("utf-8").split(":")[1] for value_score in query_response]
             # todo: double check that [-1] in list is most recent timestamp
 
             return_dict.update({
@@ -155,10 +244,210 @@ class TimeseriesStorage(KeyValueStorage):
             return {'error': "redis query problem: " + str(e),  # wtf happened?
                     'values': []}
 
+    @classmethod
+    def archive_fallback_needed(cls, min_score: float) -> bool:
+        # only ranges older than redis retention read from disk, recent queries never do
+        if not (ARCHIVE_DIR and cls.archive_storage and cls.retention_tiers):
+            return False
+        oldest_kept_score = cls.score_from_timestamp(time.time()) - \
+                            cls.periods_from_seconds(cls.retention_tiers[0].seconds)
+        return min_score < oldest_kept_score
+
+    @classmethod
+    def merge_archived_array(cls, results_array, sorted_set_key: str, min_score: float, max_score: float):
+        """
+        :param results_array: SCORE_VALUE_DTYPE array read from redis
+        :return: archived values older than the first redis value, followed by results_array
+        """
+        from apps.TA.storages.utils.archive import query_archive
+        archived_array = query_archive(sorted_set_key, min_score, max_score)
+        if len(results_array):
+            archived_array = archived_array[:np.searchsorted(archived_array['score'], results_array['score'][0])]
+        if not len(archived_array):
+            return results_array
+        if not len(results_array):
+            return archived_array  # memory mapped, no copy
+        return np.concatenate([archived_array, results_array])
+
+    @classmethod
+    def get_archived_members(cls, sorted_set_key: str, min_score: float, max_score: float, query_response: list):
+        # same as merge_archived_array(), but for the members read by query()
+        from apps.TA.storages.utils.archive import query_archive
+        archived_array = query_archive(sorted_set_key, min_score, max_score)
+
+        if query_response:
+            if cls.compact_storage:
+                first_redis_score = cls.decode_members(query_response[:1])[1][0]
+            else:
+                first_redis_score = float(query_response[0].split(b":")[-1])
+            archived_array = archived_array[:np.searchsorted(archived_array['score'], first_redis_score)]
+
+        if cls.compact_storage:
+            archived_members = [cls.encode_member(value, score) for score, value in archived_array]
+        else:
+            archived_members = [f'{cls.format_number(value)}:{cls.format_number(score)}'.encode("utf-8")
+                                for score, value in archived_array]
+        return archived_members + list(query_response)
+
+    @staticmethod
+    def format_number(number: float) -> str:
+        number = float(number)
+        return str(int(number)) if number.is_integer() else repr(number)
+
+    @classmethod
+    def get_score_range(cls, timestamp: int, timestamp_tolerance: int = 299, periods_range: float = 0.01) -> tuple:
+        # compress timestamps to scores
+        target_score = cls.score_from_timestamp(timestamp)
+        score_tolerance = cls.periods_from_seconds(timestamp_tolerance)
+        return (target_score - score_tolerance - periods_range), (target_score + score_tolerance)
+
+    @classmethod
+    def query_array(cls, key: str = "", key_suffix: str = "", key_prefix: str = "",
+                    timestamp: int = None,
+                    timestamp_tolerance: int = 299,
+                    periods_range: float = 0.01,
+                    rollup_tier: str = None,
+                    pipeline=None,
+                    archive_ranges: list = None,
+                    *args, **kwargs):
+        """
+        same params as query(), but returns values as a numpy array instead of a dict of strings
+
+        :param rollup_tier: name of a later retention tier to read its rolled up values, eg. "1h" (optional)
+        :param pipeline: optional redis pipeline, the read is added to it and the pipeline returned
+        parse the pipeline results with array_from_response() or use query_many()
+        :param archive_ranges: optional list, with a pipeline the (key, min_score, max_score) to merge
+        from the archive is appended to it, or None if not needed
+        :return: structured numpy array of SCORE_VALUE_DTYPE, oldest to newest
+        """
+        sorted_set_key = cls.compile_db_key(key=key or cls.get_tier_key_name(rollup_tier),
+                                            key_prefix=key_prefix, key_suffix=key_suffix)
+        redis_client = pipeline if pipeline is not None else database
+        archive_range = None
+
+        if not timestamp:
+            query_response = redis_client.zrange(sorted_set_key, -1, -1, withscores=True)
+        else:
+            min_score, max_score = cls.get_score_range(timestamp, timestamp_tolerance, periods_range)
+            query_response = redis_client.zrangebyscore(sorted_set_key, min_score, max_score, withscores=True)
+            if not rollup_tier and cls.archive_fallback_needed(min_score):
+                archive_range = (sorted_set_key, min_score, max_score)
+
+        if pipeline is not None:
+            if archive_ranges is not None:
+                archive_ranges.append(archive_range)
+            return query_response  # the pipeline
+
+        results_array = cls.array_from_response(query_response, compact=cls.has_compact_members(rollup_tier))
+        if archive_range:
+            return cls.merge_archived_array(results_array, *archive_range)
+        return results_array
+
+    @classmethod
+    def query_many(cls, queries: list) -> list:
+        """
+        run several query_array() reads in one round trip
+        :param queries: list of dicts, each dict being the kwargs for one query_array() call
+        :return: list of structured numpy arrays in the same order as queries
+        """
+        pipeline, archive_ranges = database.pipeline(transaction=False), []
+        for query_kwargs in queries:
+            pipeline = cls.query_array(pipeline=pipeline, archive_ranges=archive_ranges, **query_kwargs)
+        return cls.arrays_from_responses(queries, pipeline.execute(), archive_ranges)
+
+    @classmethod
+    def arrays_from_responses(cls, queries: list, query_responses: list, archive_ranges: list) -> list:
+        """
+        parse the pipeline results of query_array() reads added to a pipeline, as query_many() does
+        for callers adding other commands to the same round trip
+        :param queries: list of dicts, the kwargs of each query_array() call
+        :param query_responses: the pipeline results of those calls, in the same order
+        :param archive_ranges: the archive_ranges list passed to those calls
+        :return: list of structured numpy arrays in the same order as queries
+        """
+        results_arrays = [
+            cls.array_from_response(query_response, compact=cls.has_compact_members(query_kwargs.get('rollup_tier')))
+            for query_kwargs, query_response in zip(queries, query_responses)
+        ]
+        return [
+            cls.merge_archived_array(results_array, *archive_range) if archive_range else results_array
+            for results_array, archive_range in zip(results_arrays, archive_ranges)
+        ]
+
+    @classmethod
+    def get_tier_key_name(cls, rollup_tier: str = None) -> str:
+        """
+        :param rollup_tier: name of a later retention tier, eg. "1h", or None for the first tier
+        :return: the class part of the sorted set keys of the tier, eg. "PriceStorage" or "PriceStorage_1h"
+        """
+        return f'{cls.__name__}_{rollup_tier}' if rollup_tier else cls.__name__
+
+    @classmethod
+    def has_compact_members(cls, rollup_tier: str = None) -> bool:
+        """
+        rollup tiers (see retention.py) always hold "value:score" strings, also for compact_storage classes
+        :param rollup_tier: name of the retention tier read, eg. "1h", or None for the class's own sorted sets
+        """
+        return cls.compact_storage and not rollup_tier
+
+    @classmethod
+    def array_from_response(cls, query_response: list, compact: bool = None):
+        """
+        :param query_response: list of (member, score) tuples from a WITHSCORES read
+        :param compact: members are packed binary, defaults to cls.compact_storage
+        :return: structured numpy array of SCORE_VALUE_DTYPE
+        """
+        results_array = np.empty(len(query_response), dtype=SCORE_VALUE_DTYPE)
+        if not len(query_response):
+            return results_array
+
+        members, scores = zip(*query_response)
+        results_array['score'] = scores
+
+        if cls.compact_storage if compact is None else compact:
+            results_array['value'] = cls.decode_members(members)[0]
+        else:
+            # parse all "value:score" members at once, every other number is a value
+            values_scores = np.fromstring(b" ".join(members).replace(b":", b" ").decode("utf-8"), sep=" ")
+            if not len(values_scores) == 2 * len(members):
+                raise TimeseriesException(f"{cls.__name__} values are not single numbers, use query() instead")
+            results_array['value'] = values_scores[::2]
+
+        return results_array
+
+    @classmethod
+    def encode_member(cls, value, score) -> bytes:
+        """
+        pack a value and its score into a fixed-width binary sorted set member
+        :param value: numeric value, stored as float64
+        :param score: whole number score as defined by score_from_timestamp()
+        :return: bytes of COMPACT_MEMBER_DTYPE.itemsize length
+        """
+        try:
+            value, score = float(value), float(score)
+        except (TypeError, ValueError):
+            raise StorageException(f"compact storage requires a numeric value, received {value}")
+        if not score == int(score):
+            raise StorageException(f"compact storage requires a whole number score, received {score}")
+        return np.array([(value, int(score))], dtype=COMPACT_MEMBER_DTYPE).tobytes()
+
+    @staticmethod
+    def decode_members(members: list):
+        """
+        unpack binary sorted set members from compact storage
+        :param members: list of bytes as returned by zrange or zrangebyscore
+        :return: tuple of numpy arrays (values, scores)
+        """
+        member_array = np.frombuffer(b"".join(members), dtype=COMPACT_MEMBER_DTYPE)
+        return member_array['value'], member_array['score']
+
     @staticmethod
     def get_values_array_from_query(query_results: dict, limit: int = 0):
 
-        value_array = [float(v) for v in query_results['values']]
+        if isinstance(query_results['values'], np.ndarray):
+            value_array = query_results['values']
+        else:
+            value_array = [float(v) for v in query_results['values']]
 
         if limit:
             if not isinstance(limit, int) or limit < 1:
@@ -176,6 +465,13 @@ class TimeseriesStorage(KeyValueStorage):
         z_add_data = {"key": z_add_key, "name": z_add_name, "score": z_add_score}  # key, score, name
         return z_add_data
 
+    def get_z_add_args(self) -> tuple:
+        # same as get_z_add_data(), but the name is packed when using compact storage
+        z_add_data = self.get_z_add_data()
+        if self.compact_storage:
+            z_add_data["name"] = self.encode_member(self.value, z_add_data["score"])
+        return tuple(z_add_data.values())
+
     def save(self, publish=False, pipeline=None, *args, **kwargs):
         if not self.value:
             raise StorageException("no value set, nothing to save!")
@@ -185,21 +481,27 @@ class TimeseriesStorage(KeyValueStorage):
 
         self.save_own_existance()
 
-        z_add_data = self.get_z_add_data()
-        # # logger.debug(f'savingdata with args {z_add_data}')
+        z_add_args = self.get_z_add_args()
+        # # logger.debug(f'savingdata with args {z_add_args}')
 
         if pipeline is not None:
-            pipeline = pipeline.zadd(*z_add_data.values())
+            pipeline = pipeline.zadd(*z_add_args)
+            pipeline = pipeline.sadd(self.get_registry_key(), z_add_args[0])
             # logger.debug("added command to redis pipeline")
             if publish: pipeline = self.publish(pipeline)
             return pipeline
         else:
-            response = database.zadd(*z_add_data.values())
             # logger.debug("no pipeline, executing zadd command immediately.")
-            if publish: self.publish()
-            return response
+            save_pipeline = database.pipeline()
+            save_pipeline.zadd(*z_add_args)
+            save_pipeline.sadd(self.get_registry_key(), z_add_args[0])
+            if publish: self.publish(save_pipeline)
+            return save_pipeline.execute()[0]
 
     def publish(self, pipeline=None):
+        if EVENT_TRANSPORT == "stream":
+            from apps.TA.storages.abstract.event_stream import add_event
+            return add_event(self.__class__.__name__, json.dumps(self.get_z_add_data()), pipeline=pipeline)
         if pipeline:
             return pipeline.publish(self.__class__.__name__, json.dumps(self.get_z_add_data()))
         else:
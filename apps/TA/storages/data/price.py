@@ -1,19 +1,33 @@
 import logging
 
-from apps.TA import TAException
+from apps.TA import TAException, COMPACT_STORAGE
+from apps.TA.storages.abstract.retention import RetentionTier
 from apps.TA.storages.abstract.ticker import TickerStorage
-from apps.TA.storages.abstract.ticker_subscriber import TickerSubscriber, score_is_near_5min
+from apps.TA.storages.abstract.ticker_subscriber import TickerSubscriber, score_is_near_5min, \
+    get_nearest_5min_score
 from apps.TA.storages.data.pv_history import default_price_indexes, derived_price_indexes, PriceVolumeHistoryStorage
 from apps.TA.storages.utils.memory_cleaner import clear_pv_history_values
+from apps.indicator.models.sma import SMA_LIST
+from settings import STAGE
 
 logger = logging.getLogger(__name__)
 
+# keep 5min values for the longest SMA, 200 days (200 periods on short for STAGE)
+PRICE_RETENTION_SECONDS = (5 if STAGE else 3600 * 24) * SMA_LIST[-1]
+
 
 class PriceException(TAException):
     pass
 
 
 class PriceStorage(TickerStorage):
+    compact_storage = COMPACT_STORAGE
+    retention_tiers = [
+        RetentionTier("5min", periods=1, seconds=PRICE_RETENTION_SECONDS),
+        RetentionTier("1h", periods=12, seconds=3600 * 24 * 730),  # 2 years
+    ]
+    archive_storage = True
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.index = kwargs.get('index', "close_price")
@@ -55,11 +69,39 @@ class PriceStorage(TickerStorage):
         results_dict['index'] = index
         return results_dict
 
+    @classmethod
+    def query_array(cls, *args, **kwargs):
+
+        if kwargs.get("periods_key", None):
+            raise PriceException("periods_key is not usable in PriceStorage query")
+
+        key_suffix = kwargs.get("key_suffix", "")
+        index = kwargs.get("index", "close_price")
+        kwargs["key_suffix"] = f'{index}' + (f':{key_suffix}' if key_suffix else "")
+
+        return super().query_array(*args, **kwargs)
+
 
 class PriceSubscriber(TickerSubscriber):
     classes_subscribing_to = [
         PriceVolumeHistoryStorage
     ]
+    batch_events = True
+
+    def get_batch_key(self, channel, data) -> tuple:
+        # all indexes for the same 5min period are resampled together
+        [ticker, exchange] = data["key"].split(":")[:2]
+        return ticker, exchange, get_nearest_5min_score(float(data["score"]))
+
+    def handle_batch(self, events: list):
+        from apps.TA.storages.utils.pv_resampling import resample_pv_storages # import here, bc has circular dependancy
+
+        if not any([score_is_near_5min(float(data["score"])) for channel, data in events]):
+            return
+
+        # all indexes for the 5min period are resampled together in one pass
+        [ticker, exchange, score] = self.get_batch_key(*events[0])
+        resample_pv_storages(ticker, exchange, score)
 
     def handle(self, channel, data, *args, **kwargs):
         from apps.TA.storages.utils.pv_resampling import generate_pv_storages # import here, bc has circular dependancy
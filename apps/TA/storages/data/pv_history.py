@@ -2,6 +2,7 @@ import logging
 
 from apps.TA import TAException
 from apps.TA.storages.abstract.indicator import TickerStorage
+from apps.TA.storages.abstract.retention import RetentionTier
 
 logger = logging.getLogger(__name__)
 
@@ -19,6 +20,8 @@ class PriceVolumeHistoryException(TAException):
 
 
 class PriceVolumeHistoryStorage(TickerStorage):
+    # raw values are only needed until resampled into PriceStorage and VolumeStorage
+    retention_tiers = [RetentionTier("raw", periods=0, seconds=3600 * 2), ]
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -50,6 +53,12 @@ class PriceVolumeHistoryStorage(TickerStorage):
             results_dict['index'] = index
         return results_dict
 
+    @classmethod
+    def query_array(cls, *args, **kwargs):
+        # "ETH_BTC:poloniex:PriceVolumeHistoryStorage:close_price"
+        kwargs["key_suffix"] = f':{kwargs.get("index", "close_price")}'
+        return super().query_array(*args, **kwargs)
+
 
     @classmethod
     def destroy(cls, *args, **kwargs):
@@ -1,9 +1,11 @@
 import logging
 
-from apps.TA import TAException
+from apps.TA import TAException, COMPACT_STORAGE
+from apps.TA.storages.abstract.retention import RetentionTier
 from apps.TA.storages.abstract.ticker import TickerStorage
 from apps.TA.storages.abstract.ticker_subscriber import TickerSubscriber, timestamp_is_near_5min, \
     get_nearest_5min_timestamp
+from apps.TA.storages.data.price import PRICE_RETENTION_SECONDS
 from apps.TA.storages.data.pv_history import PriceVolumeHistoryStorage, default_volume_indexes, derived_volume_indexes
 
 logger = logging.getLogger(__name__)
@@ -14,6 +16,13 @@ class VolumeException(TAException):
 
 
 class VolumeStorage(TickerStorage):
+    compact_storage = COMPACT_STORAGE
+    retention_tiers = [
+        RetentionTier("5min", periods=1, seconds=PRICE_RETENTION_SECONDS),
+        RetentionTier("1h", periods=12, seconds=3600 * 24 * 730),  # 2 years
+    ]
+    archive_storage = True
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.index = kwargs.get('index', "close_volume")
@@ -0,0 +1,140 @@
+"""
+local columnar archive of TimeseriesStorage values older than redis retention
+
+each sorted set key gets a directory of append-only .npy segments, eg.
+    {TA_ARCHIVE_DIR}/BTC_USDT/binance/PriceStorage/close_price/000208000-000208287.npy
+a segment is a SCORE_VALUE_DTYPE array sorted by score, named by its first and last score
+segments are never modified, only merged by compact_segments() and replaced atomically
+reads memory map the segments, so a range within one segment is a view without copying
+"""
+import logging
+import os
+
+import numpy as np
+
+from apps.TA import ARCHIVE_DIR
+from apps.TA.storages.abstract.timeseries_storage import SCORE_VALUE_DTYPE
+from settings.redis_db import database
+
+logger = logging.getLogger(__name__)
+
+MAX_SEGMENTS_PER_KEY = 64  # merge segments when a key has more than this
+ARCHIVE_BATCH_SIZE = 500  # keys per pipelined round trip
+
+
+def get_archive_path(key: str) -> str:
+    return os.path.join(ARCHIVE_DIR, *key.split(":"))
+
+
+def list_segments(key: str) -> list:
+    """
+    :return: sorted list of (first_score, last_score, file_path)
+    """
+    archive_path = get_archive_path(key)
+    if not os.path.isdir(archive_path):
+        return []
+
+    segments = []
+    for file_name in sorted(os.listdir(archive_path)):
+        if not file_name.endswith(".npy"):
+            continue  # eg. a partly written .tmp file
+        [first_score, last_score] = file_name[:-len(".npy")].split("-")
+        segments.append((int(first_score), int(last_score), os.path.join(archive_path, file_name)))
+    return segments
+
+
+def get_last_archived_score(key: str):
+    segments = list_segments(key)
+    return segments[-1][1] if segments else None
+
+
+def write_segment(key: str, values_array) -> str:
+    """
+    :param values_array: SCORE_VALUE_DTYPE array with whole number scores, sorted, newer than the last segment
+    :return: path of the new segment
+    """
+    archive_path = get_archive_path(key)
+    os.makedirs(archive_path, exist_ok=True)
+
+    file_path = os.path.join(
+        archive_path, f'{int(values_array["score"][0]):09d}-{int(values_array["score"][-1]):09d}.npy'
+    )
+    with open(file_path + ".tmp", "wb") as segment_file:
+        np.save(segment_file, values_array.astype(SCORE_VALUE_DTYPE, copy=False))
+    os.replace(file_path + ".tmp", file_path)
+    return file_path
+
+
+def compact_segments(key: str):
+    """
+    merge all segments of a key into one
+    readers holding a memory map of a replaced segment keep reading the old file until they are done
+    """
+    segments = list_segments(key)
+    if len(segments) < 2:
+        return
+    merged_array = np.concatenate([np.load(file_path, mmap_mode="r") for (_, _, file_path) in segments])
+    new_file_path = write_segment(key, merged_array)
+    for (_, _, file_path) in segments:
+        if file_path != new_file_path:
+            os.remove(file_path)
+
+
+def query_archive(key: str, min_score: float, max_score: float):
+    """
+    :return: SCORE_VALUE_DTYPE array of archived values with min_score <= score <= max_score
+    a memory mapped view when the range is within one segment
+    """
+    arrays = []
+    for (first_score, last_score, file_path) in list_segments(key):
+        if last_score < min_score or first_score > max_score:
+            continue
+        segment_array = np.load(file_path, mmap_mode="r")
+        start = np.searchsorted(segment_array["score"], min_score, side="left")
+        end = np.searchsorted(segment_array["score"], max_score, side="right")
+        arrays.append(segment_array[start:end])
+
+    if not arrays:
+        return np.empty(0, dtype=SCORE_VALUE_DTYPE)
+    if len(arrays) == 1:
+        return arrays[0]
+    return np.concatenate(arrays)
+
+
+def archive_storage_class(storage_class, before_score: float, batch_size: int = ARCHIVE_BATCH_SIZE) -> int:
+    """
+    append values scored before before_score to the archive, for every key of the storage class
+    run before the values expire from redis (see memory_cleaner.redisCleanup)
+    :return: number of values archived
+    """
+    values_archived = 0
+    keys_batch = []
+
+    def archive_batch(keys):
+        last_archived_scores = [get_last_archived_score(key) for key in keys]
+        pipeline = database.pipeline(transaction=False)
+        for key, last_archived_score in zip(keys, last_archived_scores):
+            min_score = "-inf" if last_archived_score is None else f'({last_archived_score}'
+            pipeline.zrangebyscore(key, min_score, f'({before_score}', withscores=True)
+
+        archived = 0
+        for key, query_response in zip(keys, pipeline.execute()):
+            values_array = storage_class.array_from_response(query_response)
+            if not len(values_array):
+                continue
+            write_segment(key, values_array)
+            archived += len(values_array)
+            if len(list_segments(key)) > MAX_SEGMENTS_PER_KEY:
+                compact_segments(key)
+        return archived
+
+    for key in storage_class.iter_registered_keys(batch_size=batch_size):
+        keys_batch.append(key)
+        if len(keys_batch) >= batch_size:
+            values_archived += archive_batch(keys_batch)
+            keys_batch = []
+    if keys_batch:
+        values_archived += archive_batch(keys_batch)
+
+    logger.info(f'archived {values_archived} {storage_class.__name__} values')
+    return values_archived
@@ -18,3 +18,19 @@ def missing_elements(L):
     L.sort()
     missing = chain.from_iterable(range(x + 1, y) for x, y in window(L) if (y - x) > 1)
     return list(missing)
+
+
+def missing_runs(scores, start: int, end: int) -> list:
+    """
+    same as missing_elements(), but vectorized and returning runs instead of every element
+    :param scores: array-like of whole number scores, in any order, duplicates allowed
+    :param start: first score expected
+    :param end: last score expected
+    :return: list of (first_missing, last_missing) tuples, inclusive
+    """
+    import numpy as np
+
+    scores = np.asarray(scores, dtype=np.int64)
+    scores = np.unique(np.concatenate([[start - 1], scores[(scores >= start) & (scores <= end)], [end + 1]]))
+    gap_indexes = np.flatnonzero(np.diff(scores) > 1)
+    return [(int(scores[i] + 1), int(scores[i + 1] - 1)) for i in gap_indexes]
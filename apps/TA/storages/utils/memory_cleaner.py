@@ -1,13 +1,15 @@
 import logging
 import time
 
+from apps.TA import ARCHIVE_DIR
 from apps.common.utilities.multithreading import start_new_thread
-from apps.indicator.models.sma import SMA_LIST
 from settings import STAGE
 from settings.redis_db import database
 
 logger = logging.getLogger(__name__)
 
+CLEANUP_BATCH_SIZE = 500  # keys per pipelined round trip
+
 
 def redisCleanup():
 
@@ -22,61 +24,47 @@ def redisCleanup():
 
     logger.info("I'M CLEANING REDIS !!!")
 
-    now_timestamp = int(time.time())
-
-    # PriceVolumeHistoryStorage
-    # delete all values 2 hours old or older
-    old_for_pv_history_timestamp = now_timestamp - (3600 * 2)  # 2 hours
-
+    # roll up and trim each storage class as declared in its retention_tiers
+    # PriceVolumeHistoryStorage keeps 2 hours, PriceStorage and VolumeStorage keep 200 days of 5min values
+    from apps.TA.storages.abstract.retention import apply_retention_policy
     from apps.TA.storages.data.pv_history import PriceVolumeHistoryStorage
-    old_score = PriceVolumeHistoryStorage.score_from_timestamp(old_for_pv_history_timestamp)
-
-    pv_history_keys = database.keys(f'*:PriceVolumeHistoryStorage:*')
-    for pv_history_key in pv_history_keys:
-        try:
-            database.zremrangebyscore(pv_history_key, 0, old_score)
-        except Exception as e:
-            logger.error(str(e))
-
-
-    #PriceVolumeHistoryStorage
-    from datetime import datetime, timedelta
-    from apps.TA.storages.abstract.timeseries_storage import TimeseriesStorage
-    old_score = TimeseriesStorage.score_from_timestamp(datetime(2017, 1, 1).timestamp())
-    highest_allowed_score = TimeseriesStorage.score_from_timestamp((datetime.today() + timedelta(days=1)).timestamp())
-
-    for price_history_key in database.keys("*PriceVolumeHistoryStorage*"):
-        # remove anything without a valid score (valid is between jan_1_2017 and today using timeseries score)
-        database.zremrangebyscore(price_history_key, 0, old_score)
-        database.zremrangebyscore(price_history_key, highest_allowed_score, datetime.today().timestamp())
-    #PriceVolumeHistoryStorage
-
-
-
-    # PriceStorage
-    # delete all values 200 days old or older
-    if STAGE:
-        old_for_price_timestamp = now_timestamp - (5 * SMA_LIST[-1])  # 200 periods on short
-    else:
-        old_for_price_timestamp = now_timestamp - (3600 * 24 * SMA_LIST[-1])  # 200 days
-
     from apps.TA.storages.data.price import PriceStorage
-    old_score = PriceStorage.score_from_timestamp(old_for_price_timestamp)
+    from apps.TA.storages.data.volume import VolumeStorage
 
-    price_history_keys = database.keys(f'*:PriceStorage:*')
-    for price_history_key in price_history_keys:
+    for storage_class in [PriceVolumeHistoryStorage, PriceStorage, VolumeStorage]:
         try:
-            database.zremrangebyscore(price_history_key, 0, old_score)
+            if ARCHIVE_DIR and storage_class.archive_storage:
+                # keep a copy on disk of everything about to expire from the first tier
+                from apps.TA.storages.utils.archive import archive_storage_class
+                archive_storage_class(storage_class, before_score=storage_class.score_from_timestamp(
+                    time.time() - storage_class.retention_tiers[0].seconds
+                ))
+            apply_retention_policy(storage_class)
         except Exception as e:
-            logger.error(str(e))
+            logger.error(f'{storage_class.__name__} retention failed: {str(e)}')
 
     if STAGE:
         # remove all poloniex and bittrex data for now
         # todo: remove this and make sure it's not necessary
-        for key in database.keys("*:poloniex:*"):
-            database.delete(key)
-        for key in database.keys("*:bittrex:*"):
-            database.delete(key)
+        delete_matching_keys("*:poloniex:*")
+        delete_matching_keys("*:bittrex:*")
+
+
+def delete_matching_keys(pattern: str, batch_size: int = CLEANUP_BATCH_SIZE) -> int:
+    """
+    delete all keys matching the pattern, using SCAN so redis is not blocked
+    registries are cleaned up later by apply_retention_policy() when the keys are found empty
+    """
+    keys_deleted = 0
+    keys_batch = []
+    for key in database.scan_iter(match=pattern, count=batch_size):
+        keys_batch.append(key)
+        if len(keys_batch) >= batch_size:
+            keys_deleted += database.delete(*keys_batch)
+            keys_batch = []
+    if keys_batch:
+        keys_deleted += database.delete(*keys_batch)
+    return keys_deleted
 
 # from apps.TA.storages.data.memory_cleaner import redisCleanup as rC
 
@@ -101,6 +89,14 @@ def clear_pv_history_values(ticker: str, exchange: str, score: float, conservati
     min_score = score - 1 + ((45/300) if conservative else 0)
     max_score = score - ((255/300) if conservative else 0)
 
-    for key in database.keys(f"{ticker}:{exchange}:PriceVolumeHistoryStorage:*price*"):
-        database.zremrangebyscore(key, min_score, max_score)
+    # the keys are known, no need to search for them
+    from apps.TA.storages.data.pv_history import PriceVolumeHistoryStorage, default_price_indexes
+
+    pipeline = database.pipeline(transaction=False)
+    for index in default_price_indexes:
+        key = PriceVolumeHistoryStorage.compile_db_key(
+            key=PriceVolumeHistoryStorage.__name__, key_prefix=f'{ticker}:{exchange}', key_suffix=index
+        )
+        pipeline.zremrangebyscore(key, min_score, max_score)
         # logger.debug(f"removing values in {key} for scores {min_score} to {max_score}")
+    pipeline.execute()
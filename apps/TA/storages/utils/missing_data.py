@@ -1,11 +1,14 @@
 import logging
 from datetime import datetime, timedelta
 
+import numpy as np
+
 from apps.TA import PRICE_INDEXES, VOLUME_INDEXES, JAN_1_2017_TIMESTAMP
 from apps.TA.storages.abstract.timeseries_storage import TimeseriesStorage
 from apps.TA.storages.data.price import PriceStorage
+from apps.TA.storages.data.pv_history import PriceVolumeHistoryStorage
 from apps.TA.storages.data.volume import VolumeStorage
-from apps.TA.storages.utils.list_search import missing_elements
+from apps.TA.storages.utils.list_search import missing_runs
 from apps.TA.storages.utils.pv_resampling import generate_pv_storages
 from apps.api.helpers import get_source_index, get_counter_currency_index
 from apps.indicator.models import PriceHistory
@@ -30,11 +33,21 @@ def find_start_score(ticker: str, exchange: str, index: str) -> float:
     # eg. key = "ETH_BTC:binance:PriceStorage:close_price"
     key = f"{ticker}:{exchange}:PriceStorage:{index}"
 
-    query_response = database.zrange(key, 0, 0)
-    score = float(query_response[0].decode("utf-8").split(":")[1])
+    query_response = database.zrange(key, 0, 0, withscores=True)
+    score = float(query_response[0][1])
     return score
 
 
+def get_storage_class(index: str):
+    # validate index and determine storage class
+    if index in PRICE_INDEXES:
+        return PriceStorage
+    elif index in VOLUME_INDEXES:
+        return VolumeStorage
+    else:
+        raise Exception("unknown index")
+
+
 def find_pv_storage_data_gaps(ticker: str, exchange: str, index: str, back_to_the_backlog: bool = False) -> list:
     """
     Find and plug up gaps in the data for Price and Volume Storages
@@ -42,123 +55,84 @@ def find_pv_storage_data_gaps(ticker: str, exchange: str, index: str, back_to_th
     :param ticker: eg. "ETH_BTC"
     :param exchange: eg. "binance"
     :param index: eg. "close_price", should be found in TA.PRICE_INDEXES or TA.VOLUME_INDEXES
-    :param start_score: optional, default is jan_1_2017
-    :param end_score: optional, default will reset to 2 hours ago from now()
-    :return: list of scores that are still missing gaps, [] empty list means no gaps
+    :return: list of (first_score, last_score) runs of scores still missing, [] empty list means no gaps
     """
-    from apps.TA.management.commands.TA_restore import save_pv_histories_to_redis
-
-    # validate index and determine storage class
-    if index in PRICE_INDEXES:
-        storage_class = PriceStorage
-    elif index in VOLUME_INDEXES:
-        storage_class = VolumeStorage
-    else:
-        raise Exception("unknown index")
-
-    storage_instance = storage_class(ticker=ticker, exchange=exchange, index=index, timestamp=JAN_1_2017_TIMESTAMP)
-    redis_zset_withscores = database.zrange(storage_instance.get_db_key(), 0, -1, withscores=True)
+    storage_class = get_storage_class(index)
 
     start_score = int(TimeseriesStorage.score_from_timestamp(datetime(2018,12,11).timestamp()))  # todo: change to 2018,1,1
     end_score = int(TimeseriesStorage.score_from_timestamp(datetime.now().timestamp()))  # 206836 is Dec 20
 
-    scores = [int(score) for (value, score) in redis_zset_withscores if score > start_score]
-    scores.insert(0,start_score)
-    scores.append(end_score+1)
-
-    missing_scores = missing_elements(scores)
-
-    restored_scores = []
-
-    # if back_to_the_backlog:
-    #     # let's go "back to the backlog"; try to reach back and deep into the SQL
-    #     restorable_scores = []
-    #
-    #     for processing_score in missing_scores:
-    #         processing_datetime = TimeseriesStorage.datetime_from_score(processing_score)
-    #
-    #         price_history_objects = PriceHistory.objects.filter(
-    #             timestamp__gte=processing_datetime - timedelta(minutes=1),
-    #             timestamp__lte=processing_datetime,
-    #             source=get_source_index(exchange),
-    #             counter_currency=get_counter_currency_index(ticker.split("_")[1])
-    #         )
-    #
-    #         for ph_object in price_history_objects:
-    #             results = save_pv_histories_to_redis(ph_object)
-    #             if sum(results):
-    #                 restorable_scores.append(processing_score)
-    #
-    #     if len(restorable_scores):
-    #         logger.debug("successfully restored missing data from SQL into PriceVolumeHistoryStorage")
-
-    for processing_score in missing_scores:
-        if generate_pv_storages(ticker, exchange, index, processing_score):
-            restored_scores.append(processing_score)
-            continue  # problem solved!
-
-    missing_scores = set(missing_scores) - set(restored_scores)
+    scores_array = storage_class.query_array(
+        ticker=ticker, exchange=exchange, index=index,
+        timestamp=TimeseriesStorage.timestamp_from_score(end_score),
+        periods_range=end_score - start_score, timestamp_tolerance=0
+    )['score']
+    missing_scores_runs = missing_runs(scores_array, start_score, end_score)
 
-    if len(restored_scores):
-        logger.debug(f"successfully restored {len(restored_scores)} scores from PriceVolumeHistoryStorage")
+    # only recent scores can be resampled, older PriceVolumeHistoryStorage values are already cleaned up
+    oldest_restorable_score = TimeseriesStorage.score_from_timestamp(
+        datetime.now().timestamp() - PriceVolumeHistoryStorage.retention_tiers[0].seconds
+    )
 
-    if len(missing_scores):
-        logger.debug(f"there are {len(missing_scores)} mores scores not yet restored")
+    # todo: if back_to_the_backlog, reach back and deep into the SQL (see TA_restore.restore_ticker_to_redis)
 
-    return list(missing_scores - set(restored_scores))
+    restored_scores = set()
+    for (first_score, last_score) in missing_scores_runs:
+        for processing_score in range(max(first_score, int(oldest_restorable_score)), last_score + 1):
+            if generate_pv_storages(ticker, exchange, index, processing_score):
+                restored_scores.add(processing_score)  # problem solved!
 
+    if len(restored_scores):
+        logger.debug(f"successfully restored {len(restored_scores)} scores from PriceVolumeHistoryStorage")
+        missing_scores_runs = missing_runs(
+            np.concatenate([scores_array, list(restored_scores)]), start_score, end_score
+        )
 
-def force_plug_pv_storage_data_gaps(ticker: str, exchange: str, index: str, scores: list = []):
-    # validate index and determine storage class
-    if index in PRICE_INDEXES:
-        storage_class = PriceStorage
-    elif index in VOLUME_INDEXES:
-        storage_class = VolumeStorage
-        return  # todo: turn this back on later
-    else:
-        raise Exception("unknown index")
-
-    for missing_score in scores:
-        logger.debug(f"working with {missing_score} == timestamp {TimeseriesStorage.timestamp_from_score(missing_score)}")
+    if len(missing_scores_runs):
+        logger.debug(f"there are {count_run_scores(missing_scores_runs)} mores scores "
+                     f"in {len(missing_scores_runs)} gaps not yet restored")
 
-        query_response = storage_class.query(
-            ticker=ticker,
-            exchange=exchange,
-            index=index,
-            timestamp=TimeseriesStorage.timestamp_from_score(missing_score),
-            timestamp_tolerance=0,
-            periods_range=5
-        )
+    return missing_scores_runs
 
-        if not len(query_response['values']):
-            # no previous value to copy
-            continue
 
-        if missing_score == int(float(query_response['scores'][-1])):
-            # value is not actaully missing, skip
-            continue
+def count_run_scores(scores_runs: list) -> int:
+    return sum([last_score - first_score + 1 for (first_score, last_score) in scores_runs])
 
-        copied_value = int(query_response['values'][-1])
-        copied_score = float(query_response['scores'][-1])
 
+def force_plug_pv_storage_data_gaps(ticker: str, exchange: str, index: str, scores_runs: list = [],
+                                    max_fill_periods: int = 5):
+    """
+    fill each gap with the last value before it (forward fill), one pipeline per gap
+    :param scores_runs: list of (first_score, last_score) as returned by find_pv_storage_data_gaps()
+    :param max_fill_periods: only fill if there is a value within this many periods before the gap
+    """
+    storage_class = get_storage_class(index)
+    if storage_class is VolumeStorage:
+        return  # todo: turn this back on later
 
-        logger.debug("printing query response >>>")
-        logger.debug(query_response)
+    storage = storage_class(ticker=ticker, exchange=exchange, index=index, timestamp=JAN_1_2017_TIMESTAMP)
 
-        assert 'warning' in query_response
-        assert float(query_response['earliest_timestamp']) <= float(query_response['latest_timestamp'])
-        assert float(query_response['latest_timestamp']) <= TimeseriesStorage.timestamp_from_score(missing_score - 1)
-        assert copied_score <= missing_score - 1
+    for (first_score, last_score) in scores_runs:
+        logger.debug(f"working with {first_score} to {last_score} == timestamp "
+                     f"{TimeseriesStorage.timestamp_from_score(first_score)}")
 
-        storage = storage_class(ticker=ticker,
-                                exchange=exchange,
-                                timestamp=TimeseriesStorage.timestamp_from_score(missing_score),
-                                index=index)
+        previous_array = storage_class.query_array(
+            ticker=ticker, exchange=exchange, index=index,
+            timestamp=TimeseriesStorage.timestamp_from_score(first_score - 1),
+            timestamp_tolerance=0, periods_range=max_fill_periods - 1
+        )
+        if not len(previous_array):
+            # no previous value to copy
+            continue
 
-        # save value equal to previous score's value
-        storage.value = copied_value
-        storage.save(publish=True)
-        logger.debug("Filled the gap on score " + str(missing_score))
+        # save values equal to previous score's value
+        storage.value = int(previous_array['value'][-1])
+        pipeline = database.pipeline()
+        for missing_score in range(first_score, last_score + 1):
+            storage.unix_timestamp = TimeseriesStorage.timestamp_from_score(missing_score)
+            pipeline = storage.save(publish=True, pipeline=pipeline)
+        pipeline.execute()
+        logger.debug(f"Filled the gap on scores {first_score} to {last_score}")
 
 
 def test_force_plug_pv_storage_data_gaps():
@@ -168,9 +142,9 @@ def test_force_plug_pv_storage_data_gaps():
     key = f"{ticker}:{exchange}:PriceStorage:{index}"
     database.zremrangebyscore(key, 155773 + 1, 155773 + 2)
 
-    scores = [155773, 155773 + 1, 155773 + 2]
+    scores_runs = [(155773 + 1, 155773 + 2)]
 
-    force_plug_pv_storage_data_gaps(ticker, exchange, index, scores)
+    force_plug_pv_storage_data_gaps(ticker, exchange, index, scores_runs)
 
     database.zremrangebyscore(key, 155773 + 1, 155773 + 2)
 
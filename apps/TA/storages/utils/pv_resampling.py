@@ -1,121 +1,166 @@
 import logging
 
+import numpy as np
+
 from apps.TA import PRICE_INDEXES, VOLUME_INDEXES
-from apps.TA.storages.abstract.ticker_subscriber import get_nearest_5min_score
+from apps.TA.storages.abstract.ticker_subscriber import get_nearest_5min_score, timestamp_is_near_5min
 from apps.TA.storages.abstract.timeseries_storage import TimeseriesStorage
 from apps.TA.storages.data.price import PriceStorage
-from apps.TA.storages.data.pv_history import PriceVolumeHistoryStorage, derived_price_indexes
+from apps.TA.storages.data.pv_history import PriceVolumeHistoryStorage, default_price_indexes, default_volume_indexes
 from apps.TA.storages.data.volume import VolumeStorage
+from settings import BTC, USDT, BINANCE
+from settings.redis_db import database
 
 logger = logging.getLogger(__name__)
 
 
+def resample_values(raw_values: dict) -> dict:
+    """
+    :param raw_values: dict of numpy arrays of values in time order for one 5min period,
+    for each of default_price_indexes + default_volume_indexes (empty arrays if no values)
+    :return: dict of PriceStorage and VolumeStorage index: value, with 'close_price' last
+    """
+    index_values = {}
+    if len(raw_values["open_price"]):
+        index_values["open_price"] = int(raw_values["open_price"][0])
+    if len(raw_values["low_price"]):
+        index_values["low_price"] = int(raw_values["low_price"].min())
+    if len(raw_values["high_price"]):
+        index_values["high_price"] = int(raw_values["high_price"].max())
+    if len(raw_values["close_volume"]):
+        index_values["close_volume"] = float(raw_values["close_volume"][-1])  # volumes can be fractional
+
+    if len(raw_values["close_price"]):
+        all_values = np.unique(np.concatenate([raw_values[index] for index in default_price_indexes]))
+        index_values.update({
+            "midpoint_price": int(all_values[(len(all_values) - 1) // 2]),
+            "mean_price": float(all_values.mean()),
+            "price_variance": float(all_values.var()),
+        })
+        # always save 'close_price' last, it is published for the indicators
+        index_values["close_price"] = int(raw_values["close_price"][-1])
+
+    return index_values
+
+
+def resample_pv_storages(ticker: str, exchange: str, score: float) -> bool:
+    """
+    resample all indexes from PriceVolumeHistoryStorage into one 5min period in PriceStorage and VolumeStorage
+    reads all raw indexes in one round trip and writes all resampled values in one pipeline
+    :param ticker: eg. "ETH_BTC"
+    :param exchange: eg. "binance"
+    :param score: as defined by TimeseriesStorage.score_from_timestamp()
+    :return: True if successful at generating a new close_price for the score, else False
+    """
+    return "close_price" in save_resampled_pv_storages(ticker, exchange, score)
+
+
+def save_resampled_pv_storages(ticker: str, exchange: str, score: float) -> dict:
+    """
+    see resample_pv_storages()
+    :return: dict of the PriceStorage and VolumeStorage index: value saved for the score
+    """
+    score = get_nearest_5min_score(score)
+    timestamp = TimeseriesStorage.timestamp_from_score(score)
+
+    raw_indexes = default_price_indexes + default_volume_indexes
+    raw_arrays = dict(zip(raw_indexes, PriceVolumeHistoryStorage.query_many([
+        dict(ticker=ticker, exchange=exchange, index=index, timestamp=timestamp,
+             periods_range=1, timestamp_tolerance=29)
+        for index in raw_indexes
+    ])))
+    index_values = resample_values({index: raw_array['value'] for index, raw_array in raw_arrays.items()})
+    if not index_values:
+        return {}
+
+    pipeline = database.pipeline()
+    for index, value in index_values.items():
+        storage_class = PriceStorage if index in PRICE_INDEXES else VolumeStorage
+        storage = storage_class(ticker=ticker, exchange=exchange, timestamp=timestamp, index=index, value=value)
+        if storage.value:
+            pipeline = storage.save(publish=bool(index == "close_price"), pipeline=pipeline)
+    pipeline.execute()
+
+    return index_values
+
+
 def generate_pv_storages(ticker: str, exchange: str, index: str, score: float) -> bool:
     """
     resample values from PriceVolumeHistoryStorage into 5min periods in PriceStorage and VolumeStorage
+    all indexes of the period are resampled together with resample_pv_storages(),
+    so callers going index by index save the same values as the batched PriceSubscriber
     :param ticker: eg. "ETH_BTC"
     :param exchange: eg. "binance"
     :param index: eg. "close_price"
     :param score: as defined by TimeseriesStorage.score_from_timestamp()
     :return: True if successful at generating a new storage index value for the score, else False
     """
-    score = get_nearest_5min_score(score)
-    timestamp = TimeseriesStorage.timestamp_from_score(score)
-
-    if index in PRICE_INDEXES:
-        storage = PriceStorage(ticker=ticker, exchange=exchange, timestamp=timestamp, index=index)
-    elif index in VOLUME_INDEXES:
-        storage = VolumeStorage(ticker=ticker, exchange=exchange, timestamp=timestamp, index=index)
-    else:
+    if index not in PRICE_INDEXES and index not in VOLUME_INDEXES:
         logger.error("I don't know what kind of index this is")
         return False
 
-    # logger.debug(f'process price for ticker: {ticker} and index: {index}')
+    return index in save_resampled_pv_storages(ticker, exchange, score)
 
-    # eg. key_format = f'{ticker}:{exchange}:PriceVolumeHistoryStorage:{index}'
 
-    query_results = PriceVolumeHistoryStorage.query(
-        ticker=ticker, exchange=exchange,
-        index=index, timestamp=timestamp,
-        periods_range=1, timestamp_tolerance=29
-    )
+### PULL PRICE HISTORY RECORDS FROM CORE PRICE HISTORY DATABASE ###
+def save_pv_histories_to_redis(ph_object, pipeline=None):
+    # note an empty redis-py pipeline is falsy, so compare with None
+    if ph_object.source != BINANCE or ph_object.counter_currency not in [BTC, USDT]:
+        return [0] if pipeline is None else pipeline
 
-    if not query_results['values_count']:
-        return False
+    using_local_pipeline = pipeline is None
 
-    # logger.debug("results from PriceVolumeHistoryStorage query... ")
-    # logger.debug(query_results)
-
-    try:
-        index_values = [int(v) for v in query_results['values']]
-        # timestamps = [int(v) for v in query_results['timestamps']]
-
-        if not len(index_values):
-            storage.value = None
-        elif index == "close_volume":
-            storage.value = index_values[-1]
-        elif index == "open_price":
-            storage.value = index_values[0]
-        elif index == "low_price":
-            storage.value = min(index_values)
-        elif index == "high_price":
-            storage.value = max(index_values)
-        elif index == "close_price":
-            storage.value = index_values[-1]
-        else:
-            raise IndexError("unknown index)")
-
-    except IndexError:
-        return False # couldn't find a useful value or index (sorry for using this for both definitions of "index")
-    except ValueError:
-        return False # couldn't find a useful value
-    except Exception as e:
-        logger.error("there's a bug here: " + str(e))
-        return False
+    if using_local_pipeline:
+        pipeline = database.pipeline()  # transaction=False
 
-    if storage.value:
-        storage.save(publish=bool(index == "close_price"))
-        # logger.info("saved new thing: " + storage.get_db_key())
+    ticker = f'{ph_object.transaction_currency}_{ph_object.get_counter_currency_display()}'
+    exchange = str(ph_object.get_source_display())
+    unix_timestamp = int(ph_object.timestamp.timestamp())
 
-    if index == 'close_volume':
-        # todo:  for index in derived_volume_indexes: calculate and save volume index
-        pass
+    # SAVE VALUES IN REDIS USING PriceVolumeHistoryStorage OBJECT
+    # CREATE OBJECT FOR STORAGE
+    pv_storage = PriceVolumeHistoryStorage(
+        ticker=ticker,
+        exchange=exchange,
+        timestamp=unix_timestamp
+    )
 
-    if index == "close_price":
-        all_values_set = set(index_values)  # these are the close prices
-        for other_index in ["open_price", "low_price", "high_price"]:
-            query_results = PriceVolumeHistoryStorage.query(
-                ticker=ticker, exchange=exchange,
-                index=other_index, timestamp=timestamp,
-                periods_range=1, timestamp_tolerance=29
-            )
+    publish_close_price = timestamp_is_near_5min(unix_timestamp)
 
-            index_values = [int(v) for v in query_results['values']]
-            all_values_set = all_values_set | set(index_values)
+    if ph_object.volume and ph_object.volume > 0:
+        pv_storage.index = "close_volume"
+        pv_storage.value = ph_object.volume
+        pipeline = pv_storage.save(publish=publish_close_price, pipeline=pipeline)
 
-        if not len(all_values_set):
-            logger.error("This shouldn't be possible. Serious bug if you see this!")
-            return False
+    if ph_object.open_p and ph_object.open_p > 0:
+        pv_storage.index = "open_price"
+        pv_storage.value = ph_object.open_p
+        pipeline = pv_storage.save(publish=False, pipeline=pipeline)
 
-        for d_index in derived_price_indexes:
-            price_storage = PriceStorage(ticker=ticker, exchange=exchange, timestamp=timestamp, index=d_index)
+    if ph_object.high and ph_object.high > 0:
+        pv_storage.index = "high_price"
+        pv_storage.value = ph_object.high
+        pipeline = pv_storage.save(publish=False, pipeline=pipeline)
 
-            values_set = all_values_set.copy()
+    if ph_object.low and ph_object.low > 0:
+        pv_storage.index = "low_price"
+        pv_storage.value = ph_object.low
+        pipeline = pv_storage.save(publish=False, pipeline=pipeline)
 
-            if d_index == "midpoint_price":
-                while len(values_set) > 2:
-                    values_set.remove(max(values_set))
-                    values_set.remove(min(values_set))
-                price_storage.value = values_set.pop()
+    # always run 'close_price' index last
+    # why? when it saves, it triggers price storage to resample
+    # after resampling history indexes are deleted
+    # so all others should be available for resampling before being deleted
 
-            elif d_index == "mean_price":
-                price_storage.value = sum(values_set) / (len(values_set) or 1)
+    if ph_object.close and ph_object.close > 0:
+        pv_storage.index = "close_price"
+        pv_storage.value = ph_object.close
+        pipeline = pv_storage.save(publish=True, pipeline=pipeline)
 
-            elif d_index == "price_variance":
-                # this is too small of a period size to measure variance
-                pass
+    if using_local_pipeline:
+        return pipeline.execute()
+    else:
+        return pipeline
 
-            if price_storage.value:
-                price_storage.save()
 
-    return True
+### END PULL OF PRICE HISTORY RECORDS ###
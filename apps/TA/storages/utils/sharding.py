@@ -0,0 +1,37 @@
+from bisect import bisect
+from functools import lru_cache
+from zlib import crc32
+
+VIRTUAL_NODES_PER_SHARD = 64
+
+
+def _hash(key: str) -> int:
+    # crc32 is stable across processes and restarts, unlike hash()
+    return crc32(key.encode("utf-8"))
+
+
+@lru_cache(maxsize=32)
+def get_hash_ring(shard_count: int) -> tuple:
+    """
+    consistent hash ring, so changing the shard count only moves about 1/shard_count of tickers
+    :return: tuple of (sorted list of points, list of shard index for each point)
+    """
+    ring = sorted(
+        (_hash(f'shard:{shard_index}:{virtual_node}'), shard_index)
+        for shard_index in range(shard_count)
+        for virtual_node in range(VIRTUAL_NODES_PER_SHARD)
+    )
+    return [point for point, _ in ring], [shard_index for _, shard_index in ring]
+
+
+def get_shard(ticker: str, exchange: str, shard_count: int) -> int:
+    """
+    :param ticker: eg. "ETH_BTC"
+    :param exchange: eg. "binance"
+    :param shard_count: total number of shards (eg. TA_worker processes)
+    :return: the shard index that owns this ticker and exchange, 0 <= index < shard_count
+    """
+    if shard_count <= 1:
+        return 0
+    points, shard_indexes = get_hash_ring(shard_count)
+    return shard_indexes[bisect(points, _hash(f'{ticker}:{exchange}')) % len(points)]
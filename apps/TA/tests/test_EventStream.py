@@ -0,0 +1,64 @@
+from django.test import TestCase
+
+from apps.TA.storages.abstract.event_stream import EventStreamConsumer, EVENT_STREAM_GROUP, MAX_DELIVERIES
+from settings.redis_db import database
+
+stream_key = "TA_events_test"
+consumer_name = "test_consumer"
+
+
+def always_fail(data_event):
+    raise Exception("handler always fails")
+
+
+class EventStreamConsumerTestCase(TestCase):
+
+    def setUp(self):
+        database.delete(stream_key)
+        EventStreamConsumer(consumer_name, stream_key=stream_key)  # creates the group
+        self.poison_id = database.execute_command(
+            'XADD', stream_key, '*', 'channel', 'PriceStorage', 'data', '{}'
+        )
+
+    def tearDown(self):
+        database.delete(stream_key)
+
+    def read_and_fail(self, consumer, **kwargs):
+        events = consumer.read(block_ms=1, **kwargs)
+        acked_ids = []
+        for event_id, data_event in events:
+            try:
+                always_fail(data_event)
+                acked_ids.append(event_id)
+            except Exception:
+                pass
+        consumer.ack(acked_ids)
+        return events
+
+    def get_pending_ids(self):
+        pending = database.execute_command('XPENDING', stream_key, EVENT_STREAM_GROUP, '-', '+', 10)
+        return [event_id for event_id, consumer, idle_ms, deliveries in pending]
+
+    def test_backlog_is_read_once(self):
+        consumer = EventStreamConsumer(consumer_name, stream_key=stream_key)
+        self.assertEqual([event_id for event_id, _ in self.read_and_fail(consumer)], [self.poison_id])
+
+        # a restarted consumer re-reads the failed event once, then moves on to new events
+        consumer = EventStreamConsumer(consumer_name, stream_key=stream_key)
+        self.assertEqual([event_id for event_id, _ in self.read_and_fail(consumer)], [self.poison_id])
+
+        new_id = database.execute_command('XADD', stream_key, '*', 'channel', 'PriceStorage', 'data', '{}')
+        self.assertEqual([event_id for event_id, _ in self.read_and_fail(consumer)], [new_id])
+        self.assertIsNone(consumer.backlog_id)
+        self.assertEqual(self.read_and_fail(consumer), [])
+
+    def test_poison_event_is_dropped(self):
+        self.read_and_fail(EventStreamConsumer(consumer_name, stream_key=stream_key))
+
+        for restart in range(MAX_DELIVERIES - 1):
+            events = self.read_and_fail(EventStreamConsumer(consumer_name, stream_key=stream_key))
+            self.assertEqual([event_id for event_id, _ in events], [self.poison_id])
+
+        # delivered MAX_DELIVERIES times already, so the next restart drops it
+        self.assertEqual(self.read_and_fail(EventStreamConsumer(consumer_name, stream_key=stream_key)), [])
+        self.assertEqual(self.get_pending_ids(), [])
@@ -140,6 +140,65 @@ class IndicatorsTestCase(TestCase):
         self.run_subscriber(RsiStorage, RsiSubscriber)
 
 
+    # STREAMING INDICATORS
+
+    def test_streaming_state_matches_window(self):
+        import talib
+        from apps.TA.indicators.overlap.sma import SmaStorage
+        from apps.TA.indicators.overlap.ema import EmaStorage
+        from apps.TA.indicators.momentum.rsi import RsiStorage
+
+        periods = 20
+        values = np.random.random(periods * 5)
+        scores = np.arange(len(values), dtype=float)
+
+        # rebuilt from the first part of the history, then rolled through the rest like new closes
+        for storage_class, reference_values in [
+            (SmaStorage, talib.SMA(values, timeperiod=periods)),
+            (EmaStorage, talib.EMA(values, timeperiod=periods)),
+            (RsiStorage, talib.RSI(values, timeperiod=periods)),
+        ]:
+            storage = storage_class(ticker=ticker, exchange=exchange, timestamp=JAN_1_2017_TIMESTAMP, periods=periods)
+            first_update = storage.recovery_periods(periods) + 1
+            state = storage.state_from_history(values[:first_update], scores[:first_update], periods)
+
+            for i in range(first_update, len(values)):
+                state = storage.update_state(state, values[i], scores[i], values[i - periods], periods)
+
+            self.assertAlmostEqual(float(storage.value_from_state(state, periods)), reference_values[-1],
+                                   msg=storage_class.__name__)
+
+    def test_min_max_queue_matches_window(self):
+        from apps.TA.indicators.math_operators.min_max import MinStorage, MaxStorage
+
+        min_max_ticker = "MINMAX_BTC"
+        periods = 20
+        values = np.random.random(periods * 3)
+
+        for i, value in enumerate(values):
+            timestamp = JAN_1_2017_TIMESTAMP + 300 * i
+            price_storage = PriceStorage(ticker=min_max_ticker, exchange=exchange, timestamp=timestamp)
+            price_storage.value = value
+            price_storage.save()
+
+            for storage_class, window_function in [(MinStorage, np.min), (MaxStorage, np.max)]:
+                storage = storage_class(ticker=min_max_ticker, exchange=exchange, timestamp=timestamp, periods=periods)
+                if i % 2:
+                    storage.prefetch([periods])  # the path of compute_and_save_all_values_for_timestamp()
+                extreme_value = storage.compute_value(periods)
+
+                if i + 1 < periods:
+                    self.assertEqual(extreme_value, "")  # not enough history yet
+                    continue
+                self.assertAlmostEqual(float(extreme_value), window_function(values[i + 1 - periods:i + 1]))
+                # the same score resampled again rebuilds the queue and gives the same value
+                if i == periods * 2:
+                    self.assertAlmostEqual(float(storage.compute_value(periods)), float(extreme_value))
+
+        for key in database.keys(f"{min_max_ticker}:*"):
+            database.delete(key)
+
+
     # END INDICATORS
 
     def tearDown(self):
@@ -0,0 +1,29 @@
+import numpy as np
+from django.test import SimpleTestCase
+
+from apps.TA.storages.utils.list_search import missing_runs, missing_elements
+
+
+class MissingRunsTestCase(SimpleTestCase):
+
+    def test_empty_list(self):
+        self.assertEqual(missing_runs([], 10, 20), [(10, 20)])
+        self.assertEqual(missing_runs(np.array([]), 10, 10), [(10, 10)])
+
+    def test_no_gaps(self):
+        self.assertEqual(missing_runs(range(10, 21), 10, 20), [])
+        self.assertEqual(missing_runs(np.arange(0, 30, dtype=float), 10, 20), [])  # scores outside are ignored
+
+    def test_gaps_at_start_and_end(self):
+        self.assertEqual(missing_runs([13, 14, 15], 10, 20), [(10, 12), (16, 20)])
+        self.assertEqual(missing_runs([10, 20], 10, 20), [(11, 19)])
+        self.assertEqual(missing_runs([11, 19], 10, 20), [(10, 10), (12, 18), (20, 20)])
+
+    def test_duplicate_and_unordered_scores(self):
+        self.assertEqual(missing_runs([15, 12, 12, 15, 11, 11, 20], 10, 20), [(10, 10), (13, 14), (16, 19)])
+
+    def test_matches_missing_elements(self):
+        scores = [3, 5, 5, 6, 9, 14, 15, 15, 18]
+        runs = missing_runs(scores, 3, 18)
+        self.assertEqual([score for (first, last) in runs for score in range(first, last + 1)],
+                         missing_elements(scores))
@@ -3,7 +3,7 @@ import time
 from django.test import TestCase
 
 from apps.TA import JAN_1_2017_TIMESTAMP
-from apps.TA.storages.abstract.timeseries_storage import TimeseriesException
+from apps.TA.storages.abstract.timeseries_storage import TimeseriesException, StorageException
 from apps.TA.storages.data.price import PriceStorage, PriceException
 from apps.TA.storages.data.pv_history import PriceVolumeHistoryException
 
@@ -73,9 +73,103 @@ class PriceTestCase(TestCase):
             int(query_results['values'][-1]),
             value)
 
+    def test_query_array(self):
+        for periods_ago in range(3):
+            self.price.unix_timestamp = timestamp - (300 * periods_ago)
+            self.price.value = value + periods_ago
+            self.price.save()
+
+        query_kwargs = dict(ticker=ticker1, exchange=exchange, index=index,
+                            timestamp=timestamp, periods_range=2)
+        results_array = PriceStorage.query_array(**query_kwargs)
+
+        self.assertEqual(list(results_array['value']), [value + 2, value + 1, value])
+        self.assertEqual(results_array['score'][-1], PriceStorage.score_from_timestamp(timestamp))
+
+        [many_results_array, empty_array] = PriceStorage.query_many([
+            query_kwargs, dict(query_kwargs, index="open_price")
+        ])
+        self.assertEqual(list(many_results_array['value']), list(results_array['value']))
+        self.assertEqual(len(empty_array), 0)
+
+    def test_save_registers_key(self):
+        self.price.save()
+        self.assertIn(
+            self.price.get_db_key(),
+            list(PriceStorage.iter_registered_keys(match=f"{ticker1}:{exchange}:*"))
+        )
+
+    def test_backfill_registers_unsaved_keys(self):
+        from settings.redis_db import database
+        self.price.save()  # the registry exists
+        unregistered_key = f"{ticker2}:{exchange}:PriceStorage:close_price"
+        database.zadd(unregistered_key, **{f"{value}:1": 1})  # as saved before the registry existed
+        database.delete(PriceStorage.get_registry_backfilled_key())
+
+        self.assertIn(unregistered_key, list(PriceStorage.iter_registered_keys(match=f"{ticker2}:{exchange}:*")))
+        self.assertTrue(database.exists(PriceStorage.get_registry_backfilled_key()))
+        database.delete(unregistered_key)
 
 
     def tearDown(self):
         from settings.redis_db import database
         database.delete(self.price.get_db_key())
 
+
+
+class CompactPriceTestCase(TestCase):
+    def setUp(self):
+        self.compact_storage = PriceStorage.compact_storage
+        PriceStorage.compact_storage = True
+        self.price = PriceStorage(
+            ticker=ticker2, exchange=exchange, timestamp=timestamp,
+            index=index, value=value
+        )
+
+    def test_member_round_trip(self):
+        member = PriceStorage.encode_member(value, 155773.0)
+        values, scores = PriceStorage.decode_members([member, member])
+        self.assertEqual(list(values), [value, value])
+        self.assertEqual(list(scores), [155773, 155773])
+
+    def test_fractional_score_raises_exception(self):
+        self.assertRaises(
+            StorageException,
+            PriceStorage.encode_member, value, 155773.5
+        )
+
+    def test_query_returns_arrays(self):
+        for periods_ago in range(3):
+            self.price.unix_timestamp = timestamp - (300 * periods_ago)
+            self.price.value = value + periods_ago
+            self.price.save()
+
+        query_results = PriceStorage.query(ticker=ticker2, exchange=exchange, index=index,
+                                           timestamp=timestamp, periods_range=2)
+
+        self.assertEqual(list(query_results['values']), [value + 2, value + 1, value])
+        self.assertEqual(int(query_results['scores'][-1]), PriceStorage.score_from_timestamp(timestamp))
+
+    def test_rollup_tier_is_read_as_strings(self):
+        from settings.redis_db import database
+        rollup_key = f"{ticker2}:{exchange}:PriceStorage_1h:{index}"
+        database.zadd(rollup_key, **{f"{value}:155772": 155772})  # as written by retention.py
+
+        rollup_query = dict(ticker=ticker2, exchange=exchange, index=index, rollup_tier="1h")
+        self.assertEqual(list(PriceStorage.query_array(**rollup_query)['value']), [value])
+        [rollup_array] = PriceStorage.query_many([rollup_query])
+        self.assertEqual(list(rollup_array['value']), [value])
+        self.assertEqual(PriceStorage.query(**rollup_query)['values'], [str(value)])
+
+        # the class's own sorted set in the same round trip is still read as packed binary
+        self.price.save()
+        [own_array, rollup_array] = PriceStorage.query_many([
+            dict(ticker=ticker2, exchange=exchange, index=index, timestamp=timestamp), rollup_query
+        ])
+        self.assertEqual((list(own_array['value']), list(rollup_array['value'])), ([value], [value]))
+        database.delete(rollup_key)
+
+    def tearDown(self):
+        from settings.redis_db import database
+        database.delete(self.price.get_db_key())
+        PriceStorage.compact_storage = self.compact_storage
@@ -0,0 +1,60 @@
+import numpy as np
+from django.test import SimpleTestCase
+
+from apps.TA.storages.utils.pv_resampling import resample_values
+
+
+def raw_values(open_price=(), high_price=(), low_price=(), close_price=(), close_volume=()):
+    return {
+        "open_price": np.array(open_price, dtype=float),
+        "high_price": np.array(high_price, dtype=float),
+        "low_price": np.array(low_price, dtype=float),
+        "close_price": np.array(close_price, dtype=float),
+        "close_volume": np.array(close_volume, dtype=float),
+    }
+
+
+class ResampleValuesTestCase(SimpleTestCase):
+
+    def test_ohlc_values(self):
+        index_values = resample_values(raw_values(
+            open_price=[100, 101], high_price=[110, 120], low_price=[90, 95], close_price=[105, 107]
+        ))
+        self.assertEqual(index_values["open_price"], 100)
+        self.assertEqual(index_values["high_price"], 120)
+        self.assertEqual(index_values["low_price"], 90)
+        self.assertEqual(index_values["close_price"], 107)
+        self.assertEqual(list(index_values)[-1], "close_price")  # published last for the indicators
+
+    def test_midpoint_is_lower_median_of_unique_values(self):
+        # unique values 90, 100, 110, 120 -> lower median 100, the repeated 100 and 110 count once
+        index_values = resample_values(raw_values(
+            open_price=[100], high_price=[120, 110], low_price=[90, 100], close_price=[110]
+        ))
+        self.assertEqual(index_values["midpoint_price"], 100)
+
+        index_values = resample_values(raw_values(
+            open_price=[100], high_price=[120], low_price=[90], close_price=[110, 105]
+        ))
+        self.assertEqual(index_values["midpoint_price"], 105)  # odd count, the middle value
+
+    def test_mean_and_variance_of_unique_values(self):
+        index_values = resample_values(raw_values(
+            open_price=[100], high_price=[120, 110], low_price=[90, 100], close_price=[110]
+        ))
+        unique_values = np.array([90, 100, 110, 120])
+        self.assertAlmostEqual(index_values["mean_price"], unique_values.mean())
+        self.assertAlmostEqual(index_values["price_variance"], np.var(unique_values))
+
+        index_values = resample_values(raw_values(close_price=[100]))
+        self.assertEqual(index_values["price_variance"], 0)
+
+    def test_close_volume_is_float(self):
+        index_values = resample_values(raw_values(close_price=[100], close_volume=[1.5, 2.75]))
+        self.assertEqual(index_values["close_volume"], 2.75)
+        self.assertIsInstance(index_values["close_volume"], float)
+
+    def test_no_close_price(self):
+        index_values = resample_values(raw_values(open_price=[100], close_volume=[3]))
+        self.assertEqual(index_values, {"open_price": 100, "close_volume": 3.0})
+        self.assertEqual(resample_values(raw_values()), {})
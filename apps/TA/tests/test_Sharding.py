@@ -0,0 +1,46 @@
+from django.test import SimpleTestCase
+
+from apps.TA.storages.abstract.ticker_subscriber import TickerSubscriber
+from apps.TA.storages.utils.sharding import get_shard
+
+exchange = "binance"
+tickers = [f'COIN{i}_BTC' for i in range(400)]
+
+
+class ShardingTestCase(SimpleTestCase):
+
+    def test_shard_is_stable(self):
+        # crc32 points, the same in every process and after restarts
+        self.assertEqual([get_shard(ticker, exchange, 4) for ticker in ["ETH_BTC", "LTC_BTC", "BTC_USDT", "XRP_BTC"]],
+                         [1, 0, 1, 0])
+        self.assertEqual(get_shard("ETH_BTC", exchange, 4), get_shard("ETH_BTC", exchange, 4))
+
+    def test_single_shard(self):
+        self.assertEqual({get_shard(ticker, exchange, 1) for ticker in tickers}, {0})
+        self.assertEqual(get_shard("ETH_BTC", exchange, 0), 0)
+
+    def test_every_shard_owns_tickers(self):
+        for shard_count in range(2, 9):
+            shards = [get_shard(ticker, exchange, shard_count) for ticker in tickers]
+            self.assertEqual(set(shards), set(range(shard_count)))
+            fair_share = len(tickers) / shard_count
+            for shard_index in range(shard_count):
+                self.assertGreater(shards.count(shard_index), fair_share / 3, (shard_count, shard_index))
+
+    def test_new_shard_only_takes_tickers(self):
+        moved_tickers = [ticker for ticker in tickers
+                         if get_shard(ticker, exchange, 4) != get_shard(ticker, exchange, 5)]
+        # about 1/5 of the tickers move, all of them to the new shard
+        self.assertLess(len(moved_tickers), len(tickers) * 2 / 5)
+        self.assertEqual({get_shard(ticker, exchange, 5) for ticker in moved_tickers}, {4})
+
+    def test_each_event_has_one_owner(self):
+        shard_count = 3
+        subscribers = [TickerSubscriber(shard=(shard_index, shard_count), subscribe=False)
+                       for shard_index in range(shard_count)]
+        for ticker in tickers[:50]:
+            data = {"key": f'{ticker}:{exchange}:PriceStorage:close_price'}
+            owners = [subscriber for subscriber in subscribers if subscriber.owns_event(data)]
+            self.assertEqual(len(owners), 1)
+            self.assertEqual(owners[0].shard[0], get_shard(ticker, exchange, shard_count))
+        self.assertTrue(TickerSubscriber(subscribe=False).owns_event({"key": f'ETH_BTC:{exchange}:PriceStorage'}))
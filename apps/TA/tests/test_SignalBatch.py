@@ -0,0 +1,43 @@
+from django.test import TestCase
+
+from apps.TA import JAN_1_2017_TIMESTAMP
+from apps.TA.storages.abstract.indicator import SignalBatch, BULLISH
+from apps.TA.storages.data.price import PriceStorage
+from apps.indicator.models import Price
+from apps.signal.models import Signal
+from settings import BINANCE, BTC
+
+ticker = "ETH_BTC"
+exchange = "binance"
+timestamp = JAN_1_2017_TIMESTAMP + 86400 * 2
+
+
+class SignalBatchTestCase(TestCase):
+
+    def setUp(self):
+        price_storage = PriceStorage(ticker=ticker, exchange=exchange, timestamp=timestamp)
+        price_storage.value = 5000000
+        price_storage.save()
+
+        # the db prices the pre_save receiver reads price and price_change from
+        for (price_timestamp, price) in [(timestamp - 86400 - 60, 4000000), (timestamp - 60, 5000000)]:
+            Price.objects.create(source=BINANCE, transaction_currency="ETH", counter_currency=BTC,
+                                 price=price, timestamp=price_timestamp)
+
+        self.signal_kwargs = dict(
+            timestamp=timestamp, source=BINANCE, transaction_currency="ETH", counter_currency=BTC,
+            resample_period=60, signal="RSI", trend=BULLISH, strength_value=3, strength_max=3,
+        )
+
+    def test_batched_signal_matches_saved_signal(self):
+        saved_signal = Signal.objects.create(price=5000000, **self.signal_kwargs)
+
+        signal_batch = SignalBatch()
+        signal_batch.add(ticker, exchange, **self.signal_kwargs)
+        (batched_signal, ) = signal_batch.create()
+        batched_signal.refresh_from_db()
+
+        self.assertIsNotNone(batched_signal.price_change)
+        for field in ['price', 'price_change', 'timestamp', 'source', 'transaction_currency', 'counter_currency',
+                      'resample_period', 'signal', 'trend', 'strength_value', 'strength_max']:
+            self.assertEqual(getattr(batched_signal, field), getattr(saved_signal, field), field)
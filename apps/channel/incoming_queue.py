@@ -1,5 +1,6 @@
 import logging
 import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 import boto3
 
@@ -12,22 +13,45 @@ logger = logging.getLogger(__name__)
 if not DEBUG:
     logging.getLogger("botocore").setLevel(logging.INFO)
 
+MAX_NUMBER_OF_MESSAGES = 10  # SQS maximum per receive_message and delete_message_batch call
+STATS_INTERVAL = 60  # seconds between queue depth and throughput logs
+
 
 class SqsListener:
 
     def __init__(self, queue_name, **kwargs):
         """
         :param queue_name: name of sqs queue
-        :param kwargs: settings for sqs listener, interval=10, region_name='us-east-1'
+        :param kwargs: settings for sqs listener, interval=10, region_name='us-east-1', wait_time=0,
+        workers=4 (messages handled at once), client=None (a boto3 sqs client, eg. for tests with moto)
         """
 
         self._queue_name = queue_name
         self._region_name = kwargs.get('region_name', 'us-east-1')
         self._poll_interval = kwargs.get('interval', 10) # by default poll messages every 10 sec
         self._wait_time = kwargs.get('wait_time', 0) #in seconds, wait_time=0 mean short polling
+        self._workers = kwargs.get('workers', 4)
         self.handler = lambda *args: None # empty handler
-
-        self._client = self._init_sqs_client()
+        # optional, replaces handler for batching handlers that acknowledge messages later:
+        # gets the whole message and returns the list of messages now saved, which are then deleted
+        self.message_handler = None
+        self.poll_handler = lambda: None # called after every poll, eg. to flush batched work, may also return saved messages
+
+        self.stats = {
+            'received': 0,
+            'handled': 0,
+            'failed': 0,
+            'deleted': 0,
+            'in_flight': 0,
+            'queue_depth': None,  # approximate number of visible messages, updated every STATS_INTERVAL
+            'messages_per_second': 0.0,
+        }
+        self._stats_time = time.time()
+        self._stats_handled = 0
+
+        self._client = kwargs.get('client') or self._init_sqs_client()
+        if kwargs.get('client'):
+            self._queue_url = self._get_queue_url(self._client)
 
     def _init_sqs_client(self):
         self._session = boto3.Session(
@@ -35,34 +59,111 @@ class SqsListener:
             aws_secret_access_key=AWS_OPTIONS['AWS_SECRET_ACCESS_KEY'],
         )
         sqs = self._session.client('sqs', region_name=self._region_name)
-        queues = sqs.list_queues(QueueNamePrefix=self._queue_name) # we filter to narrow down the list
-        self._queue_url = queues['QueueUrls'][0]
+        self._queue_url = self._get_queue_url(sqs)
         return sqs
 
-    def listen(self):
-        while True:
-            # short polling if WaitTimeSecconds=0 or not specified
-            # better use long polling
-            messages = self._client.receive_message(
-                QueueUrl=self._queue_url,
-                WaitTimeSeconds=self._wait_time,
+    def _get_queue_url(self, sqs):
+        queues = sqs.list_queues(QueueNamePrefix=self._queue_name) # we filter to narrow down the list
+        return queues['QueueUrls'][0]
+
+    def _handle(self, message):
+        # runs in a worker thread, exceptions are reported on the future
+        if self.message_handler is not None:
+            return self.message_handler(message) or []
+        self.handler(message['Body'])
+        return [message]
+
+    def _delete_messages(self, messages):
+        # acknowledge handled messages, up to 10 per call
+        for i in range(0, len(messages), MAX_NUMBER_OF_MESSAGES):
+            entries = [
+                {'Id': str(n), 'ReceiptHandle': message['ReceiptHandle']}
+                for n, message in enumerate(messages[i:i + MAX_NUMBER_OF_MESSAGES])
+            ]
+            response = self._client.delete_message_batch(QueueUrl=self._queue_url, Entries=entries)
+            self.stats['deleted'] += len(response.get('Successful', []))
+            for failed in response.get('Failed', []):
+                logger.error(f"Error deleting SQS message -> {failed}")
+
+    def _collect(self, done_futures, messages_by_future):
+        handled_messages = []
+        for future in done_futures:
+            message = messages_by_future.pop(future)
+            if future.exception() is None:
+                handled_messages.extend(future.result())
+                self.stats['handled'] += 1
+            else:
+                # not deleted, so the message becomes visible again after the visibility timeout
+                self.stats['failed'] += 1
+                logger.error(f"Error handling SQS message -> ReceiptHandle: {message['ReceiptHandle']}, "
+                             f"{future.exception()}")
+                logger.debug(f"MessageBody: {message['Body']}")
+        if handled_messages:
+            self._delete_messages(handled_messages)
+        self.stats['in_flight'] = len(messages_by_future)
+
+    def update_stats(self):
+        now = time.time()
+        if now - self._stats_time < STATS_INTERVAL:
+            return
+        self.stats['messages_per_second'] = (self.stats['handled'] - self._stats_handled) / (now - self._stats_time)
+        self._stats_time, self._stats_handled = now, self.stats['handled']
+        try:
+            attributes = self._client.get_queue_attributes(
+                QueueUrl=self._queue_url, AttributeNames=['ApproximateNumberOfMessages']
             )
-            if 'Messages' in messages:
-                logger.info(f"SQS messages received: {len(messages['Messages'])}")
-
-                for message in messages['Messages']:
-                    receipt_handle = message['ReceiptHandle']
+            self.stats['queue_depth'] = int(attributes['Attributes']['ApproximateNumberOfMessages'])
+        except Exception as e:
+            logger.debug(f"SQS queue depth unavailable: {e}")
+        logger.info(f"SQS listener stats: {self.stats}")
 
-                    self._client.delete_message(
+    def listen(self, max_polls: int = None):
+        """
+        receive up to 10 messages per poll and handle them in a pool of worker threads
+        a message is deleted from the queue only after its handler succeeds,
+        or with a message_handler, once the handler or poll_handler returns it as saved
+        :param max_polls: stop after this many polls (for tests), default listens forever
+        """
+        messages_by_future = {}
+        polls = 0
+
+        with ThreadPoolExecutor(max_workers=self._workers) as executor:
+            while max_polls is None or polls < max_polls:
+                # receive full batches of 10 while a worker is free, messages beyond the free workers
+                # wait in the executor's queue, the rest stays in the queue for other listeners
+                free_workers = self._workers - len(messages_by_future)
+                if free_workers > 0:
+                    # short polling if WaitTimeSecconds=0 or not specified
+                    # better use long polling
+                    messages = self._client.receive_message(
                         QueueUrl=self._queue_url,
-                        ReceiptHandle=receipt_handle
-                    )
-
-                    try:
-                        self.handler(message['Body'])
-                    except Exception:
-                        logger.error(f"Error handling SQS message -> ReceiptHandle: {receipt_handle}")
-                        logger.debug(f"MessageBody: {message['Body']}")
-
-            else:
-                time.sleep(self._poll_interval)
+                        WaitTimeSeconds=self._wait_time if not messages_by_future else 0,
+                        MaxNumberOfMessages=MAX_NUMBER_OF_MESSAGES,
+                    ).get('Messages', [])
+                    polls += 1
+
+                    if messages:
+                        logger.info(f"SQS messages received: {len(messages)}")
+                        self.stats['received'] += len(messages)
+                        for message in messages:
+                            messages_by_future[executor.submit(self._handle, message)] = message
+                    elif not messages_by_future:
+                        time.sleep(self._poll_interval)
+
+                if messages_by_future:
+                    done, _ = wait(list(messages_by_future), timeout=0 if free_workers > 0 else None,
+                                   return_when=FIRST_COMPLETED)
+                    self._collect(done, messages_by_future)
+
+                try:
+                    saved_messages = self.poll_handler()
+                    if saved_messages:
+                        self._delete_messages(saved_messages)
+                except Exception as e:
+                    logger.error(f"Error in SQS poll handler -> {e}")
+                self.update_stats()
+
+            # finish and acknowledge messages already received
+            if messages_by_future:
+                done, _ = wait(list(messages_by_future))
+                self._collect(done, messages_by_future)
@@ -8,9 +8,12 @@ import ast
 # import io
 import time
 import sys
+from itertools import islice
 
 # import pandas as pd
 from django.core.management.base import BaseCommand
+from django.db import connection
+from apps.common.utilities.multithreading import run_all_in_executor
 from apps.indicator.models.price_history import PriceHistory
 
 #from apps.channel.helpers import source_code_from_name, counter_currency_code_from_name
@@ -21,6 +24,10 @@ from settings import BASE_DIR, COUNTER_CURRENCY_CHOICES, COUNTER_CURRENCIES, SOU
 
 
 csv.field_size_limit(sys.maxsize)
+
+ROWS_PER_CHUNK = 100  # rows saved by a pool thread before it closes its db connection
+
+
 class Command(BaseCommand):
     help = 'Import historical pricess from ExchangeData model (from Core and Data App) stored in csv file.'
 
@@ -45,52 +52,76 @@ def read_from_data_channel_exchange_data_all():
     iter_rows = iter(getrow(filename))
     print(f"Columns:{next(iter_rows)}")  # Skipping the column names
 
-    for idx, row in enumerate(iter_rows):
-        (_, source_text, data, timestamp_str) = row # timestamp in itf format
-        row_timestamp = float(timestamp_str) # timestamp in itf format
-
-        source = get_source_code_from_exchange(source_text)
-        data_dict = json.loads(data)
-
-        prices = []
-        i = 0
-        for key, value in data_dict.items():
-            try:
-                transaction_currency, counter_currency = key.split("/")
-            except:
-                print(f"Skipped malformed coin: {key}")
-                continue # skip malformed pairs
-            if len(transaction_currency) > 6: # skip long coins
-                print(f">>> Skipped long coin: {transaction_currency}")
-                continue
-            #print(f">>>> counter_cur: {counter_currency}")
-            counter_currency_code = next((code for code, cc_text in COUNTER_CURRENCY_CHOICES if counter_currency == cc_text), None)
-            if counter_currency_code is None:
-                print(f">>>>Skip non-supported counter_cur: {counter_currency}")
-                continue
-
-            print(f"{idx}: {source} {key} {value['timestamp']/1000}")
-
-            #import pdb; pdb.set_trace()
-
-            price = PriceHistory(
-                timestamp=datetime.datetime.utcfromtimestamp(float(value['timestamp'])/1000),
-                source=source,
-                transaction_currency=transaction_currency,
-                counter_currency=counter_currency_code,
-                close=to_satoshi(value['close']),
-                open_p=to_satoshi(value['open']),
-                high=to_satoshi(value['high']),
-                low=to_satoshi(value['low']),
-                volume=get_volume(value['baseVolume']),
-            )
-            prices.append(price)
-            #print(price.__dict__)
-            i += 1
-            #break
+    # each row is one bulk_create, run chunks of rows at once on the shared thread pool
+    run_all_in_executor(save_rows, (
+        (save_data_channel_exchange_data_row, indexed_rows)
+        for indexed_rows in iter_chunks(enumerate(iter_rows), ROWS_PER_CHUNK)
+    ), backend="thread", ordered=False)
+
+
+def save_data_channel_exchange_data_row(indexed_row):
+    (idx, row) = indexed_row
+    (_, source_text, data, timestamp_str) = row # timestamp in itf format
+    row_timestamp = float(timestamp_str) # timestamp in itf format
+
+    source = get_source_code_from_exchange(source_text)
+    data_dict = json.loads(data)
+
+    prices = []
+    i = 0
+    for key, value in data_dict.items():
+        try:
+            transaction_currency, counter_currency = key.split("/")
+        except:
+            print(f"Skipped malformed coin: {key}")
+            continue # skip malformed pairs
+        if len(transaction_currency) > 6: # skip long coins
+            print(f">>> Skipped long coin: {transaction_currency}")
+            continue
+        #print(f">>>> counter_cur: {counter_currency}")
+        counter_currency_code = next((code for code, cc_text in COUNTER_CURRENCY_CHOICES if counter_currency == cc_text), None)
+        if counter_currency_code is None:
+            print(f">>>>Skip non-supported counter_cur: {counter_currency}")
+            continue
+
+        print(f"{idx}: {source} {key} {value['timestamp']/1000}")
+
+        #import pdb; pdb.set_trace()
+
+        price = PriceHistory(
+            timestamp=datetime.datetime.utcfromtimestamp(float(value['timestamp'])/1000),
+            source=source,
+            transaction_currency=transaction_currency,
+            counter_currency=counter_currency_code,
+            close=to_satoshi(value['close']),
+            open_p=to_satoshi(value['open']),
+            high=to_satoshi(value['high']),
+            low=to_satoshi(value['low']),
+            volume=get_volume(value['baseVolume']),
+        )
+        prices.append(price)
+        #print(price.__dict__)
+        i += 1
         #break
-        PriceHistory.objects.bulk_create(prices)
-        print(f"Saved coins batch ({i}) from: {source} at {row_timestamp}")
+    #break
+    PriceHistory.objects.bulk_create(prices)
+    print(f"Saved coins batch ({i}) from: {source} at {row_timestamp}")
+
+def save_rows(params):
+    # runs in a pool thread, close its db connection after the chunk so pool threads don't keep one open each
+    (save_row, indexed_rows) = params
+    try:
+        for indexed_row in indexed_rows:
+            save_row(indexed_row)
+    finally:
+        connection.close()
+
+def iter_chunks(iterable, size):
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, size))
 
 def get_source_code_from_exchange(exchange):
     "return 0 for poloniex"
@@ -103,34 +134,43 @@ def read_from_core_channel_exchange_data_poloniex():
 
     iter_rows = iter(getrow(filename))
     print(f"Columns:{next(iter_rows)}")  # Skipping the column names
-    for idx, row in enumerate(iter_rows):
-        (_, source, data, timestamp_str) = row # timestamp in itf format
-        timestamp = float(timestamp_str) # timestamp in itf format
-        data_dict = ast.literal_eval(data)
-
-        prices = []
-        i = 0
-        for key, value in data_dict.items():
-            counter_currency, transaction_currency = key.split("_") # it switched for raw poloniex
-            counter_currency_code = next(code for code, cc_text in COUNTER_CURRENCY_CHOICES if counter_currency == cc_text)
-            print(f"{idx} - {key} - {timestamp}")
-
-            price = PriceHistory(
-                timestamp=datetime.datetime.utcfromtimestamp(timestamp),
-                source=source,
-                transaction_currency=transaction_currency,
-                counter_currency=counter_currency_code,
-                close=to_satoshi(float(value['last'])),
-                volume=get_volume(value['quoteVolume']), # because trading pair is switched, we need quoteVolume, not basevolume
-            )
-            prices.append(price)
-            print(price.__dict__)
-            #return
-            i += 1
-            #break
+
+    # each row is one bulk_create, run chunks of rows at once on the shared thread pool
+    run_all_in_executor(save_rows, (
+        (save_core_channel_exchange_data_row, indexed_rows)
+        for indexed_rows in iter_chunks(enumerate(iter_rows), ROWS_PER_CHUNK)
+    ), backend="thread", ordered=False)
+
+
+def save_core_channel_exchange_data_row(indexed_row):
+    (idx, row) = indexed_row
+    (_, source, data, timestamp_str) = row # timestamp in itf format
+    timestamp = float(timestamp_str) # timestamp in itf format
+    data_dict = ast.literal_eval(data)
+
+    prices = []
+    i = 0
+    for key, value in data_dict.items():
+        counter_currency, transaction_currency = key.split("_") # it switched for raw poloniex
+        counter_currency_code = next(code for code, cc_text in COUNTER_CURRENCY_CHOICES if counter_currency == cc_text)
+        print(f"{idx} - {key} - {timestamp}")
+
+        price = PriceHistory(
+            timestamp=datetime.datetime.utcfromtimestamp(timestamp),
+            source=source,
+            transaction_currency=transaction_currency,
+            counter_currency=counter_currency_code,
+            close=to_satoshi(float(value['last'])),
+            volume=get_volume(value['quoteVolume']), # because trading pair is switched, we need quoteVolume, not basevolume
+        )
+        prices.append(price)
+        print(price.__dict__)
+        #return
+        i += 1
         #break
-        PriceHistory.objects.bulk_create(prices)
-        print(f"Saved coins batch ({i}) from: {source} at {timestamp}")
+    #break
+    PriceHistory.objects.bulk_create(prices)
+    print(f"Saved coins batch ({i}) from: {source} at {timestamp}")
 
 # csv iterator
 def getrow(filename):
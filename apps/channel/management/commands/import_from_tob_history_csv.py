@@ -1,20 +1,16 @@
 import logging
 import time
-import csv
-import datetime
 import os
 
 import os.path
 import boto3
 
-import pandas as pd
-
 from django.core.management.base import BaseCommand
-from django.db import transaction
 
-from apps.indicator.models.price_history import PriceHistory
+from apps.channel.price_history_import import import_csv_file, load_manifest, IMPORT_CHUNK_SIZE
+from apps.common.utilities.multithreading import run_all_in_executor
 
-from settings import AWS_OPTIONS, SOURCE_CHOICES, COUNTER_CURRENCY_CHOICES
+from settings import AWS_OPTIONS, COUNTER_CURRENCY_CHOICES
 
 
 logger = logging.getLogger(__name__)
@@ -29,31 +25,66 @@ EXCHANGE = 'binance'
 # for binance:
 IMPORT_FILES = ['binance-ADA-BNB.csv', 'binance-ADA-BTC.csv', 'binance-ADA-ETH.csv', 'binance-ADA-USDT.csv', 'binance-ADX-BNB.csv', 'binance-ADX-BTC.csv', 'binance-ADX-ETH.csv', 'binance-AE-BNB.csv', 'binance-AE-BTC.csv', 'binance-AE-ETH.csv', 'binance-AION-BNB.csv', 'binance-AION-BTC.csv', 'binance-AION-ETH.csv', 'binance-AMB-BNB.csv', 'binance-AMB-BTC.csv', 'binance-AMB-ETH.csv', 'binance-APPC-BNB.csv', 'binance-APPC-BTC.csv', 'binance-APPC-ETH.csv', 'binance-ARK-BTC.csv', 'binance-ARK-ETH.csv', 'binance-ARN-BTC.csv', 'binance-ARN-ETH.csv', 'binance-AST-BTC.csv', 'binance-AST-ETH.csv', 'binance-BAT-BNB.csv', 'binance-BAT-BTC.csv', 'binance-BAT-ETH.csv', 'binance-BCD-BTC.csv', 'binance-BCD-ETH.csv', 'binance-BCH-BNB.csv', 'binance-BCH-BTC.csv', 'binance-BCH-ETH.csv', 'binance-BCH-USDT.csv', 'binance-BCPT-BNB.csv', 'binance-BCPT-BTC.csv', 'binance-BCPT-ETH.csv', 'binance-BLZ-BNB.csv', 'binance-BLZ-BTC.csv', 'binance-BLZ-ETH.csv', 'binance-BNB-BTC.csv', 'binance-BNB-ETH.csv', 'binance-BNB-USDT.csv', 'binance-BNT-BTC.csv', 'binance-BNT-ETH.csv', 'binance-BQX-BTC.csv', 'binance-BQX-ETH.csv', 'binance-BRD-BNB.csv', 'binance-BRD-BTC.csv', 'binance-BRD-ETH.csv', 'binance-BTC-USDT.csv', 'binance-BTG-BTC.csv', 'binance-BTG-ETH.csv', 'binance-BTS-BNB.csv', 'binance-BTS-BTC.csv', 'binance-BTS-ETH.csv', 'binance-CDT-BTC.csv', 'binance-CDT-ETH.csv', 'binance-CHAT-BTC.csv', 'binance-CHAT-ETH.csv', 'binance-CLOAK-BTC.csv', 'binance-CLOAK-ETH.csv', 'binance-CMT-BNB.csv', 'binance-CMT-BTC.csv', 'binance-CMT-ETH.csv', 'binance-CND-BNB.csv', 'binance-CND-BTC.csv', 'binance-CND-ETH.csv', 'binance-DASH-BTC.csv', 'binance-DASH-ETH.csv', 'binance-DGD-BTC.csv', 'binance-DGD-ETH.csv', 'binance-DLT-BNB.csv', 'binance-DLT-BTC.csv', 'binance-DLT-ETH.csv', 'binance-DNT-BTC.csv', 'binance-DNT-ETH.csv', 'binance-EDO-BTC.csv', 'binance-EDO-ETH.csv', 'binance-ELF-BTC.csv', 'binance-ELF-ETH.csv', 'binance-ENG-BTC.csv', 'binance-ENG-ETH.csv', 'binance-ENJ-BTC.csv', 'binance-ENJ-ETH.csv', 'binance-EOS-BTC.csv', 'binance-EOS-ETH.csv', 'binance-ETC-BTC.csv', 'binance-ETC-ETH.csv', 'binance-ETH-BTC.csv', 'binance-ETH-USDT.csv', 'binance-EVX-BTC.csv', 'binance-EVX-ETH.csv', 'binance-FUEL-BTC.csv', 'binance-FUEL-ETH.csv', 'binance-FUN-BTC.csv', 'binance-FUN-ETH.csv', 'binance-GAS-BTC.csv', 'binance-GNT-BNB.csv', 'binance-GNT-BTC.csv', 'binance-GNT-ETH.csv', 'binance-GRS-BTC.csv', 'binance-GRS-ETH.csv', 'binance-GTO-BNB.csv', 'binance-GTO-BTC.csv', 'binance-GTO-ETH.csv', 'binance-GVT-BTC.csv', 'binance-GVT-ETH.csv', 'binance-GXS-BTC.csv', 'binance-GXS-ETH.csv', 'binance-HSR-BTC.csv', 'binance-HSR-ETH.csv', 'binance-ICN-BTC.csv', 'binance-ICN-ETH.csv', 'binance-ICX-BNB.csv', 'binance-ICX-BTC.csv', 'binance-ICX-ETH.csv', 'binance-INS-BTC.csv', 'binance-INS-ETH.csv', 'binance-IOST-BTC.csv', 'binance-IOST-ETH.csv', 'binance-IOTA-BNB.csv', 'binance-IOTA-BTC.csv', 'binance-IOTA-ETH.csv', 'binance-KMD-BTC.csv', 'binance-KMD-ETH.csv', 'binance-KNC-BTC.csv', 'binance-KNC-ETH.csv', 'binance-LEND-BTC.csv', 'binance-LEND-ETH.csv', 'binance-LINK-BTC.csv', 'binance-LINK-ETH.csv', 'binance-LOOM-BNB.csv', 'binance-LOOM-BTC.csv', 'binance-LOOM-ETH.csv', 'binance-LRC-BTC.csv', 'binance-LRC-ETH.csv', 'binance-LSK-BNB.csv', 'binance-LSK-BTC.csv', 'binance-LSK-ETH.csv', 'binance-LTC-BNB.csv', 'binance-LTC-BTC.csv', 'binance-LTC-ETH.csv', 'binance-LTC-USDT.csv', 'binance-LUN-BTC.csv', 'binance-LUN-ETH.csv', 'binance-MANA-BTC.csv', 'binance-MANA-ETH.csv', 'binance-MCO-BNB.csv', 'binance-MCO-BTC.csv', 'binance-MCO-ETH.csv', 'binance-MDA-BTC.csv', 'binance-MDA-ETH.csv', 'binance-MOD-BTC.csv', 'binance-MOD-ETH.csv', 'binance-MTH-BTC.csv', 'binance-MTH-ETH.csv', 'binance-MTL-BTC.csv', 'binance-MTL-ETH.csv', 'binance-NAV-BNB.csv', 'binance-NAV-BTC.csv', 'binance-NAV-ETH.csv', 'binance-NCASH-BNB.csv', 'binance-NCASH-BTC.csv', 'binance-NCASH-ETH.csv', 'binance-NEBL-BNB.csv', 'binance-NEBL-BTC.csv', 'binance-NEBL-ETH.csv', 'binance-NEO-BNB.csv', 'binance-NEO-BTC.csv', 'binance-NEO-ETH.csv', 'binance-NEO-USDT.csv', 'binance-NULS-BNB.csv', 'binance-NULS-BTC.csv', 'binance-NULS-ETH.csv', 'binance-OAX-BTC.csv', 'binance-OAX-ETH.csv', 'binance-OMG-BTC.csv', 'binance-OMG-ETH.csv', 'binance-ONT-BNB.csv', 'binance-ONT-BTC.csv', 'binance-ONT-ETH.csv', 'binance-OST-BNB.csv', 'binance-OST-BTC.csv', 'binance-OST-ETH.csv', 'binance-PIVX-BNB.csv', 'binance-PIVX-BTC.csv', 'binance-PIVX-ETH.csv', 'binance-POA-BNB.csv', 'binance-POA-BTC.csv', 'binance-POA-ETH.csv', 'binance-POE-BTC.csv', 'binance-POE-ETH.csv', 'binance-POWR-BNB.csv', 'binance-POWR-BTC.csv', 'binance-POWR-ETH.csv', 'binance-PPT-BTC.csv', 'binance-PPT-ETH.csv', 'binance-QLC-BNB.csv', 'binance-QLC-BTC.csv', 'binance-QLC-ETH.csv', 'binance-QSP-BNB.csv', 'binance-QSP-BTC.csv', 'binance-QSP-ETH.csv', 'binance-QTUM-BNB.csv', 'binance-QTUM-BTC.csv', 'binance-QTUM-ETH.csv', 'binance-QTUM-USDT.csv', 'binance-RCN-BNB.csv', 'binance-RCN-BTC.csv', 'binance-RCN-ETH.csv', 'binance-RDN-BNB.csv', 'binance-RDN-BTC.csv', 'binance-RDN-ETH.csv', 'binance-REQ-BTC.csv', 'binance-REQ-ETH.csv', 'binance-RLC-BNB.csv', 'binance-RLC-BTC.csv', 'binance-RLC-ETH.csv', 'binance-RPX-BNB.csv', 'binance-RPX-BTC.csv', 'binance-RPX-ETH.csv', 'binance-SALT-BTC.csv', 'binance-SALT-ETH.csv', 'binance-SNGLS-BTC.csv', 'binance-SNGLS-ETH.csv', 'binance-SNM-BTC.csv', 'binance-SNM-ETH.csv', 'binance-SNT-BTC.csv', 'binance-SNT-ETH.csv', 'binance-STEEM-BNB.csv', 'binance-STEEM-BTC.csv', 'binance-STEEM-ETH.csv', 'binance-STORJ-BTC.csv', 'binance-STORJ-ETH.csv', 'binance-STORM-BNB.csv', 'binance-STORM-BTC.csv', 'binance-STORM-ETH.csv', 'binance-STRAT-BTC.csv', 'binance-STRAT-ETH.csv', 'binance-SUB-BTC.csv', 'binance-SUB-ETH.csv', 'binance-SYS-BNB.csv', 'binance-SYS-BTC.csv', 'binance-SYS-ETH.csv', 'binance-TNB-BTC.csv', 'binance-TNB-ETH.csv', 'binance-TNT-BTC.csv', 'binance-TNT-ETH.csv', 'binance-TRIG-BNB.csv', 'binance-TRIG-BTC.csv', 'binance-TRIG-ETH.csv', 'binance-TRX-BTC.csv', 'binance-TRX-ETH.csv', 'binance-VEN-BNB.csv', 'binance-VEN-BTC.csv', 'binance-VEN-ETH.csv', 'binance-VIA-BNB.csv', 'binance-VIA-BTC.csv', 'binance-VIA-ETH.csv', 'binance-VIB-BTC.csv', 'binance-VIB-ETH.csv', 'binance-VIBE-BTC.csv', 'binance-VIBE-ETH.csv', 'binance-WABI-BNB.csv', 'binance-WABI-BTC.csv', 'binance-WABI-ETH.csv', 'binance-WAN-BNB.csv', 'binance-WAN-BTC.csv', 'binance-WAN-ETH.csv', 'binance-WAVES-BNB.csv', 'binance-WAVES-BTC.csv', 'binance-WAVES-ETH.csv', 'binance-WINGS-BTC.csv', 'binance-WINGS-ETH.csv', 'binance-WPR-BTC.csv', 'binance-WPR-ETH.csv', 'binance-WTC-BNB.csv', 'binance-WTC-BTC.csv', 'binance-WTC-ETH.csv', 'binance-XEM-BNB.csv', 'binance-XEM-BTC.csv', 'binance-XEM-ETH.csv', 'binance-XLM-BNB.csv', 'binance-XLM-BTC.csv', 'binance-XLM-ETH.csv', 'binance-XMR-BTC.csv', 'binance-XMR-ETH.csv', 'binance-XRB-BNB.csv', 'binance-XRB-BTC.csv', 'binance-XRB-ETH.csv', 'binance-XRP-BTC.csv', 'binance-XRP-ETH.csv', 'binance-XRP-USDT.csv', 'binance-XVG-BTC.csv', 'binance-XVG-ETH.csv', 'binance-XZC-BNB.csv', 'binance-XZC-BTC.csv', 'binance-XZC-ETH.csv', 'binance-YOYOW-BNB.csv', 'binance-YOYOW-BTC.csv', 'binance-YOYOW-ETH.csv', 'binance-ZEC-BTC.csv', 'binance-ZEC-ETH.csv', 'binance-ZIL-BNB.csv', 'binance-ZIL-BTC.csv', 'binance-ZIL-ETH.csv', 'binance-ZRX-BTC.csv', 'binance-ZRX-ETH.csv']
 
-ALREADY_IMPORTED = []
 TO_TIMESTAMP = 1523015897.999 # Skip entries older that this
+MANIFEST_FILE = 'price_history_import_manifest.jsonl'
 
 
 class Command(BaseCommand):
     help = "Load data from csv to pricehistory"
 
+    def add_arguments(self, parser):
+        parser.add_argument('files', nargs='*', type=str,
+                            help='local csv files like binance-ADA-BTC.csv, default downloads IMPORT_FILES from S3')
+        parser.add_argument('--dir', type=str, default=None, help='import all csv files in this local directory')
+        parser.add_argument('--bucket', type=str, default='intelligenttrading-historical-dump')
+        parser.add_argument('--manifest', type=str, default=MANIFEST_FILE,
+                            help='progress of each file, an interrupted import continues from here')
+        parser.add_argument('--processes', type=int, default=None, help='files imported at once, default one per cpu')
+        parser.add_argument('--chunksize', type=int, default=IMPORT_CHUNK_SIZE, help='csv rows per COPY')
+
     def handle(self, *args, **options):
-        bucket = 'intelligenttrading-historical-dump'
         exchange = EXCHANGE
         print(f"> Getting ready to load csv for {exchange}")
         start = time.time()
 
-        #for file_name in get_matching_s3_keys(bucket=bucket, prefix=f"{exchange}-"):
-        for file_no, file_name in enumerate(IMPORT_FILES):
-            if skip_this_file(file_name):
-                print(f"> Skip: {file_name}")
+        if options['dir']:
+            file_paths = [os.path.join(options['dir'], file_name)
+                          for file_name in sorted(os.listdir(options['dir'])) if file_name.endswith(".csv")]
+            bucket = None
+        elif options['files']:
+            file_paths, bucket = options['files'], None
+        else:
+            #for file_name in get_matching_s3_keys(bucket=bucket, prefix=f"{exchange}-"):
+            file_paths, bucket = IMPORT_FILES, options['bucket']
+
+        manifest = load_manifest(options['manifest'])
+        import_params = []
+        for file_no, file_path in enumerate(file_paths):
+            if skip_this_file(os.path.basename(file_path), manifest):
+                print(f"> Skip: {file_path}")
                 continue
             else:
-                print(f"\n{file_no}> Importing: {file_name}")
-                create_file_from_S3_Bucket(bucket, file_name)
-                import_historical_prices_from_csv(file_name=file_name, from_timestamp=None, to_timestamp=TO_TIMESTAMP, do_not_write=False)
-                os.remove(file_name)
+                import_params.append((bucket, file_no, file_path, options['manifest'], options['chunksize']))
+
+        # parsing and converting the csv files is cpu bound, import several files at once
+        timings = []
+        rows_copied = run_all_in_executor(import_file, import_params, backend="process",
+                                          max_workers=options['processes'], ordered=False, timings=timings)
 
-        print(f"Exec time {time.time() - start} seconds")
+        print(f"{sum(rows_copied)} rows imported from {len(import_params)} files. "
+              f"Exec time {time.time() - start} seconds, slowest file {max(timings or [0])} seconds")
+
+
+def import_file(import_params) -> int:
+    (bucket, file_no, file_path, manifest_path, chunksize) = import_params
+    print(f"\n{file_no}> Importing: {file_path}")
+    if bucket is not None:
+        create_file_from_S3_Bucket(bucket, file_path)
+    try:
+        return import_csv_file(file_path, manifest_path, to_timestamp=TO_TIMESTAMP, chunksize=chunksize)
+    finally:
+        if bucket is not None:
+            os.remove(file_path)
 
 
 def aws_resource(resource_type):
@@ -82,52 +113,6 @@ def create_file_from_S3_Bucket(bucket_name, file_name):
 
 
 
-def import_historical_prices_from_csv(file_name, from_timestamp=None, to_timestamp=None, do_not_write=False):
-    # from_timestamp (and to_) in ms, like 1483239900000, not inclusive
-    #poloniex-BTC-USDT.csv -> 0 BTC 2
-    (source_txt, transaction_currency, cc_txt) = os.path.splitext(file_name)[0].split("-")
-    source = next((code for code, source_text in SOURCE_CHOICES if source_text == source_txt), None)
-    counter_currency = next((code for code, cc_text in COUNTER_CURRENCY_CHOICES if cc_text == cc_txt), None)
-    print(f"> Importing {file_name}: source: {source}, transaction_currency: {transaction_currency}, counter_currency: {counter_currency}")
-
-    for chunk_df in pd.read_csv(file_name, names=["timestamp", "open", "high", "low", "close", "volume"], float_precision='round_trip', chunksize=500):
-        prices = []
-        for item in chunk_df.itertuples():
-            (index, timestamp, openp, high, low, close, volume) = item
-            #import pdb; pdb.set_trace()
-            if from_timestamp and int(timestamp) <= int(from_timestamp)*1000:
-                #print(f"skipping f: {timestamp})")
-                print('f', end='')
-                continue # skip items older than from_timestamp
-            elif to_timestamp and int(timestamp) > int(to_timestamp)*1000:
-                #print(f"skipping t: {timestamp})")
-                print('t', end='')
-                continue # skip items older than from_timestamp
-            if do_not_write:
-                pass
-                #print(f"Sim DB write>t_cur:{transaction_currency},c_cur:{counter_currency},source:{source},timestamp:{datetime.datetime.utcfromtimestamp(float(timestamp)/1000.0)},ohlcv:{(openp, high, low, close, volume)}, tmstmpt:{timestamp}")
-            price = PriceHistory(
-                timestamp=datetime.datetime.utcfromtimestamp(float(timestamp)/1000.0),
-                source=source,
-                transaction_currency=transaction_currency,
-                counter_currency=counter_currency,
-                open_p=to_satoshi(openp),
-                high=to_satoshi(high),
-                low=to_satoshi(low),
-                close=to_satoshi(close),
-            )
-            # if do_not_write:
-            #     print(f"Price: {price.__dict__}")
-            prices.append(price)
-            print('.', end='')
-        print('*', end='')
-        if do_not_write:
-            pass
-#            print(f"Prices: {prices}")
-        else:
-            PriceHistory.objects.bulk_create(prices)
-    print('')
-
 def get_matching_s3_keys(bucket, prefix='', suffix=''):
     s3 = aws_client('s3')
     kwargs = {'Bucket': bucket}
@@ -157,9 +142,9 @@ def get_matching_s3_keys(bucket, prefix='', suffix=''):
 
 
 
-def skip_this_file(file_name):
+def skip_this_file(file_name, manifest):
     # we already imported this
-    if file_name in ALREADY_IMPORTED:
+    if manifest.get(file_name, {}).get("done"):
         print(f"> {file_name} already imported")
         return True
     (source_txt, transaction_currency, cc_txt) = os.path.splitext(file_name)[0].split("-")
@@ -171,11 +156,4 @@ def skip_this_file(file_name):
     else:
         return False
 
-
-def to_satoshi(value):
-    try:
-        return int(float(value) * 10 ** 8)
-    except:
-        return None
-
 # data was collected with ccxts fetch_ohlcv method
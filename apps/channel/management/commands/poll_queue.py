@@ -1,29 +1,59 @@
 import json
 import logging
 import datetime
+import time
+from concurrent.futures import wait
+from threading import Lock
 
 from django.core.management.base import BaseCommand
-from django.db import IntegrityError
 
+from apps.TA.storages.utils.pv_resampling import save_pv_histories_to_redis
 from apps.channel.incoming_queue import SqsListener
+from apps.channel.price_history_import import copy_to_price_history, get_copy_frame_from_objects
+from apps.common.utilities.multithreading import get_executor
 from apps.indicator.models import Price, Volume, PriceHistory
 
 from taskapp.helpers.common import get_source_name
 
 from settings import INCOMING_SQS_QUEUE, SOURCE_CHOICES, COUNTER_CURRENCY_CHOICES
-
+from settings.redis_db import database
 
 
 logger = logging.getLogger(__name__)
 
+SOURCE_CODES = {source_text: code for code, source_text in SOURCE_CHOICES}
+COUNTER_CURRENCY_CODES = {counter_currency: code for code, counter_currency in COUNTER_CURRENCY_CHOICES}
+
+INGEST_BATCH_ROWS = 5000  # flush when this many rows are waiting
+INGEST_BATCH_SECONDS = 10  # or when the oldest waiting message is this old, well below the SQS visibility timeout
+BULK_CREATE_BATCH_SIZE = 1000  # rows per INSERT statement
+MAX_BACKGROUND_SAVES = 4  # batches waiting to be saved in the background before a flush waits for the oldest
+
+
 class Command(BaseCommand):
     help = "Polls price data from the incoming queue"
 
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-messages', type=int, default=None,
+                            help='number of queue messages saved together, default saves each message on its own, '
+                                 'or batches by rows and time with --redis')
+        parser.add_argument('--redis', action='store_true', default=False,
+                            help='dual write: save ohlc_prices to redis for TA first, and to the db in the background')
+        parser.add_argument('--workers', type=int, default=4,
+                            help='number of queue messages handled at once')
+
     def handle(self, *args, **options):
         logger.info("Getting ready to poll prices from the queue")
 
-        listener = SqsListener(INCOMING_SQS_QUEUE, wait_time=10)
-        listener.handler = process_message_from_queue
+        if options['redis']:
+            ingestion_batch = IngestionBatch(max_messages=options['batch_messages'] or INGEST_BATCH_ROWS,
+                                             save_to_redis=True, async_flush=True)
+        else:
+            ingestion_batch = IngestionBatch(max_messages=options['batch_messages'] or 1)
+
+        listener = SqsListener(INCOMING_SQS_QUEUE, wait_time=10, workers=options['workers'])
+        listener.message_handler = ingestion_batch.add_message  # messages are deleted once their batch is saved
+        listener.poll_handler = ingestion_batch.flush_if_due  # flush on time even when no messages arrive
         listener.listen()
 
 
@@ -37,62 +67,50 @@ class Command(BaseCommand):
 #     }, ...
 # ]
 
-def process_message_from_queue(message_body):
-    "Save SQS message to DB: Price, Volume and PriceHistory"
-
+def get_rows_from_message(message_body) -> tuple:
+    """
+    parse an SQS message into unsaved Price, Volume and PriceHistory objects
+    :return: (subject, source_code, list of model objects)
+    """
     body_dict = json.loads(message_body)
     subject = body_dict['Subject']
     items = json.loads(body_dict['Message'])
 
-    #processed = []
+    rows = []
+    source_code = None
 
     for item in items:
         # logger.debug(f"Save {item['category']} for {item['symbol']} from {item['source']}")
 
-        source_code = next((code for code, source_text in SOURCE_CHOICES if source_text == item['source']), None)
+        source_code = SOURCE_CODES.get(item['source'])
 
         (transaction_currency, counter_curency_text) = item['symbol'].split('/')
 
-        counter_currency_code = next((code for code, counter_currency in COUNTER_CURRENCY_CHOICES if counter_currency == counter_curency_text), None)
+        counter_currency_code = COUNTER_CURRENCY_CODES.get(counter_curency_text)
         if None in (source_code, counter_currency_code):
             continue # skip this source or counter_currency
 
-        if subject == 'prices_volumes' and item['category'] == 'price':
-            try:
-                price = int(float(item['value']) * 10 ** 8) # convert to satoshi
-
-                Price.objects.create(
+        try:
+            if subject == 'prices_volumes' and item['category'] == 'price':
+                rows.append(Price(
                     source=source_code,
                     transaction_currency=transaction_currency,
                     counter_currency=counter_currency_code,
-                    price=price,
+                    price=int(float(item['value']) * 10 ** 8), # convert to satoshi
                     timestamp=item['timestamp']
-                )
-                #processed.append("{}/{}".format(transaction_currency, counter_currency_code))
-                # logger.debug(">>> Price saved: source={}, transaction_currency={}, counter_currency={}, price={}, timestamp={}".format(
-                #            source_code, transaction_currency, counter_currency_code, price, item['timestamp']))
-            except Exception as e:
-                logger.debug(f">>>> Error saving Price for {item['symbol']} from: {item['source']}. {e}")
-
-        elif subject == 'prices_volumes' and item['category'] == 'volume':
-            try:
-                volume = float(item['value'])
-
-                Volume.objects.create(
+                ))
+
+            elif subject == 'prices_volumes' and item['category'] == 'volume':
+                rows.append(Volume(
                     source=source_code,
                     transaction_currency=transaction_currency,
                     counter_currency=counter_currency_code,
-                    volume=volume,
+                    volume=float(item['value']),
                     timestamp=item['timestamp']
-                )
-                # logger.debug(">>> Volume saved: source={}, transaction_currency={}, counter_currency={}, volume={}, timestamp={}".format(
-                #            source_code, transaction_currency, counter_currency_code, volume, item['timestamp']))
-            except Exception as e:
-                logger.debug(f">>>> Error saving Volume for {item['symbol']} from: {item['source']}. {e}")
-
-        elif subject == 'ohlc_prices':
-            try:
-                PriceHistory.objects.create(
+                ))
+
+            elif subject == 'ohlc_prices':
+                rows.append(PriceHistory(
                     source=source_code,
                     transaction_currency=transaction_currency,
                     counter_currency=counter_currency_code,
@@ -102,18 +120,183 @@ def process_message_from_queue(message_body):
                     close=to_satoshi(item['close']),
                     timestamp=datetime.datetime.utcfromtimestamp(item['timestamp']),
                     volume=get_volume(item['bvolume'])
-                )
-            except IntegrityError as e:
-                pass
-                # logger.debug(f">>> Dublicated record for PriceHistory.\n{e}")
-            except Exception as e:
-                logger.debug(f">>>> Error saving PriceHistory for {item['symbol']} from: {item['source']}. {e}")
-            #logger.debug(f">>> OHLC history price saved. Source:{source_code}, {transaction_currency}_{counter_currency_code}")
-
-    #logger.debug("Message for {} saved to db. Coins: {}".format(get_source_name(source_code), ",".join(processed)))
+                ))
+        except Exception as e:
+            logger.debug(f">>>> Error parsing {subject} for {item['symbol']} from: {item['source']}. {e}")
+
+    return subject, source_code, rows
+
+
+def save_rows(rows: list):
+    """
+    save model objects with one bulk_create per model
+    PriceHistory is copied through a temporary table instead, like the csv import,
+    because ON CONFLICT on the partitioned parent table does not catch duplicates inserted by the partition trigger,
+    so PriceHistory rows already saved are skipped without failing the rest of the batch
+    """
+    rows_by_model = {}
+    for row in rows:
+        rows_by_model.setdefault(type(row), []).append(row)
+
+    errors = []
+    for model, model_rows in rows_by_model.items():
+        try:
+            if model is PriceHistory:
+                copy_to_price_history(get_copy_frame_from_objects(model_rows))
+            else:
+                model.objects.bulk_create(model_rows, batch_size=BULK_CREATE_BATCH_SIZE, ignore_conflicts=True)
+        except Exception as e:
+            logger.error(f">>>> Error saving {len(model_rows)} {model.__name__} rows. {e}")
+            errors.append(e)
+
+    if errors:
+        raise errors[0]  # after saving the other models, so the handler fails and the message is not acknowledged
+
+
+def save_rows_to_redis(rows: list) -> int:
+    """
+    save PriceHistory objects to PriceVolumeHistoryStorage in one pipeline
+    close prices near a 5min mark are published, so PriceStorage resamples and the indicators run right away
+    :return: number of redis commands executed
+    """
+    pipeline = database.pipeline(transaction=False)
+    for row in rows:
+        if isinstance(row, PriceHistory):
+            pipeline = save_pv_histories_to_redis(row, pipeline=pipeline)
+    if not len(pipeline):
+        return 0
+    try:
+        return len(pipeline.execute())
+    except Exception as e:
+        logger.error(f">>>> Error saving {len(rows)} rows to redis. {e}")
+        raise  # the message is not acknowledged and is received again
+
+
+def process_message_from_queue(message_body):
+    "Save SQS message to DB: Price, Volume and PriceHistory"
+
+    subject, source_code, rows = get_rows_from_message(message_body)
+    save_rows(rows)
+
     logger.info(f"Message for {get_source_name(source_code)} ({subject}) saved to db")
 
 
+class IngestionBatch:
+    """
+    collects rows from several queue messages and saves them together
+    flushes after max_messages messages, max_rows rows, or when the oldest message is max_seconds old
+    safe to share between the listener's worker threads
+    messages are returned from add_message() and flush_if_due() only once their rows are saved,
+    so the listener deletes them from the queue after the save, and a crash or failed save leaves them in the queue
+
+    in dual write mode (save_to_redis=True) ohlc_prices are first saved to redis for TA as each message arrives,
+    and batches are saved to the db in the background (async_flush=True) without holding up the next message,
+    their messages are returned by a later flush_if_due() once the background save succeeds
+    """
+
+    def __init__(self, max_messages: int = 1, max_rows: int = INGEST_BATCH_ROWS,
+                 max_seconds: float = INGEST_BATCH_SECONDS,
+                 save_to_redis: bool = False, async_flush: bool = False):
+        self.max_messages = max(max_messages, 1)
+        self.max_rows = max_rows
+        self.max_seconds = max_seconds
+        self.save_to_redis = save_to_redis
+        self.async_flush = async_flush
+        self.rows = []
+        self.messages = []
+        self.first_message_time = None
+        self._background_saves = []  # (future, messages) of batches saved in the background, oldest first
+        self._lock = Lock()
+
+    def add_message(self, message: dict) -> list:
+        """
+        :param message: SQS message, with the json in 'Body'
+        :return: list of the messages saved to the db, ready to be deleted from the queue
+        """
+        subject, source_code, rows = get_rows_from_message(message['Body'])
+
+        if self.save_to_redis and subject == 'ohlc_prices':
+            save_rows_to_redis(rows)
+
+        with self._lock:
+            if not self.messages:
+                self.first_message_time = time.time()
+            self.rows.extend(rows)
+            self.messages.append(message)
+        logger.debug(f"Message for {get_source_name(source_code)} ({subject}) added to batch")
+
+        return self.flush_if_due()
+
+    def is_due(self) -> bool:
+        with self._lock:
+            return bool(self.messages) and (
+                len(self.messages) >= self.max_messages or
+                len(self.rows) >= self.max_rows or
+                time.time() - self.first_message_time >= self.max_seconds
+            )
+
+    def flush_if_due(self) -> list:
+        saved_messages = self.flush() if self.is_due() else []
+        return saved_messages + self.collect_background_saves()
+
+    def flush(self) -> list:
+        """
+        :return: list of the messages saved to the db, empty when saving in the background
+        raises if the save fails, the messages are then not returned and are received again
+        """
+        # take the rows under the lock, save them without it so other workers can keep adding
+        with self._lock:
+            rows, self.rows = self.rows, []
+            messages, self.messages = self.messages, []
+            self.first_message_time = None
+        if not messages:
+            return []
+
+        if not self.async_flush:
+            self.save(rows, len(messages))
+            return messages
+
+        with self._lock:
+            oldest_future = self._background_saves[0][0] if len(self._background_saves) >= MAX_BACKGROUND_SAVES else None
+        if oldest_future is not None:
+            wait([oldest_future])  # the db is falling behind, hold up the listener instead of piling up batches
+
+        # one background thread, so batches reach the db in order and one at a time
+        future = get_executor("thread", max_workers=1).submit(self.save, rows, len(messages))
+        with self._lock:
+            self._background_saves.append((future, messages))
+        return []
+
+    def collect_background_saves(self, wait_all: bool = False) -> list:
+        """
+        :param wait_all: wait for all background saves to finish, eg. before stopping
+        :return: list of the messages of finished background saves that succeeded
+        messages of a failed save are not returned, so they are received again and saved again
+        """
+        if wait_all:
+            with self._lock:
+                futures = [future for future, messages in self._background_saves]
+            wait(futures)
+
+        finished = []
+        with self._lock:
+            while self._background_saves and self._background_saves[0][0].done():
+                finished.append(self._background_saves.pop(0))  # in order, so messages are acknowledged in order
+
+        saved_messages = []
+        for future, messages in finished:
+            if future.exception() is None:
+                saved_messages.extend(messages)
+            else:
+                logger.error(f">>>> Error saving {len(messages)} messages to db in the background, "
+                             f"they will be received again. {future.exception()}")
+        return saved_messages
+
+    def save(self, rows: list, messages_count: int):
+        save_rows(rows)
+        logger.info(f"{len(rows)} rows from {messages_count} messages saved to db")
+
+
 # Little helpers
 def to_satoshi(value):
     try:
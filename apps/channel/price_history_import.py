@@ -0,0 +1,175 @@
+"""
+bulk import of historical ohlcv csv files into PriceHistory
+
+files are named like "binance-ADA-BTC.csv" and have no header, one row per
+    timestamp (ms), open, high, low, close, volume
+as collected with ccxt fetch_ohlcv
+
+each file is read in chunks, converted with numpy and loaded with postgres COPY
+through a temporary table, so rows already in PriceHistory are skipped
+
+progress is appended to a manifest file, one json line per chunk, eg.
+    {"file": "binance-ADA-BTC.csv", "rows": 200000, "done": false}
+an interrupted import continues after the last row saved
+"""
+import io
+import json
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+from django.db import connection, transaction
+
+from apps.indicator.models.price_history import PriceHistory
+from settings import SOURCE_CHOICES, COUNTER_CURRENCY_CHOICES
+
+logger = logging.getLogger(__name__)
+
+CSV_COLUMNS = ["timestamp", "open", "high", "low", "close", "volume"]
+IMPORT_CHUNK_SIZE = 100000  # csv rows per COPY
+
+# (csv column, PriceHistory field) for prices converted to satoshi
+SATOSHI_COLUMNS = [("open", "open_p"), ("high", "high"), ("low", "low"), ("close", "close")]
+COPY_FIELDS = ["timestamp", "source", "transaction_currency", "counter_currency",
+               "open_p", "high", "low", "close", "volume"]
+UNIQUE_FIELDS = ["timestamp", "transaction_currency", "counter_currency", "source"]
+
+
+def parse_file_name(file_name: str) -> tuple:
+    """
+    :param file_name: eg. "binance-BTC-USDT.csv" or a path to it
+    :return: (source, transaction_currency, counter_currency) eg. (2, "BTC", 2), codes are None if unknown
+    """
+    (source_txt, transaction_currency, cc_txt) = os.path.splitext(os.path.basename(file_name))[0].split("-")
+    source = next((code for code, source_text in SOURCE_CHOICES if source_text == source_txt), None)
+    counter_currency = next((code for code, cc_text in COUNTER_CURRENCY_CHOICES if cc_text == cc_txt), None)
+    return source, transaction_currency, counter_currency
+
+
+def load_manifest(manifest_path: str) -> dict:
+    """
+    :return: dict of file name: latest progress record
+    """
+    manifest = {}
+    if not os.path.exists(manifest_path):
+        return manifest
+    with open(manifest_path) as manifest_file:
+        for line in manifest_file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue  # eg. a line cut short by a crash
+            manifest[record["file"]] = record
+    return manifest
+
+
+def append_to_manifest(manifest_path: str, file_name: str, rows: int, done: bool = False):
+    # one short write in append mode, so workers in several processes can share the file
+    line = json.dumps({"file": file_name, "rows": rows, "done": done}) + "\n"
+    with open(manifest_path, "a") as manifest_file:
+        manifest_file.write(line)
+
+
+def to_satoshi_array(values) -> np.ndarray:
+    # vectorized to_satoshi(), anything not a number becomes nan and is saved as null
+    return np.trunc(pd.to_numeric(values, errors="coerce").values * 10 ** 8)
+
+
+def get_copy_frame(chunk_df, source: int, transaction_currency: str, counter_currency: int):
+    """
+    :param chunk_df: DataFrame of CSV_COLUMNS
+    :return: DataFrame of COPY_FIELDS
+    """
+    copy_df = pd.DataFrame(index=chunk_df.index)
+    copy_df["timestamp"] = pd.to_datetime(chunk_df["timestamp"], unit="ms").dt.strftime("%Y-%m-%d %H:%M:%S.%f+00")
+    copy_df["source"] = source
+    copy_df["transaction_currency"] = transaction_currency
+    copy_df["counter_currency"] = counter_currency
+    for (column, field) in SATOSHI_COLUMNS:
+        copy_df[field] = to_satoshi_array(chunk_df[column])
+    copy_df["volume"] = pd.to_numeric(chunk_df["volume"], errors="coerce")
+    return copy_df[COPY_FIELDS]
+
+
+def get_copy_frame_from_objects(price_histories: list):
+    """
+    :param price_histories: unsaved PriceHistory objects
+    :return: DataFrame of COPY_FIELDS, as get_copy_frame()
+    """
+    copy_df = pd.DataFrame([[getattr(price_history, field) for field in COPY_FIELDS]
+                            for price_history in price_histories], columns=COPY_FIELDS)
+    copy_df["timestamp"] = pd.to_datetime(copy_df["timestamp"]).dt.strftime("%Y-%m-%d %H:%M:%S.%f+00")
+    return copy_df
+
+
+def copy_to_price_history(copy_df) -> int:
+    """
+    load rows with COPY FROM STDIN into a temporary table, then insert the ones not in PriceHistory yet
+    :return: number of rows copied
+    """
+    buffer = io.StringIO()
+    # %.17g keeps floats exact and writes whole numbers without a decimal point, for the bigint columns
+    copy_df.to_csv(buffer, header=False, index=False, float_format="%.17g")
+    buffer.seek(0)
+
+    table = connection.ops.quote_name(PriceHistory._meta.db_table)
+    columns = ", ".join(connection.ops.quote_name(PriceHistory._meta.get_field(field).column) for field in COPY_FIELDS)
+    unique_columns = [connection.ops.quote_name(PriceHistory._meta.get_field(field).column) for field in UNIQUE_FIELDS]
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f"CREATE TEMPORARY TABLE price_history_import ON COMMIT DROP AS "
+                       f"SELECT {columns} FROM {table} WITH NO DATA")
+        cursor.copy_expert(f"COPY price_history_import ({columns}) FROM STDIN WITH CSV", buffer)
+        # an insert on the partitioned parent table, so the partition trigger routes the rows
+        cursor.execute(
+            f"INSERT INTO {table} ({columns}) "
+            f"SELECT DISTINCT ON ({', '.join(unique_columns)}) {columns} FROM price_history_import staged "
+            f"WHERE NOT EXISTS (SELECT 1 FROM {table} saved WHERE "
+            + " AND ".join(f"saved.{column} = staged.{column}" for column in unique_columns) + ")"
+        )
+    return len(copy_df)
+
+
+def import_csv_file(file_path: str, manifest_path: str, from_timestamp: float = None, to_timestamp: float = None,
+                    chunksize: int = IMPORT_CHUNK_SIZE) -> int:
+    """
+    :param file_path: local csv file
+    :param manifest_path: progress of this file is read from and appended to this file
+    :param from_timestamp: skip rows at or before this unix timestamp (seconds)
+    :param to_timestamp: skip rows after this unix timestamp (seconds)
+    :return: number of rows copied
+    """
+    file_name = os.path.basename(file_path)
+    (source, transaction_currency, counter_currency) = parse_file_name(file_name)
+    if None in (source, counter_currency):
+        logger.warning(f"{file_name}: unsupported source or counter currency, skipping")
+        return 0
+
+    record = load_manifest(manifest_path).get(file_name, {})
+    if record.get("done"):
+        logger.info(f"{file_name} already imported")
+        return 0
+    rows_read = record.get("rows", 0)
+
+    rows_copied = 0
+    for chunk_df in pd.read_csv(file_path, names=CSV_COLUMNS, skiprows=rows_read,
+                                float_precision="round_trip", chunksize=chunksize):
+        rows_read += len(chunk_df)
+        timestamps = pd.to_numeric(chunk_df["timestamp"], errors="coerce").values
+        in_range = ~np.isnan(timestamps)
+        if from_timestamp:
+            in_range &= timestamps > from_timestamp * 1000
+        if to_timestamp:
+            in_range &= timestamps <= to_timestamp * 1000
+        chunk_df = chunk_df[in_range].assign(timestamp=timestamps[in_range])
+
+        if len(chunk_df):
+            rows_copied += copy_to_price_history(
+                get_copy_frame(chunk_df, source, transaction_currency, counter_currency)
+            )
+        append_to_manifest(manifest_path, file_name, rows_read)
+
+    append_to_manifest(manifest_path, file_name, rows_read, done=True)
+    logger.info(f"{file_name}: {rows_copied} rows copied")
+    return rows_copied
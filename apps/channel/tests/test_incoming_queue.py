@@ -0,0 +1,53 @@
+import json
+
+import boto3
+from django.test import TestCase
+from moto import mock_sqs
+
+from apps.channel.incoming_queue import SqsListener
+
+
+queue_name = "test-incoming-queue"
+
+
+class SqsListenerTestCase(TestCase):
+    def setUp(self):
+        self.mock = mock_sqs()
+        self.mock.start()
+        self.client = boto3.client("sqs", region_name="us-east-1")
+        self.queue_url = self.client.create_queue(
+            QueueName=queue_name, Attributes={"VisibilityTimeout": "0"}
+        )["QueueUrl"]
+        self.listener = SqsListener(queue_name, client=self.client, interval=0, workers=4)
+
+    def send_messages(self, count):
+        for i in range(count):
+            self.client.send_message(QueueUrl=self.queue_url, MessageBody=json.dumps({"i": i}))
+
+    def test_handled_messages_are_deleted(self):
+        self.send_messages(12)
+        handled = []
+        self.listener.handler = lambda body: handled.append(json.loads(body)["i"])
+
+        self.listener.listen(max_polls=10)
+
+        self.assertEqual(sorted(handled), list(range(12)))
+        self.assertEqual(self.listener.stats["received"], 12)
+        self.assertEqual(self.listener.stats["deleted"], 12)
+        self.assertNotIn("Messages", self.client.receive_message(QueueUrl=self.queue_url))
+
+    def test_failed_messages_stay_in_queue(self):
+        self.send_messages(1)
+
+        def failing_handler(body):
+            raise ValueError("can't handle")
+        self.listener.handler = failing_handler
+
+        self.listener.listen(max_polls=1)
+
+        self.assertEqual(self.listener.stats["failed"], 1)
+        self.assertEqual(self.listener.stats["deleted"], 0)
+        self.assertIn("Messages", self.client.receive_message(QueueUrl=self.queue_url))
+
+    def tearDown(self):
+        self.mock.stop()
@@ -0,0 +1,85 @@
+import datetime
+import json
+import time
+from unittest import mock
+
+from django.test import TestCase
+
+from apps.channel.management.commands.poll_queue import IngestionBatch, save_rows_to_redis
+from apps.indicator.models import Price, PriceHistory
+from settings import BINANCE, POLONIEX, BTC
+
+
+class SaveRowsToRedisTestCase(TestCase):
+    def get_row(self, source, transaction_currency="ETH"):
+        return PriceHistory(
+            source=source, transaction_currency=transaction_currency, counter_currency=BTC,
+            open_p=2000000, high=2100000, low=1900000, close=2050000, volume=123.4,
+            timestamp=datetime.datetime.utcnow().replace(second=0, microsecond=0),
+        )
+
+    def test_mixed_sources_share_one_pipeline(self):
+        for sources in ([BINANCE, BINANCE], [POLONIEX, BINANCE], [BINANCE, POLONIEX]):
+            rows = [self.get_row(source, transaction_currency) for source, transaction_currency in zip(sources, ["ETH", "LTC"])]
+            self.assertGreater(save_rows_to_redis(rows), 0)
+
+    def test_skipped_rows_only(self):
+        self.assertEqual(save_rows_to_redis([self.get_row(POLONIEX)]), 0)
+
+
+class IngestionBatchTestCase(TestCase):
+    def get_message(self, transaction_currency):
+        items = [{'source': 'binance', 'category': 'price', 'symbol': f'{transaction_currency}/BTC',
+                  'value': 0.05, 'timestamp': time.time()}]
+        return {
+            'ReceiptHandle': transaction_currency,
+            'Body': json.dumps({'Subject': 'prices_volumes', 'Message': json.dumps(items)}),
+        }
+
+    def test_flush_on_messages_count(self):
+        ingestion_batch = IngestionBatch(max_messages=3)
+        messages = [self.get_message(transaction_currency) for transaction_currency in ["ETH", "LTC", "XRP"]]
+
+        self.assertEqual(ingestion_batch.add_message(messages[0]), [])
+        self.assertEqual(ingestion_batch.add_message(messages[1]), [])
+        self.assertEqual(Price.objects.count(), 0)  # not saved, so not acknowledged yet
+
+        self.assertEqual(ingestion_batch.add_message(messages[2]), messages)
+        self.assertEqual(Price.objects.count(), 3)
+        self.assertEqual(ingestion_batch.flush_if_due(), [])
+
+    def test_flush_on_time(self):
+        ingestion_batch = IngestionBatch(max_messages=100, max_seconds=0.1)
+        message = self.get_message("ETH")
+
+        self.assertEqual(ingestion_batch.add_message(message), [])
+        self.assertEqual(ingestion_batch.flush_if_due(), [])
+
+        time.sleep(0.2)
+        self.assertEqual(ingestion_batch.flush_if_due(), [message])
+        self.assertEqual(Price.objects.count(), 1)
+
+    def test_failed_save_returns_no_messages(self):
+        ingestion_batch = IngestionBatch(max_messages=2)
+        ingestion_batch.add_message(self.get_message("ETH"))
+
+        with mock.patch('apps.channel.management.commands.poll_queue.save_rows', side_effect=Exception("db down")):
+            with self.assertRaises(Exception):
+                ingestion_batch.add_message(self.get_message("LTC"))
+        self.assertEqual(ingestion_batch.flush_if_due(), [])
+
+    def test_background_save_returns_messages_once_saved(self):
+        ingestion_batch = IngestionBatch(max_messages=1, async_flush=True)
+        message = self.get_message("ETH")
+
+        with mock.patch('apps.channel.management.commands.poll_queue.save_rows') as save_rows:
+            self.assertEqual(ingestion_batch.add_message(message), [])
+            self.assertEqual(ingestion_batch.collect_background_saves(wait_all=True), [message])
+        save_rows.assert_called_once()
+
+    def test_failed_background_save_returns_no_messages(self):
+        ingestion_batch = IngestionBatch(max_messages=1, async_flush=True)
+
+        with mock.patch('apps.channel.management.commands.poll_queue.save_rows', side_effect=Exception("db down")):
+            self.assertEqual(ingestion_batch.add_message(self.get_message("ETH")), [])
+            self.assertEqual(ingestion_batch.collect_background_saves(wait_all=True), [])
@@ -0,0 +1,143 @@
+import datetime
+import json
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+from django.test import TestCase, SimpleTestCase
+
+from apps.channel import price_history_import
+from apps.channel.price_history_import import parse_file_name, get_copy_frame, to_satoshi_array, \
+    copy_to_price_history, import_csv_file, load_manifest, CSV_COLUMNS, COPY_FIELDS
+from apps.indicator.models import PriceHistory
+from settings import BINANCE, POLONIEX, BTC, USDT
+
+FIRST_TIMESTAMP = 1530000000000  # ms, one row per minute
+
+
+def get_csv_rows(count, first_timestamp=FIRST_TIMESTAMP) -> list:
+    return [[first_timestamp + 60000 * i, 0.01 + i, 0.02 + i, 0.005 + i, 0.015 + i, 100.5 + i] for i in range(count)]
+
+
+class ParseFileNameTestCase(SimpleTestCase):
+
+    def test_parse_file_name(self):
+        self.assertEqual(parse_file_name("binance-BTC-USDT.csv"), (BINANCE, "BTC", USDT))
+        self.assertEqual(parse_file_name("/data/poloniex/poloniex-ADA-BTC.csv"), (POLONIEX, "ADA", BTC))
+
+    def test_unknown_codes_are_none(self):
+        self.assertEqual(parse_file_name("nowhere-ADA-BTC.csv"), (None, "ADA", BTC))
+        self.assertEqual(parse_file_name("binance-ADA-EUR.csv"), (BINANCE, "ADA", None))
+
+
+class GetCopyFrameTestCase(SimpleTestCase):
+
+    def test_to_satoshi_array_truncates(self):
+        satoshis = to_satoshi_array(pd.Series([0.123456789, 1.999999999, "1.5", "bad", None]))
+        np.testing.assert_array_equal(satoshis[:3], [12345678, 199999999, 150000000])
+        self.assertTrue(np.isnan(satoshis[3:]).all())
+
+    def test_copy_frame(self):
+        chunk_df = pd.DataFrame([[FIRST_TIMESTAMP + 1500, 0.01, 0.02, 0.005, 0.015, 100.5],
+                                 [FIRST_TIMESTAMP + 60000, "bad", 0.03, 0.01, 0.02, None]], columns=CSV_COLUMNS)
+        copy_df = get_copy_frame(chunk_df, BINANCE, "ADA", BTC)
+
+        self.assertEqual(list(copy_df.columns), COPY_FIELDS)
+        self.assertEqual(copy_df["timestamp"].iloc[0], "2018-06-26 08:00:01.500000+00")
+        self.assertEqual(list(copy_df.iloc[0][["source", "transaction_currency", "counter_currency"]]),
+                         [BINANCE, "ADA", BTC])
+        self.assertEqual(list(copy_df.iloc[0][["open_p", "high", "low", "close", "volume"]]),
+                         [1000000, 2000000, 500000, 1500000, 100.5])
+        self.assertTrue(np.isnan(copy_df["open_p"].iloc[1]))
+        self.assertTrue(np.isnan(copy_df["volume"].iloc[1]))
+
+
+class CopyToPriceHistoryTestCase(TestCase):
+
+    def test_nan_is_saved_as_null(self):
+        chunk_df = pd.DataFrame([[FIRST_TIMESTAMP, "bad", 0.02, 0.005, 0.015, None]], columns=CSV_COLUMNS)
+        copy_df = get_copy_frame(chunk_df, BINANCE, "ADA", BTC)
+
+        self.assertEqual(copy_to_price_history(copy_df), 1)
+        self.assertEqual(copy_to_price_history(copy_df), 1)  # already saved rows are skipped
+
+        price_history = PriceHistory.objects.get(source=BINANCE, transaction_currency="ADA", counter_currency=BTC)
+        self.assertEqual(price_history.timestamp, datetime.datetime.utcfromtimestamp(FIRST_TIMESTAMP / 1000))
+        self.assertIsNone(price_history.open_p)
+        self.assertIsNone(price_history.volume)
+        self.assertEqual((price_history.high, price_history.low, price_history.close), (2000000, 500000, 1500000))
+
+
+class ImportCsvFileTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.file_path = os.path.join(self.directory, "binance-ADA-BTC.csv")
+        self.manifest_path = os.path.join(self.directory, "manifest.jsonl")
+        pd.DataFrame(get_csv_rows(10)).to_csv(self.file_path, header=False, index=False)
+
+        # the copy frames instead of the db
+        self.copy_frames = []
+        patcher = mock.patch.object(price_history_import, 'copy_to_price_history', side_effect=self.copy)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def copy(self, copy_df):
+        self.copy_frames.append(copy_df)
+        return len(copy_df)
+
+    def get_copied_timestamps(self) -> list:
+        return [timestamp for copy_df in self.copy_frames for timestamp in copy_df["timestamp"]]
+
+    def test_chunks_and_manifest(self):
+        self.assertEqual(import_csv_file(self.file_path, self.manifest_path, chunksize=4), 10)
+        self.assertEqual([len(copy_df) for copy_df in self.copy_frames], [4, 4, 2])
+
+        with open(self.manifest_path) as manifest_file:
+            records = [json.loads(line) for line in manifest_file]
+        self.assertEqual([(record["rows"], record["done"]) for record in records],
+                         [(4, False), (8, False), (10, False), (10, True)])
+
+        # a finished file is not imported again
+        self.assertEqual(import_csv_file(self.file_path, self.manifest_path, chunksize=4), 0)
+        self.assertEqual(len(self.copy_frames), 3)
+
+    def test_resume_after_last_saved_chunk(self):
+        with open(self.manifest_path, "w") as manifest_file:
+            manifest_file.write(json.dumps({"file": "binance-ADA-BTC.csv", "rows": 4, "done": False}) + "\n")
+            manifest_file.write('{"file": "binance-ADA-BTC.csv", "ro')  # cut short by a crash
+
+        self.assertEqual(import_csv_file(self.file_path, self.manifest_path, chunksize=4), 6)
+
+        # only the rows after the 4 saved ones, skiprows=rows_read
+        all_timestamps = get_copy_frame(pd.DataFrame(get_csv_rows(10), columns=CSV_COLUMNS), BINANCE, "ADA", BTC)
+        self.assertEqual(self.get_copied_timestamps(), list(all_timestamps["timestamp"].iloc[4:]))
+        self.assertEqual(load_manifest(self.manifest_path)["binance-ADA-BTC.csv"], {
+            "file": "binance-ADA-BTC.csv", "rows": 10, "done": True
+        })
+
+    def test_from_and_to_timestamp(self):
+        # from is exclusive and to is inclusive, in seconds
+        from_timestamp = (FIRST_TIMESTAMP + 60000 * 2) / 1000
+        to_timestamp = (FIRST_TIMESTAMP + 60000 * 6) / 1000
+
+        self.assertEqual(import_csv_file(self.file_path, self.manifest_path, from_timestamp=from_timestamp,
+                                         to_timestamp=to_timestamp, chunksize=4), 4)
+
+        all_timestamps = get_copy_frame(pd.DataFrame(get_csv_rows(10), columns=CSV_COLUMNS), BINANCE, "ADA", BTC)
+        self.assertEqual(self.get_copied_timestamps(), list(all_timestamps["timestamp"].iloc[3:7]))
+        self.assertEqual(load_manifest(self.manifest_path)["binance-ADA-BTC.csv"]["rows"], 10)
+
+    def test_unsupported_file_is_skipped(self):
+        file_path = os.path.join(self.directory, "binance-ADA-EUR.csv")
+        shutil.copy(self.file_path, file_path)
+
+        self.assertEqual(import_csv_file(file_path, self.manifest_path), 0)
+        self.assertEqual(self.copy_frames, [])
+        self.assertFalse(os.path.exists(self.manifest_path))
@@ -1,8 +1,23 @@
+import atexit
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from itertools import islice
+from threading import Thread, Lock
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_THREAD_WORKERS = 16
+
+# executors are created on first use and shared by all callers in the process
+_executors = {}
+_executors_lock = Lock()
+
+
 # A DECORATOR FOR PYTHON THREADING
 # http://docs.python.org/2/library/threading.html#thread-objects
 # http://stackoverflow.com/questions/18420699/multithreading-for-python-django
-from threading import Thread
-
 def start_new_thread(function):
     def decorator(*args, **kwargs):
         t = Thread(target = function, args=args, kwargs=kwargs)
@@ -11,24 +26,99 @@ def start_new_thread(function):
     return decorator
 
 
-def run_all_multithreaded(function_def, list_of_params):
+def get_max_workers(backend: str, max_workers: int = None) -> int:
+    return max_workers or (DEFAULT_THREAD_WORKERS if backend == "thread" else os.cpu_count())
+
+
+def get_executor(backend: str = "thread", max_workers: int = None):
     """
-    :param function_def: the function to pass params to
-    :param list_of_params: list of function params, for multiple-param functions, pass tuples
-    :return:
+    :param backend: "thread" for IO bound work (redis, SQL, S3), "process" for CPU bound work (numpy, parsing)
+    :param max_workers: defaults to 16 threads, or one process per cpu
+    :return: the shared executor for this backend and size
     """
+    if backend not in ("thread", "process"):
+        raise ValueError(f"unknown executor backend: {backend}")
+    max_workers = get_max_workers(backend, max_workers)
 
-    from multiprocessing.dummy import Pool as ThreadPool
+    with _executors_lock:
+        executor = _executors.get((backend, max_workers))
+        if executor is None:
+            if backend == "thread":
+                executor = ThreadPoolExecutor(max_workers=max_workers)
+            else:
+                # forked processes must not share the parent's database connections
+                from django.db import connections
+                connections.close_all()
+                executor = ProcessPoolExecutor(max_workers=max_workers)
+            _executors[(backend, max_workers)] = executor
+        return executor
 
-    # make the Pool of workers
-    pool = ThreadPool(16)
 
-    # open functions in their own threads
-    # and compile all the results
-    results = pool.map(function_def, list_of_params)
+@atexit.register
+def shutdown_executors(wait: bool = True):
+    with _executors_lock:
+        for executor in _executors.values():
+            executor.shutdown(wait=wait)
+        _executors.clear()
 
-    # close the pool and wait for the work to finish
-    pool.close()
-    pool.join()
 
+def _run_chunk(function_def, indexed_params: list) -> list:
+    # runs in the worker, must stay a module level function so process backends can pickle it
+    results = []
+    for (index, params) in indexed_params:
+        start_time = time.time()
+        result = function_def(params)
+        results.append((index, result, time.time() - start_time))
     return results
+
+
+def run_all_in_executor(function_def, list_of_params, backend: str = "thread", max_workers: int = None,
+                        chunksize: int = 1, ordered: bool = True, timings: list = None) -> list:
+    """
+    :param function_def: the function to pass params to, module level for the process backend
+    :param list_of_params: iterable of function params, for multiple-param functions, pass tuples
+    :param backend: "thread" or "process", see get_executor()
+    :param max_workers: size of the shared executor to use
+    :param chunksize: number of params sent to a worker at once, raise for many small tasks
+    :param ordered: return results in the order of list_of_params, else in the order they finish
+    :param timings: optional list, filled with the seconds each task took, matching the results
+    :return: list of results
+    """
+    executor = get_executor(backend, max_workers)
+    max_chunks_in_flight = 2 * get_max_workers(backend, max_workers)
+    start_time = time.time()
+
+    indexed_params = iter(enumerate(list_of_params))
+    results, pending = [], set()
+
+    while True:
+        # submit chunks as workers free up, so generators of params are not read all at once
+        while len(pending) < max_chunks_in_flight:
+            chunk = list(islice(indexed_params, chunksize))
+            if not chunk:
+                break
+            pending.add(executor.submit(_run_chunk, function_def, chunk))
+        if not pending:
+            break
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            results.extend(future.result())
+
+    if ordered:
+        results.sort(key=lambda indexed_result: indexed_result[0])
+    if timings is not None:
+        timings.extend([seconds for (_, _, seconds) in results])
+    if results:
+        logger.debug(f"{getattr(function_def, '__name__', function_def)}: {len(results)} tasks "
+                     f"in {time.time() - start_time:.2f}s, slowest {max([r[2] for r in results]):.2f}s")
+    return [result for (_, result, _) in results]
+
+
+def run_all_multithreaded(function_def, list_of_params):
+    """
+    :param function_def: the function to pass params to
+    :param list_of_params: list of function params, for multiple-param functions, pass tuples
+    :return:
+    """
+    # uses the shared pool of 16 threads instead of starting a new pool for each call
+    return run_all_in_executor(function_def, list_of_params, backend="thread")
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2018-10-21 12:40
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('indicator', '0027_priceresampl_volume_variance'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='rsi',
+            name='avg_gain',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name='rsi',
+            name='avg_loss',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name='rsi',
+            name='ewm_weight',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name='rsi',
+            name='last_close_price',
+            field=models.BigIntegerField(null=True),
+        ),
+    ]
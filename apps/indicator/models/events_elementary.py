@@ -13,7 +13,7 @@ from django.db import models
 from apps.indicator.models.abstract_indicator import AbstractIndicator
 from apps.indicator.models.price_resampl import get_n_last_resampl_df
 from apps.indicator.models.sma import get_n_last_sma_df
-from apps.indicator.models.rsi import Rsi
+from apps.indicator.models.rsi import Rsi, get_rsi_bracket_values
 from apps.signal.models.signal import Signal
 
 from apps.user.models.user import get_horizon_value_from_string
@@ -75,6 +75,9 @@ _col2trend = {
     'sma50_cross_sma200_up': 3
 }
 
+# SMA crossover parameters
+SMA_LOW, SMA_HIGH = [50, 200]
+
 # Ichimoku parameters
 ichi_param_1_9 = 20
 ichi_param_2_26 = 60
@@ -87,66 +90,235 @@ VBI_VOLUME_PERIOD = 50
 VBI_PRICE_CROSS_PERCENT = 0.02  # TODO just for the time being it is here, should move later
 VBI_VOLUME_CROSS_PERCENT = 0.02
 
+# ANN anomaly parameters
+ANN_ANOMALY_THRESHOLD = 0.06  # have to learn that threshold
+
+# feature column saved as event_second_value of an event
+EVENT_SECOND_VALUE_FEATURES = {
+    'rsi_bracket': 'rsi',
+}
+
+
+def _fired(mask, value=1) -> pd.Series:
+    # the event value where mask is True, nan where the event did not fire
+    mask = pd.Series(mask).fillna(False).astype(bool)
+    return pd.Series(value, index=mask.index, dtype=float).where(mask)
+
 
+def _ben_is_active(resample_period) -> bool:
+    return RUN_BEN and resample_period <= MEDIUM # can't handle volume data for 1440 until we use PriceHistory
 
-def _process_ai_simple(horizon, ann_classif_df, **kwargs):
+
+def get_elementary_features_df(last_records, **kwargs) -> pd.DataFrame:
     '''
-    very simple strategy: emit signal anytime it changes state from up to down
+    one frame of everything the price based rules need for a pair, aligned on the resampled timestamps
+    resampled prices, sma{period} close price columns, mean_volume and the current rsi on the last row
+    :param kwargs: timestamp, source, transaction_currency, counter_currency and resample_period
     '''
+    # create a param dict to pass inside get_n_last_resampl_df
+    no_time_params = {
+        'source' : kwargs['source'],
+        'transaction_currency' : kwargs['transaction_currency'],
+        'counter_currency' : kwargs['counter_currency'],
+        'resample_period' : kwargs['resample_period']
+    }
+
+    # load nessesary resampled prices from price resampled
+    features_df = get_n_last_resampl_df(last_records, **no_time_params)
+    if features_df.empty:
+        return features_df
+    features_df = features_df.fillna(value=0)
+
+    sma_periods = {SMA_LOW, SMA_HIGH}
+    if _ben_is_active(kwargs['resample_period']):
+        sma_periods.add(VBI_PRICE_PERIOD)
+        # TODO: read resampled volumes from the DB when they're live
+        features_df['mean_volume'] = talib.SMA(np.array(features_df['close_volume'], dtype=float),
+                                               timeperiod=VBI_VOLUME_PERIOD)
+
+    for sma_period in sorted(sma_periods):
+        sma_df = get_n_last_sma_df(last_records, sma_period, **no_time_params)
+        # aligned on the index, nan where there is no sma
+        features_df[f'sma{sma_period}'] = sma_df['sma_close_price'] if 'sma_close_price' in sma_df else np.nan
 
-    # NOTE: here I hardcoded two class classification ignoring SAME - should be done on a  model level!!
+    rs_obj = Rsi.objects.filter(**kwargs).last()
+    features_df['rsi'] = np.nan
+    if rs_obj is not None and rs_obj.rsi is not None:
+        features_df.iloc[-1, features_df.columns.get_loc('rsi')] = rs_obj.rsi
+
+    return features_df
+
+
+def _rsi_events(features_df, **kwargs) -> pd.DataFrame:
+    '''
+    check the brackets of RSI, an event if we are less 30 or more 70
+    '''
+    rsi_brackets = get_rsi_bracket_values(features_df['rsi'].values)
+    return pd.DataFrame({
+        'rsi_bracket': _fired(pd.Series(rsi_brackets != 0, index=features_df.index), rsi_brackets),
+    })
+
+
+def _sma_crossover_events(features_df, **kwargs) -> pd.DataFrame:
+    '''
+    SMA crossover events, the sma is 0 where it is not available yet
+    '''
+    # NOTE - correct df names if change sma_low!
+    time_current = pd.to_datetime(time.time(), unit='s')
+    time_of_last_row = features_df.index[-1]
+    assert(abs( (time_current-time_of_last_row).seconds)  < 3000),'current time too far away'  # check if difference with now now > 30min
+
+    # todo: that is not right fron statistical view point!!! remove later when anough values
+    low_sma = features_df[f'sma{SMA_LOW}'].fillna(value=0)
+    high_sma = features_df[f'sma{SMA_HIGH}'].fillna(value=0)
 
-    # ann_classif_df = get_n_last_ann_classif_df(5, **kwargs)
-    # if ann_classif_df.empty:
-    #     logger.error('  get_n_last_ann: something wrong with AI indicators... we dont have it ...')
-    #     return False
+    low_price_sign = np.sign(low_sma - features_df.close_price)
+    high_price_sign = np.sign(high_sma - features_df.close_price)
+    low_high_sign = np.sign(low_sma - high_sma)
 
-    # choose only two class classification (ignore SAME), then add a new column with the best class
-    df = ann_classif_df[['probability_up','probability_down']]
-    df['class'] = df.idxmax(axis=1)
+    return pd.DataFrame({
+        'sma50_cross_price_down': _fired(low_price_sign.diff().lt(0)),  # -1
+        'sma200_cross_price_down': _fired(high_price_sign.diff().lt(0)),  # -2
+        'sma50_cross_sma200_down': _fired(low_high_sign.diff().lt(0)),  # -3
+        'sma50_cross_price_up': _fired(low_price_sign.diff().gt(0)),  # 1
+        'sma200_cross_price_up': _fired(high_price_sign.diff().gt(0)),  # 2
+        'sma50_cross_sma200_up': _fired(low_high_sign.diff().gt(0)),  # 3
+        'sma50_above_sma200': _fired(low_high_sign.gt(0)),
+        'sma50_below_sma200': _fired(low_high_sign.lt(0)),
+    })
 
-    df.loc[df['class'] == 'probability_up', 'class_num'] = int(0)
-    df.loc[df['class'] == 'probability_down', 'class_num'] = int(1)
-    df['class_change'] = df['class_num'].diff()   # detect change of state
+
+def _ben_volume_events(features_df, **kwargs) -> pd.DataFrame:
+    # DESCRIPTION of indicator:
+    # if price crosses the mean by some percent AND volume is already greater than mean by some other percent)
+    # OR (volume crosses the mean by some percent AND price is already greater than mean by some other
+    # percent) we emit a signal
+
+    # only the rows with both means, the events of the last of them are checked even if newer rows have no means yet
+    df = features_df[['close_price', 'close_volume', f'sma{VBI_PRICE_PERIOD}', 'mean_volume']].dropna()
+
+    price_sign = np.sign((1 + VBI_PRICE_CROSS_PERCENT) * df[f'sma{VBI_PRICE_PERIOD}'] - df.close_price)
+    volume_sign = np.sign((1 + VBI_VOLUME_CROSS_PERCENT) * df.mean_volume - df.close_volume)
+
+    return pd.DataFrame({
+        'vbi_price_cross_from_below': _fired(price_sign.diff().lt(0)),
+        'vbi_price_gt_mean_by_percent': _fired(price_sign.lt(0)),
+        'vbi_volume_cross_from_below': _fired(volume_sign.diff().lt(0)),
+        'vbi_volume_gt_mean_by_percent': _fired(volume_sign.lt(0)),
+    })
+
+
+def _ichimoku_events(features_df, **kwargs) -> pd.DataFrame:
+    '''
+    Ichimoku events are computed on prices resampled again by whole hours
+    and spread back to the feature rows of each hour
+    '''
+    # correct shift in 10 min , so resumple again
+    # shall be removed as soon as we have time by exact hours
+    # res_df = res_df[['high_price','low_price','open_price','close_price']].resample(rule='1H').mean().bfill()
+    rule = str(int(kwargs['resample_period'] / 60)) + 'H'
+
+    # todo - remove resampling when enough data is gathered (several weeks from now)
+    price_low_ts = features_df['low_price'].resample(rule=rule).mean().bfill()
+    price_high_ts = features_df['high_price'].resample(rule=rule).mean().bfill()
+    closing_price_ts = features_df['close_price'].resample(rule=rule).mean().bfill()
+
+
+    # calculate five Ichi lines
+    period_9_high = price_high_ts.rolling(window=ichi_param_1_9, center=False, min_periods=6).max() #highest high
+    period_9_low = price_low_ts.rolling(window=ichi_param_1_9, center=False, min_periods=6).min() # lowest low
+    tenkan_sen_conversion = (period_9_high + period_9_low) / 2
+
+    period_26_high = price_high_ts.rolling(window=ichi_param_2_26, center=False, min_periods=15).max()
+    period_26_low = price_low_ts.rolling(window=ichi_param_2_26, center=False, min_periods=15).min()
+    kijun_sen_base = (period_26_high + period_26_low) / 2
+
+    senkou_span_a_leading = ((tenkan_sen_conversion + kijun_sen_base) / 2).shift(ichi_displacement)
+
+    period_52_high = price_high_ts.rolling(window=ichi_param_3_52, center=False, min_periods=25).max()
+    period_52_low = price_low_ts.rolling(window=ichi_param_3_52, center=False, min_periods=25).min()
+    period52 = (period_52_high + period_52_low) / 2
+
+    senkou_span_b_leading = period52.shift(ichi_displacement)
+
+    hikou_span_lagging = closing_price_ts.shift(-ichi_displacement)
+
+    # combine everything into one dataFrame for convinience
+    df = pd.DataFrame({
+        'low': price_low_ts,
+        'high': price_high_ts,
+        'closing': closing_price_ts,
+        'conversion': tenkan_sen_conversion,
+        'base': kijun_sen_base,
+        'leading_a': senkou_span_a_leading,
+        'leading_b': senkou_span_b_leading,
+        'lagging': hikou_span_lagging,
+    })
+
+    # emit warning if any NAN is present
+    if df.isnull().values.any():
+        logger.debug("  Ichi: some of the elem_events are NaN, result might be INCORRECT! ")
+
+    # calculate intercections and more complex events
+    events_df = pd.DataFrame(index=df.index)
+    events_df['close_above_cloud'] = (df.closing > df.leading_a) & (df.closing > df.leading_b)
+    events_df['close_below_cloud'] = (df.closing < df.leading_a) & (df.closing < df.leading_b)
+
+    events_df['close_cloud_breakout_up'] = np.sign(
+        df.closing - pd.concat([df.leading_a, df.leading_b], axis=1).max(axis=1)
+    ).diff().fillna(0).gt(0)
+
+    events_df['close_cloud_breakout_down'] = np.sign(
+        df.closing - pd.concat([df.leading_a, df.leading_b], axis=1).min(axis=1)
+    ).diff().fillna(0).lt(0)
+
+    # to avoid up and down noise, make signal active for one more time point
+    events_df['close_cloud_breakout_up_ext'] = \
+        events_df['close_cloud_breakout_up'] | events_df['close_cloud_breakout_up'].shift(1).fillna(False)
+    events_df['close_cloud_breakout_down_ext'] = \
+        events_df['close_cloud_breakout_down'] | events_df['close_cloud_breakout_down'].shift(1).fillna(False)
+
+    # check it ichi_param_4_26 hours ago, then shift back to current day
+    lagging = df.lagging.shift(ichi_displacement)
+    events_df['lagging_above_cloud'] = ((lagging > df.leading_a.shift(ichi_displacement)) &
+                                        (lagging > df.leading_b.shift(ichi_displacement))).shift(ichi_displacement)
+    events_df['lagging_below_cloud'] = ((lagging < df.leading_a.shift(ichi_displacement)) &
+                                        (lagging < df.leading_b.shift(ichi_displacement))).shift(ichi_displacement)
+
+    events_df['lagging_above_highest'] = (lagging > df.high.shift(ichi_displacement)).shift(ichi_displacement)
+    events_df['lagging_below_lowest'] = (lagging < df.low.shift(ichi_displacement)).shift(ichi_displacement)
+
+    events_df['conversion_above_base'] = df.conversion > df.base
+    events_df['conversion_below_base'] = df.conversion < df.base
+
+    return pd.DataFrame({
+        event_name: _fired(events_df[event_name]) for event_name in ICHI_ELEMENTARY_EVENTS
+    }).reindex(features_df.index, method='ffill')
+
+
+def _ann_2class_simple_events(ann_classif_df, **kwargs) -> pd.DataFrame:
+    '''
+    very simple strategy: emit signal anytime it changes state from up to down, the value is the new trend
+    '''
+
+    # NOTE: here I hardcoded two class classification ignoring SAME - should be done on a  model level!!
+
+    # choose only two class classification (ignore SAME), up is 0 and down is 1, like idxmax() of the two
+    class_num = (ann_classif_df['probability_down'] > ann_classif_df['probability_up']).astype(int)
+    class_change = class_num.diff()   # detect change of state
 
     # class change is a difference btw previos and current cell of class (which is Up or DOWN)
     # so in case we have  0 0 0 0 1 1 (change prediction from up to down)
     # it will generate    0 0 0 0 1 0
-    if df.iloc[-1]['class_change'] != 0:
-        # emit signal
-        try:
-            logger.debug("******************** AI event is detected *****************")
-            # TODO: change to emitting two signals UP and DOWN according to how others events are generated (for ML)
-            new_instance = EventsElementary(
-                **kwargs,
-                event_name="ann_price_2class_simple",
-                event_value= -int(df.iloc[-1]['class_change']),
-            )
-            if MODIFY_DB: new_instance.save()
-            logger.debug("   >>> ANN event detected and saved")
+    return pd.DataFrame({
+        'ann_price_2class_simple': _fired(class_change.notnull() & class_change.ne(0), -class_change),
+    })
 
-            signal_ai = Signal(
-                **kwargs,
-                signal='ANN_Simple',
-                trend= -int(df.iloc[-1]['class_change']),
-                strength_value= int(3),
-                horizon=horizon,
-                predicted_ahead_for= ann_classif_df.tail(1)['predicted_ahead_for'][0],
-                probability_same = ann_classif_df.tail(1)['probability_same'][0],
-                probability_up = df.tail(1)['probability_up'][0],
-                probability_down = df.tail(1)['probability_down'][0]
-            )
-            if MODIFY_DB: signal_ai.save()
-            logger.debug("   >>> ANN event FIRED!")
-        except Exception as e:
-            logger.error(" Error saving/emitting ANN Event " + e)
-    else:
-        logger.debug("   ... no AI event generated (predicts no changes in price")
 
-
-def _process_ai_anomaly(horizon, ann_classif_df, **kwargs):
+def _ann_anomaly_events(ann_classif_df, **kwargs) -> pd.DataFrame:
     '''
-    yet another strategy based on ai indicator
+    yet another strategy based on ai indicator, the value is the probability of the current prediction
+    belonging to the distribution of the previous ones
     '''
 
     # we have a multivariate (3-variate) disctribution of price predictiton, calculate mean, varuance for each
@@ -159,9 +331,6 @@ def _process_ai_anomaly(horizon, ann_classif_df, **kwargs):
     # get the current data point
     x = np.array(ann_classif_df.tail(1)[['probability_same','probability_up','probability_down']])
 
-    # calculate single pdf value, for test
-    #p = multivariate_normal.pdf(x, mu, cov, allow_singular=True)
-
     #### here we calculate an area under 3D Gaussian curve which is probability of current point belonging to this disctibution
     m_dist_x = np.dot((x - mu), np.linalg.inv(cov))
     m_dist_x = np.dot(m_dist_x, (x - mu).transpose())
@@ -170,186 +339,137 @@ def _process_ai_anomaly(horizon, ann_classif_df, **kwargs):
     p = float(1 - stats.chi2.cdf(m_dist_x, 3))
     logger.info("  || ANOMALY DETECTION: probability of price belong to current distribution p = " + str(p))
 
-    # have to learn that threshold
-    TRESHOLD = 0.06
+    # only the current data point is checked
+    is_current = pd.Series(np.arange(len(ann_classif_df)) == len(ann_classif_df) - 1, index=ann_classif_df.index)
+    return pd.DataFrame({
+        'ann_price_anomaly': _fired(is_current & (p < ANN_ANOMALY_THRESHOLD), p),
+    })
 
-    if p < TRESHOLD:
-        # emit signal
+
+def get_elementary_rules(features_df, ann_classif_df, resample_period) -> list:
+    '''
+    :return: list of (rule name, rule function, the frame it reads) for evaluate_elementary_rules()
+    '''
+    rules = [
+        ('rsi', _rsi_events, features_df),
+        ('sma', _sma_crossover_events, features_df),
+    ]
+    if _ben_is_active(resample_period):
+        rules.append(('ben_volume', _ben_volume_events, features_df))
+    rules.append(('ichimoku', _ichimoku_events, features_df))
+    if ann_classif_df is not None:
+        rules.append(('ann_simple', _ann_2class_simple_events, ann_classif_df))
+        rules.append(('ann_anomaly', _ann_anomaly_events, ann_classif_df))
+    return rules
+
+
+def evaluate_elementary_rules(rules, timings: dict = None, **kwargs) -> dict:
+    '''
+    evaluate each rule on its frame, one column of event values per elementary event, and keep the last time point
+    a rule that fails is logged and skipped, the other rules still run
+    :param rules: list of (rule name, rule function, frame), a rule returns a DataFrame of event values
+    with nan where an event did not fire
+    :param timings: optional dict, filled with rule name: seconds the rule took
+    :return: dict of fired event name: event value
+    '''
+    fired_events = {}
+    for (rule_name, rule, frame) in rules:
+        start_time = time.time()
         try:
-            logger.debug("******************** ANOMALY THRESHOLD AI event is detected *****************")
-            new_instance = EventsElementary(
+            if frame is None or frame.empty:
+                logger.debug(f"   ... no data for {rule_name} elementary events")
+                continue
+            events_df = rule(frame, **kwargs)
+            if not events_df.empty:
+                fired_events.update(events_df.iloc[-1].dropna().to_dict())
+        except Exception as e:
+            logger.error(f" Error checking {rule_name} elementary events: {e}")
+        finally:
+            if timings is not None:
+                timings[rule_name] = time.time() - start_time
+    return fired_events
+
+
+def _emit_signals(horizon, fired_events, features_df, ann_classif_df, **kwargs):
+    '''
+    save a Signal for each fired event that emits one, Ichimoku and Ben events are only saved as events
+    '''
+    if 'rsi_bracket' in fired_events:
+        if EMIT_RSI:
+            try:
+                rsi_bracket = int(fired_events['rsi_bracket'])
+                signal_rsi = Signal(
+                    **kwargs,
+                    signal='RSI',
+                    rsi_value=features_df['rsi'].iloc[-1],
+                    trend=np.sign(rsi_bracket),
+                    horizon=horizon,
+                    strength_value=np.abs(rsi_bracket),
+                    strength_max=int(3),
+                )
+                if MODIFY_DB: signal_rsi.save()
+                logger.debug("   >>> RSI bracket event FIRED!")
+            except Exception as e:
+                logger.error(" Error emitting RSI Event ")
+        else:
+            logger.debug("   .. RSI emitting disabled by settings")
+
+    # Fire all sinals, except two which we dont need and imitting is allowed
+    for event_name in [event_name for event_name in _col2trend if event_name in fired_events]:
+        if not EMIT_SMA:
+            break
+        logger.debug('======> DISCREPANCY CHECK :: period= ' + str(kwargs['resample_period']) + '/ horozon= ' + str(horizon))
+        try:
+            trend = _col2trend[event_name]
+            signal_sma_cross = Signal(
                 **kwargs,
-                event_name="ann_price_anomaly",
-                event_value=p,
+                signal='SMA',
+                trend=np.sign(trend),  # -1 / 1
+                horizon=horizon,
+                strength_value=np.abs(trend),  # 1,2,3
+                strength_max=int(3)
             )
-            if MODIFY_DB: new_instance.save()
+            if MODIFY_DB: signal_sma_cross.save()
+            logger.debug("   >>> FIRED - Event " + event_name)
+        except Exception as e:
+            logger.error(" #Error firing SMA signal ")
 
+    if 'ann_price_2class_simple' in fired_events:
+        try:
+            # TODO: change to emitting two signals UP and DOWN according to how others events are generated (for ML)
+            signal_ai = Signal(
+                **kwargs,
+                signal='ANN_Simple',
+                trend=int(fired_events['ann_price_2class_simple']),
+                strength_value= int(3),
+                horizon=horizon,
+                predicted_ahead_for= ann_classif_df['predicted_ahead_for'].iloc[-1],
+                probability_same = ann_classif_df['probability_same'].iloc[-1],
+                probability_up = ann_classif_df['probability_up'].iloc[-1],
+                probability_down = ann_classif_df['probability_down'].iloc[-1]
+            )
+            if MODIFY_DB: signal_ai.save()
+            logger.debug("   >>> ANN event FIRED!")
+        except Exception as e:
+            logger.error(f" Error emitting ANN Event {e}")
+
+    if 'ann_price_anomaly' in fired_events:
+        try:
             signal_ai = Signal(
                 **kwargs,
                 signal='ANN_AnomalyPrc',
                 trend= int(0),
                 strength_value= int(3),
                 horizon=horizon,
-                predicted_ahead_for= ann_classif_df.tail(1)['predicted_ahead_for'][0],
-                probability_same = p,
-                #probability_up = -1,
-                #probability_down = -1
+                predicted_ahead_for= ann_classif_df['predicted_ahead_for'].iloc[-1],
+                probability_same = fired_events['ann_price_anomaly'],
             )
             logger.debug("------> AI Anomaly Signal to save:" + str(signal_ai))
 
             if MODIFY_DB: signal_ai.save()
             logger.debug("  || Anomaly ANN event FIRED!")
         except Exception as e:
-            logger.error(" Error saving/emitting Anomaly ANN Event " + e)
-    else:
-        logger.debug(" || no Anomaly AI  detected")
-
-
-
-
-
-def _process_rsi(horizon, **kwargs)->int:
-    '''
-    at every time point get the last fresh RSI value, check the brackets of RSI
-    and if we are less 25 or more 75 save this as an event in events and emit an RSI signal
-    '''
-    rs_obj = Rsi.objects.filter(**kwargs).last()
-
-    if (rs_obj is not None):
-        rsi_bracket = rs_obj.get_rsi_bracket_value() # get current rsi object
-        if rsi_bracket != 0:
-            # save the event
-            try:
-                new_instance = EventsElementary(
-                    **kwargs,
-                    event_name = "rsi_bracket",
-                    event_value = rsi_bracket,
-                    event_second_value = rs_obj.rsi,
-                )
-                if MODIFY_DB: new_instance.save()  # save if not in DEBUG mode
-                logger.debug("   >>> RSI bracket event detected and saved")
-
-                if EMIT_RSI:
-                    signal_rsi = Signal(
-                        **kwargs,
-                        signal='RSI',
-                        rsi_value=rs_obj.rsi,
-                        trend=np.sign(rsi_bracket),
-                        horizon=horizon,
-                        strength_value=np.abs(rsi_bracket),
-                        strength_max=int(3),
-                    )
-                    if MODIFY_DB: signal_rsi.save()
-                    logger.debug("   >>> RSI bracket event FIRED!")
-                else:
-                    logger.debug("   .. RSI emitting disabled by settings")
-            except Exception as e:
-                logger.error(" Error saving/emitting RSI Event ")
-            return rsi_bracket
-    else:
-        logger.debug(" ... No RSI Event found ")
-        return False
-
-
-def _process_sma_crossovers(horizon, prices_df, **kwargs):
-    '''
-    check if at given moment of time there is an SMA crossover event
-    if so, emit a signal
-    '''
-
-    # NOTE - correct df names if change sma_low!
-    time_current = pd.to_datetime(time.time(), unit='s')
-
-    # calculate all events and place them to one DF
-    events_df = pd.DataFrame()
-    events_df['sma50_cross_price_down']  = np.sign(prices_df.low_sma - prices_df.close_price).diff().lt(0)  # -1
-    events_df['sma200_cross_price_down'] = np.sign(prices_df.high_sma - prices_df.close_price).diff().lt(0)  # -2
-    events_df['sma50_cross_sma200_down'] = np.sign(prices_df.low_sma - prices_df.high_sma).diff().lt(0)  # -3
-    events_df['sma50_cross_price_up']  = np.sign(prices_df.low_sma - prices_df.close_price).diff().gt(0)  # 1
-    events_df['sma200_cross_price_up'] = np.sign(prices_df.high_sma - prices_df.close_price).diff().gt(0)  # 2
-    events_df['sma50_cross_sma200_up'] = np.sign(prices_df.low_sma - prices_df.high_sma).diff().gt(0)  # 3
-
-    events_df['sma50_above_sma200'] = np.sign(prices_df.low_sma - prices_df.high_sma).gt(0)
-    events_df['sma50_below_sma200'] = np.sign(prices_df.low_sma - prices_df.high_sma).lt(0)
-
-    # get the last events row and account for a small timestamp rounding error
-    last_event_row = events_df.iloc[-1]
-    time_of_last_row = events_df.index[-1]
-    assert(abs( (time_current-time_of_last_row).seconds)  < 3000),'current time too far away'  # check if difference with now now > 30min
-
-    # for each event in last row of all recents events
-    for event_name, event_value in last_event_row.iteritems():
-        if event_value:    # if one of SMA events is TRUE, save and emit
-
-            # save all elem events
-            try:
-                sma_event = EventsElementary(
-                    **kwargs,
-                    event_name=event_name,
-                    event_value=int(1),
-                )
-                if MODIFY_DB: sma_event.save()
-            except Exception as e:
-                logger.error(" #Error saving SMA elementary event ")
-
-            # Fire all sinals, except two which we dont need and imitting is allowed
-            if EMIT_SMA & (event_name not in ['sma50_above_sma200', 'sma50_below_sma200']):
-                logger.debug('======> DISCREPANCY CHECK :: period= ' + str(kwargs['resample_period']) + '/ horozon= ' + str(horizon))
-                try:
-                    trend = _col2trend[event_name]
-                    signal_sma_cross = Signal(
-                        **kwargs,
-                        signal='SMA',
-                        trend=np.sign(trend),  # -1 / 1
-                        horizon=horizon,
-                        strength_value=np.abs(trend),  # 1,2,3
-                        strength_max=int(3)
-                    )
-                    if MODIFY_DB: signal_sma_cross.save()
-                    logger.debug("   >>> FIRED - Event " + event_name)
-                except Exception as e:
-                    logger.error(" #Error firing SMA signal ")
-
-
-def _process_ben_volume_based(horizon, price_volume_df, **kwargs):
-    # DESCRIPTION of indicator:
-    # if price crosses the mean by some percent AND volume is already greater than mean by some other percent)
-    # OR (volume crosses the mean by some percent AND price is already greater than mean by some other
-    # percent) we emit a signal
-
-    events_df = pd.DataFrame()
-
-    events_df['vbi_price_cross_from_below'] = np.sign(
-        (1 + VBI_PRICE_CROSS_PERCENT) * price_volume_df.sma_close_price - price_volume_df.close_price
-                                                    ).diff().lt(0)
-    events_df['vbi_price_gt_mean_by_percent'] = np.sign(
-        (1 + VBI_PRICE_CROSS_PERCENT) * price_volume_df.sma_close_price - price_volume_df.close_price
-                                                    ).lt(0)
-
-    events_df['vbi_volume_cross_from_below'] = np.sign(
-        (1 + VBI_VOLUME_CROSS_PERCENT) * price_volume_df.mean_volume - price_volume_df.close_volume
-                                                    ).diff().lt(0)
-    events_df['vbi_volume_gt_mean_by_percent'] = np.sign(
-        (1 + VBI_VOLUME_CROSS_PERCENT) * price_volume_df.mean_volume - price_volume_df.close_volume
-                                                    ).lt(0)
-
-    # get the last events row and account for a small timestamp rounding error
-    last_event_row = events_df.iloc[-1]      # you can you events_df.tail(1) here
-
-    # for each event in last row of all recent events
-    # note: we need this loop because at one moment there might be several events (in contract to RSI)
-    for event_name, event_value in last_event_row.iteritems():
-        if event_value:    # if one of SMA events is TRUE, save and emit
-            # save all elem events
-            try:
-                ben_event = EventsElementary(
-                    **kwargs,
-                    event_name=event_name,
-                    event_value=int(1),
-                )
-                if MODIFY_DB: ben_event.save()
-            except Exception as e:
-                logger.error(" #Error saving Ben elementary event ")
+            logger.error(f" Error emitting Anomaly ANN Event {e}")
 
 
 
@@ -369,203 +489,58 @@ class EventsElementary(AbstractIndicator):
 
 
     @staticmethod
-    def check_events(cls, **kwargs):
+    def check_events(cls, **kwargs) -> dict:
+        '''
+        evaluate all elementary event rules of a pair, save the fired events with one insert and emit their signals
+        :return: dict of rule name: seconds it took
+        '''
         horizon = get_horizon_value_from_string(display_string=HORIZONS_TIME2NAMES[kwargs['resample_period']])
 
-        # create a param dict to pass inside get_n_last_resampl_df
-        no_time_params = {
-            'source' : kwargs['source'],
-            'transaction_currency' : kwargs['transaction_currency'],
-            'counter_currency' : kwargs['counter_currency'],
-            'resample_period' : kwargs['resample_period']
-        }
-
-
-        # load nessesary resampled prices from price resampled
         # we only need last_records back in time
         last_records = ichi_displacement * ichi_displacement + 10
-        prices_df = get_n_last_resampl_df(last_records, **no_time_params)
-        prices_df = prices_df.fillna(value=0)
-
-        logger.info('   ::::  Start analysing ELEMENTARY events ::::')
-
-        ############## check for RSI events, save and emit signal
-        logger.info("   ... Check RSI Events: ")
-        _process_rsi(horizon, **kwargs)
-
+        features_df = get_elementary_features_df(last_records, **kwargs)
 
-        ############## check SMA cross over events
-        logger.info("   ... Check SMA Events: ")
-        SMA_LOW, SMA_HIGH = [50,200]
-
-        sma_low_df = get_n_last_sma_df(last_records, SMA_LOW, **no_time_params).tail(10)
-        sma_high_df = get_n_last_sma_df(last_records, SMA_HIGH, **no_time_params).tail(10)
-        small_prices_df = prices_df.tail(10).copy()
-
-        # form a small price dataframe and add SMA to price dataframe
-        small_prices_df.loc[:,'low_sma'] = sma_low_df['sma_close_price']
-        small_prices_df.loc[:,'high_sma'] = sma_high_df['sma_close_price']
-
-        # todo: that is not right fron statistical view point!!! remove later when anough values
-        small_prices_df = small_prices_df.fillna(value=0)
-
-
-        # todo - add return value, and say if any crossovers have happend
-        _process_sma_crossovers(horizon, small_prices_df, **kwargs)
-        
-
-        ############### check Ben Volume Based events ###############
-        logger.info("   ... Check Ben Elementary Events: ")
-
-        if RUN_BEN and kwargs['resample_period'] <= MEDIUM: # can't handle volume data for 1440 until we use PriceHistory
-            prices_avg = get_n_last_sma_df(last_records, VBI_PRICE_PERIOD, **no_time_params)
-
-            # TODO: read resampled volumes from the DB when they're live
-            volumes_avg = talib.SMA(np.array(prices_df['close_volume'], dtype=float),
-                                    timeperiod=VBI_VOLUME_PERIOD)
-            prices_df['mean_volume'] = pd.Series(volumes_avg, index=prices_df.index)
-
-            prices_df = prices_df.join(prices_avg).dropna()
-
-            _process_ben_volume_based(horizon, prices_df, **kwargs)
-
-
-        ############## calculate and save ICHIMOKU elementary events
-        logger.info("   ... Check Ichimoku Elementary Events: ")
-        ichi_start_time = time.time()
-
-        # correct shift in 10 min , so resumple again
-        # shall be removed as soon as we have time by exact hours
-        # res_df = res_df[['high_price','low_price','open_price','close_price']].resample(rule='1H').mean().bfill()
-        rule = str(int(kwargs['resample_period'] / 60)) + 'H'
-
-        # todo - remove resampling when enough data is gathered (several weeks from now)
-        price_low_ts = prices_df['low_price'].resample(rule=rule).mean().bfill()
-        price_high_ts = prices_df['high_price'].resample(rule=rule).mean().bfill()
-        closing_price_ts = prices_df['close_price'].resample(rule=rule).mean().bfill()
-
-
-        # calculate five Ichi lines
-        period_9_high = price_high_ts.rolling(window=ichi_param_1_9, center=False, min_periods=6).max() #highest high
-        period_9_low = price_low_ts.rolling(window=ichi_param_1_9, center=False, min_periods=6).min() # lowest low
-        tenkan_sen_conversion = (period_9_high + period_9_low) / 2
-
-        period_26_high = price_high_ts.rolling(window=ichi_param_2_26, center=False, min_periods=15).max()
-        period_26_low = price_low_ts.rolling(window=ichi_param_2_26, center=False, min_periods=15).min()
-        kijun_sen_base = (period_26_high + period_26_low) / 2
-
-        senkou_span_a_leading = ((tenkan_sen_conversion + kijun_sen_base) / 2).shift(ichi_displacement)
-
-        period_52_high = price_high_ts.rolling(window=ichi_param_3_52, center=False, min_periods=25).max()
-        period_52_low = price_low_ts.rolling(window=ichi_param_3_52, center=False, min_periods=25).min()
-        period52 = (period_52_high + period_52_low) / 2
-
-        senkou_span_b_leading = period52.shift(ichi_displacement)
-
-        hikou_span_lagging = closing_price_ts.shift(-ichi_displacement)
-
-        # combine everything into one dataFrame for convinience
-        df = pd.DataFrame({
-            'idx_col': closing_price_ts.index,
-            'low': price_low_ts,
-            'high': price_high_ts,
-            'closing': closing_price_ts,
-            'conversion': tenkan_sen_conversion,
-            'base': kijun_sen_base,
-            'leading_a': senkou_span_a_leading,
-            'leading_b': senkou_span_b_leading,
-            'lagging': hikou_span_lagging,
-            'senkou_span_a_leading' : senkou_span_a_leading,
-            'hikou_span_lagging' :hikou_span_lagging
-        })
-
-        # emit warning if any NAN is present
-        if any(df.isnull()):
-            logger.debug("  Ichi: some of the elem_events are NaN, result might be INCORRECT! ")
-
-        # calculate intercections and more complex events
-        df['close_above_cloud'] = np.where(((df.closing > df.leading_a) & (df.closing > df.leading_b)), 1, 0)
-        df['close_below_cloud'] = np.where(((df.closing < df.leading_a) & (df.closing < df.leading_b)), 1, 0)
-
-        df['close_cloud_breakout_up'] = np.sign(
-            df.closing - pd.concat([df.leading_a, df.leading_b], axis=1).max(axis=1)
-        ).diff().fillna(0).gt(0)
-
-        df['close_cloud_breakout_down'] = np.sign(
-            df.closing - pd.concat([df.leading_a, df.leading_b], axis=1).min(axis=1)
-        ).diff().fillna(0).lt(0)
-
-        # to avoid up and down noise, make signal active for one more time point
-        df['close_cloud_breakout_up_ext'] = df['close_cloud_breakout_up'] | df['close_cloud_breakout_up'].shift(1)
-        df['close_cloud_breakout_down_ext'] = df['close_cloud_breakout_down'] | df['close_cloud_breakout_down'].shift(1)
-
-        # check it ichi_param_4_26 hours ago
-        df['lagging_above_cloud'] = np.where(
-            ((df.lagging.shift(ichi_displacement) > df.leading_a.shift(ichi_displacement)) &
-             (df.lagging.shift(ichi_displacement) > df.leading_b.shift(ichi_displacement))),
-            1, 0)
-        # shift back to current day
-        df['lagging_above_cloud'] = df['lagging_above_cloud'].shift(ichi_displacement)
-
-        df['lagging_below_cloud'] = np.where(
-            ((df.lagging.shift(ichi_displacement) < df.leading_a.shift(ichi_displacement)) &
-             (df.lagging.shift(ichi_displacement) < df.leading_b.shift(ichi_displacement))),
-            1, 0)
-        df['lagging_below_cloud'] = df['lagging_below_cloud'].shift(ichi_displacement)
-
-
-        df['lagging_above_highest'] = np.where(df.lagging.shift(ichi_displacement) > df.high.shift(ichi_displacement), 1, 0)
-        df['lagging_above_highest'] = df['lagging_above_highest'].shift(ichi_displacement)
-
-        df['lagging_below_lowest'] = np.where(df.lagging.shift(ichi_displacement) < df.low.shift(ichi_displacement), 1, 0)
-        df['lagging_below_lowest'] = df['lagging_below_lowest'].shift(ichi_displacement)
-
-        df['conversion_above_base'] = np.where(df.conversion > df.base, 1, 0)
-        df['conversion_below_base'] = np.where(df.conversion < df.base, 1, 0)
-
-
-
-        # get the last event line in DF, these are all events together
-        last_events = df.iloc[-1]
-        time_of_last_row = df.index[-1]
-        time_current = pd.to_datetime(kwargs['timestamp'], unit='s')
-        #assert (abs(time_current - time_of_last_row).value < 1800000)  # check if difference with now now > 30min
-        last_events = last_events.fillna(False)
-
-        # save event in DB and no signal emitting
-        for event_name in ICHI_ELEMENTARY_EVENTS:
-            event_value = last_events[event_name]
-            if event_value:
-                logger.debug('   >>> Ichi elem event was FIRED : ' + str(event_name))
-                try:
-                    ichi_event = cls(
-                        **kwargs,
-                        event_name=event_name,
-                        event_value=int(1),
-                    )
-                    if MODIFY_DB: ichi_event.save()
-                except Exception as e:
-                    logger.error(" Error saving  " + event_name + " elementary event ")
-        logger.info(" || Ichi calculation completed, " + str(horizon) + " in time " + str(time.time() - ichi_start_time))
-
-
-
-        ############## calculate and save ANN elementory Events   #################
         # we have ANN indicators only for SHORT period for now!
         # TODO: remove SHORT/ MEDIUM when models for 3 horizons will be added!
+        ann_classif_df = None
         if RUN_ANN and (kwargs['resample_period'] in [SHORT,MEDIUM]):
             # get recent ai_indicators from DB
             from apps.indicator.models.ann_future_price_classification import get_n_last_ann_classif_df
             ann_classif_df = get_n_last_ann_classif_df(200, "PRICE_PREDICT", **kwargs)
             if ann_classif_df.empty:
                 logger.error('  get_n_last_ann: something wrong with AI indicators... we dont have it ...')
-            else:
-                logger.info("   ... Check  AI Elementary Events for PERIOD: " + str(kwargs['resample_period']))
-                _process_ai_simple(horizon, ann_classif_df, **kwargs)
-                _process_ai_anomaly(horizon, ann_classif_df, **kwargs)
         else:
             logger.info("   ... ANN elementary event calculation has been skipped")
 
+        logger.info('   ::::  Start analysing ELEMENTARY events ::::')
+        timings = {}
+        fired_events = evaluate_elementary_rules(
+            get_elementary_rules(features_df, ann_classif_df, kwargs['resample_period']), timings, **kwargs
+        )
+
+        events = []
+        for event_name, event_value in fired_events.items():
+            second_value_feature = EVENT_SECOND_VALUE_FEATURES.get(event_name)
+            events.append(cls(
+                **kwargs,
+                event_name=event_name,
+                event_value=int(event_value),
+                event_second_value=features_df[second_value_feature].iloc[-1] if second_value_feature else None,
+            ))
+        if MODIFY_DB:
+            try:
+                cls.objects.bulk_create(events)
+            except Exception as e:
+                logger.error(f" Error saving {len(events)} elementary events: {e}")
+        logger.debug('   >>> elementary events FIRED : ' + str(list(fired_events)))
+
+        _emit_signals(horizon, fired_events, features_df, ann_classif_df, **kwargs)
+
+        logger.info(" || Elementary events completed, " + str(horizon) + ", rule timings: " + ", ".join(
+            f"{rule_name} {seconds:.3f}s" for rule_name, seconds in sorted(timings.items(), key=lambda item: -item[1])
+        ))
+        return timings
+
 
 
 
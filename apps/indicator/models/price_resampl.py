@@ -1,7 +1,13 @@
+import operator
+from contextlib import contextmanager
 from datetime import timedelta, datetime
+from functools import reduce
+from threading import Lock
 import numpy as np
 import pandas as pd
-from django.db import models
+from django.db import models, connection, transaction
+from django.db.models.signals import post_save
+from django.dispatch import receiver
 from apps.indicator.models.abstract_indicator import AbstractIndicator
 from apps.indicator.models.price_history import PriceHistory
 import time
@@ -94,9 +100,157 @@ class PriceResampl(AbstractIndicator):
             return False
 
 
+# one row of PriceResampl values per pair, in the order of compute(): prices are ordered newest first,
+# so open_price is the newest and close_price the oldest close price of the period
+RESAMPLE_ALL_PAIRS_SQL = """
+SELECT transaction_currency, counter_currency,
+    (array_agg(close ORDER BY "timestamp" DESC) FILTER (WHERE close IS NOT NULL))[1] AS open_price,
+    (array_agg(close ORDER BY "timestamp" ASC) FILTER (WHERE close IS NOT NULL))[1] AS close_price,
+    min(close) AS low_price,
+    max(close) AS high_price,
+    avg(close) AS mean_price,
+    var_pop(close) AS price_variance,
+    (array_agg(volume ORDER BY "timestamp" DESC) FILTER (WHERE volume IS NOT NULL))[1] AS open_volume,
+    (array_agg(volume ORDER BY "timestamp" ASC) FILTER (WHERE volume IS NOT NULL))[1] AS close_volume,
+    min(volume) AS low_volume,
+    max(volume) AS high_volume,
+    var_pop(volume) AS volume_variance
+FROM {table}
+WHERE source = %s AND "timestamp" >= %s AND "timestamp" <= %s
+GROUP BY transaction_currency, counter_currency
+"""
+
+
+def resample_all_pairs(source, pairs, resample_period, timestamp) -> int:
+    '''
+    PriceResampl.compute() and save() for many pairs of one source, with one GROUP BY query and one insert
+    existing PriceResampl of these pairs at this timestamp are replaced
+    :param pairs: list of (transaction_currency, counter_currency)
+    :param timestamp: unix timestamp of the end of the period
+    :return: number of pairs with prices in the period
+    '''
+    datetime_now = datetime.utcfromtimestamp(timestamp)
+    with connection.cursor() as cursor:
+        cursor.execute(RESAMPLE_ALL_PAIRS_SQL.format(table=PriceHistory._meta.db_table), [
+            source, datetime_now - timedelta(minutes=resample_period), datetime_now
+        ])
+        columns = [column[0] for column in cursor.description]
+        rows = {(row[0], row[1]): dict(zip(columns, row)) for row in cursor.fetchall()}
+
+    resample_objects = []
+    for (transaction_currency, counter_currency) in pairs:
+        resample_object = PriceResampl(source=source, transaction_currency=transaction_currency,
+                                       counter_currency=counter_currency, resample_period=resample_period,
+                                       timestamp=timestamp)
+        row = rows.get((transaction_currency, counter_currency))
+        if row and row['close_price'] is not None:
+            resample_object.open_price = int(row['open_price'])
+            resample_object.close_price = int(row['close_price'])
+            resample_object.low_price = int(row['low_price'])
+            resample_object.high_price = int(row['high_price'])
+            resample_object.midpoint_price = int((resample_object.high_price + resample_object.low_price) / 2)
+            resample_object.mean_price = int(row['mean_price'])
+            resample_object.price_variance = float(row['price_variance'])
+            for volume_field in ['open_volume', 'close_volume', 'low_volume', 'high_volume', 'volume_variance']:
+                if row[volume_field] is not None:
+                    setattr(resample_object, volume_field, float(row[volume_field]))
+        # like compute() on a created object, pairs without prices get an empty record
+        resample_objects.append(resample_object)
+
+    if not resample_objects:
+        return 0
+    with transaction.atomic():
+        PriceResampl.objects.filter(source=source, resample_period=resample_period, timestamp=timestamp).filter(
+            reduce(operator.or_, [models.Q(transaction_currency=transaction_currency, counter_currency=counter_currency)
+                                  for (transaction_currency, counter_currency) in pairs])
+        ).delete()
+        PriceResampl.objects.bulk_create(resample_objects, batch_size=1000)
+
+    # bulk_create does not send post_save
+    for (transaction_currency, counter_currency) in pairs:
+        invalidate_resampl_df_cache(source, transaction_currency, counter_currency, resample_period)
+
+    return sum(1 for pair in pairs if rows.get(pair) and rows[pair]['close_price'] is not None)
+
+
+# columns of get_n_last_resampl_df()
+RESAMPL_DF_COLUMNS = ['low_price', 'high_price', 'close_price', 'midpoint_price', 'mean_price', 'price_variance',
+                      'close_volume', 'volume_variance']
+
+
+############## per run cache of resampled prices
+# (source, transaction_currency, counter_currency, resample_period): (n, DataFrame), or None until loaded
+_resampl_df_cache = {}
+_resampl_df_cache_lock = Lock()
+
+
+@contextmanager
+def resampl_df_cache(source, transaction_currency, counter_currency, resample_period):
+    '''
+    Within this block get_n_last_resampl_df() for this pair and period queries PriceResampl once
+    and returns slices of the longest DataFrame loaded, so all indicators of a run share one query.
+    The slices are views, do not modify them in place.
+    Saving a PriceResampl of this pair and period invalidates the cache.
+    '''
+    key = (source, transaction_currency, counter_currency, resample_period)
+    with _resampl_df_cache_lock:
+        _resampl_df_cache[key] = None
+    try:
+        yield
+    finally:
+        with _resampl_df_cache_lock:
+            _resampl_df_cache.pop(key, None)
+
+
+def set_resampl_df_cache(n, df, source, transaction_currency, counter_currency, resample_period):
+    # share a DataFrame loaded elsewhere, eg. by get_n_last_resampl_dfs(), if the cache is active for it
+    key = (source, transaction_currency, counter_currency, resample_period)
+    with _resampl_df_cache_lock:
+        if key in _resampl_df_cache:
+            _resampl_df_cache[key] = (n, df)
+
+
+def invalidate_resampl_df_cache(source, transaction_currency, counter_currency, resample_period):
+    # call after writing PriceResampl without save(), eg. with bulk_create or raw SQL
+    key = (source, transaction_currency, counter_currency, resample_period)
+    with _resampl_df_cache_lock:
+        if key in _resampl_df_cache:
+            _resampl_df_cache[key] = None
+
+
+@receiver(post_save, sender=PriceResampl, dispatch_uid="invalidate_resampl_df_cache")
+def invalidate_resampl_df_cache_on_save(sender, instance, **kwargs):
+    invalidate_resampl_df_cache(instance.source, instance.transaction_currency,
+                                instance.counter_currency, instance.resample_period)
+
+
 ############## get n last records from resampled table as a DataFrame
 # NOTE: no kwargs because we dont have timestamp here
 def get_n_last_resampl_df(n, source, transaction_currency, counter_currency, resample_period)->pd.DataFrame:
+    key = (source, transaction_currency, counter_currency, resample_period)
+    with _resampl_df_cache_lock:
+        cache_is_active = key in _resampl_df_cache
+        cached = _resampl_df_cache.get(key)
+
+    if not cache_is_active:
+        return _query_n_last_resampl_df(n, source, transaction_currency, counter_currency, resample_period)
+
+    if cached is None or cached[0] < n:
+        df = _query_n_last_resampl_df(n, source, transaction_currency, counter_currency, resample_period)
+        with _resampl_df_cache_lock:
+            if key in _resampl_df_cache:
+                _resampl_df_cache[key] = (n, df)
+        return df
+
+    (cached_n, df) = cached
+    if cached_n == n or df.empty:
+        return df
+    # a shorter window of the same frame, rows are in time order
+    start = df.index.searchsorted(datetime.now() - timedelta(minutes=resample_period * n))
+    return df.iloc[start:]
+
+
+def _query_n_last_resampl_df(n, source, transaction_currency, counter_currency, resample_period)->pd.DataFrame:
 
     last_prices = list(PriceResampl.objects.filter(
         source=source,
@@ -104,31 +258,43 @@ def get_n_last_resampl_df(n, source, transaction_currency, counter_currency, res
         transaction_currency=transaction_currency,
         counter_currency=counter_currency,
         timestamp__gte = datetime.now() - timedelta(minutes=resample_period * n)
-    ).values('timestamp', 'low_price', 'high_price', 'close_price', 'midpoint_price','mean_price','price_variance','close_volume','volume_variance').order_by('-timestamp'))
+    ).values('timestamp', *RESAMPL_DF_COLUMNS).order_by('-timestamp'))
+
+    return _resampl_df_from_records(last_prices)
+
+
+def get_n_last_resampl_dfs(n, source, pairs, resample_period)->dict:
+    '''
+    get_n_last_resampl_df() for many pairs of one source, with one query
+    :param pairs: list of (transaction_currency, counter_currency)
+    :return: dict of (transaction_currency, counter_currency): DataFrame, empty if the pair has no prices
+    '''
+    last_prices = PriceResampl.objects.filter(
+        source=source,
+        resample_period=resample_period,
+        transaction_currency__in={transaction_currency for (transaction_currency, _) in pairs},
+        counter_currency__in={counter_currency for (_, counter_currency) in pairs},
+        timestamp__gte = datetime.now() - timedelta(minutes=resample_period * n)
+    ).values('transaction_currency', 'counter_currency', 'timestamp', *RESAMPL_DF_COLUMNS).order_by('-timestamp')
+
+    records_by_pair = {tuple(pair): [] for pair in pairs}
+    for record in last_prices.iterator():
+        pair_records = records_by_pair.get((record['transaction_currency'], record['counter_currency']))
+        if pair_records is not None:
+            pair_records.append(record)
+
+    return {pair: _resampl_df_from_records(records) for pair, records in records_by_pair.items()}
+
+
+def _resampl_df_from_records(last_prices)->pd.DataFrame:
+    # last_prices: list of PriceResampl values() dicts, newest first
 
     df = pd.DataFrame()
     if last_prices:
         # todo - reverse order or make sure I get values in the same order!
         ts = [rec['timestamp'] for rec in last_prices]
-        low_prices = pd.Series(data=[rec['low_price'] for rec in last_prices], index=ts)
-        high_prices = pd.Series(data=[rec['high_price'] for rec in last_prices], index=ts)
-        close_prices = pd.Series(data=[rec['close_price'] for rec in last_prices], index=ts)
-        midpoint_prices = pd.Series([rec['midpoint_price'] for rec in last_prices], index=ts)
-        mean_prices = pd.Series([rec['mean_price'] for rec in last_prices], index=ts)
-        price_variance = pd.Series([rec['price_variance'] for rec in last_prices], index=ts)
-
-        close_volume = pd.Series([rec['close_volume'] for rec in last_prices], index=ts)
-        volume_variance = pd.Series([rec['volume_variance'] for rec in last_prices], index=ts)
-
-        df['low_price'] = low_prices
-        df['high_price'] = high_prices
-        df['close_price'] = close_prices
-        df['midpoint_price'] = midpoint_prices
-        df['mean_price'] = mean_prices
-        df['price_variance'] = price_variance
-
-        df['close_volume'] = close_volume
-        df['volume_variance'] = volume_variance
+        for column in RESAMPL_DF_COLUMNS:
+            df[column] = pd.Series(data=[rec[column] for rec in last_prices], index=ts)
 
         # we need df in a right order (from past to future) to make sma rolling work righ
         df = df.iloc[::-1] # df.sort_index(inplace=True)  might works too
@@ -136,6 +302,21 @@ def get_n_last_resampl_df(n, source, transaction_currency, counter_currency, res
     return df
 
 
+def stack_resampl_column(resampl_dfs: list, column: str) -> tuple:
+    '''
+    one column of several resampled price DataFrames as one 2-D array, for computing many pairs at once
+    rows are aligned on their last value, shorter rows are padded with nan at the start
+    :return: (2-D array with one row per DataFrame, array of the index of each row's first value)
+    '''
+    length = max([len(df) for df in resampl_dfs] or [0])
+    values = np.full((len(resampl_dfs), length), np.nan)
+    offsets = np.array([length - len(df) for df in resampl_dfs], dtype=int)
+    for row, (df, offset) in enumerate(zip(resampl_dfs, offsets)):
+        if len(df):
+            values[row, offset:] = df[column].values.astype(float)
+    return values, offsets
+
+
 # get the first element ever resampled
 def get_first_resampled_time(source, transaction_currency, counter_currency, resample_period)->float:
     first_time = PriceResampl.objects.filter(
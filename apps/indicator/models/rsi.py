@@ -2,14 +2,27 @@ from django.db import models
 from apps.indicator.models.abstract_indicator import AbstractIndicator
 from apps.indicator.models import price_resampl
 from settings import MODIFY_DB
+from datetime import timedelta, datetime
 import numpy as np
 import logging
 
 logger = logging.getLogger(__name__)
 
+RSI_COM = 14  # center of mass of the up/down EWMA
+RSI_MIN_PERIODS = 3  # ewm min_periods
+RSI_MIN_PRICES = 12  # RSI is computed with more than this many close prices
+RSI_RECOMPUTE_PERIODS = 24  # recompute the EWMA from the whole window every this many resample periods
+RSI_DRIFT_TOLERANCE = 1e-6  # relative difference logged when the recomputed RS differs from the continued one
+
 class Rsi(AbstractIndicator):
     relative_strength = models.FloatField(null=True)  # relative strength
 
+    # up/down EWMA state, so the next RSI only steps through the newest close prices
+    avg_gain = models.FloatField(null=True)
+    avg_loss = models.FloatField(null=True)
+    ewm_weight = models.FloatField(null=True)  # sum of the ewm weights, the same for gains and losses
+    last_close_price = models.BigIntegerField(null=True)  # the close price of the last step
+
     class Meta:
         indexes = [
             models.Index(fields=['transaction_currency', 'counter_currency', 'source', 'resample_period']),
@@ -30,22 +43,8 @@ class Rsi(AbstractIndicator):
 
         assert (rsi>0.0) & (rsi<100.0), '>>> ERROR: RSI has extreme value of 0 or 100, highly unlikely'
 
-        rsi_strength = 0
-        if rsi >= 0 and rsi <= 100 :
-            logger.debug("   RSI= " + str(rsi))
-            if rsi >= 80:
-                rsi_strength = -3  # Extremely overbought
-            elif rsi >= 75:
-                rsi_strength = -2  # very overbought
-            elif rsi >= 70:
-                rsi_strength = -1  # overbought
-            elif rsi <= 20:
-                rsi_strength = 3  # Extremely oversold
-            elif rsi <= 25:
-                rsi_strength = 2   # very oversold
-            elif rsi <= 30:
-                rsi_strength = 1  # oversold
-        return rsi_strength
+        logger.debug("   RSI= " + str(rsi))
+        return int(get_rsi_bracket_values([rsi])[0])
 
 
     def compute_rs(self)->float:
@@ -53,34 +52,36 @@ class Rsi(AbstractIndicator):
         Relative Strength calculation.
         The RSI is calculated a a property, we only save RS
         (RSI is a momentum oscillator that measures the speed and change of price movements.)
+        the up/down EWMA continues from the previous Rsi of this pair with the close prices resampled since,
+        and is recomputed from the whole window if there is no previous state or on a recompute run
         :return:
         '''
+        pair = (self.transaction_currency, self.counter_currency)
+        previous_rsi = get_previous_rsis(self.source, [pair], self.resample_period, self.timestamp).get(pair)
+        continued_state = None
+        if previous_rsi is not None:
+            new_close_prices = get_close_prices_since(previous_rsi, self.timestamp)
+            continued_state = continue_rsi_ewm_states({pair: previous_rsi}, {pair: new_close_prices})[pair]
+
+        if continued_state is not None and not is_rsi_recompute_run(self.timestamp, self.resample_period):
+            self._set_ewm_state(*continued_state)
+            return self.relative_strength
 
         resampl_price_df = price_resampl.get_n_last_resampl_df(
-            20 * self.resample_period,
+            get_rsi_resampl_records(self.resample_period),
             self.source, self.transaction_currency, self.counter_currency, self.resample_period
         )
 
         resampl_close_price_ts = resampl_price_df.close_price
         logger.debug( '  RSI:   current period=' + str(self.resample_period) + ', close prices available for that period=' + str(resampl_close_price_ts.size))
 
-        if (resampl_close_price_ts is not None) and (resampl_close_price_ts.size > 12):
-            # difference btw start and close of the day, remove the first NA
-            delta = resampl_close_price_ts.diff()
-            delta = delta[1:]
-
-            up, down = delta.copy(), delta.copy()
-            up[up < 0] = 0
-            down[down > 0] = 0
-
+        if (resampl_close_price_ts is not None) and (resampl_close_price_ts.size > RSI_MIN_PRICES):
             # Calculate the 14 period back EWMA for each up/down trends
             # QUESTION: shall this 14 perid depends on period 15,60, 360?
-            roll_up = up.ewm(com = 14, min_periods=3).mean()
-            roll_down = np.abs(down.ewm(com = 14, min_periods=3).mean())
-
-            rs_ts = roll_up / roll_down
-
-            self.relative_strength = float(rs_ts.tail(1))  # get the last element for the last time point
+            close_prices = resampl_close_price_ts.values.astype(float)[np.newaxis, :]
+            self._set_ewm_state(*[value[0] for value in rsi_ewm_state(close_prices)], close_prices[0, -1])
+            if continued_state is not None:
+                log_rsi_drift(pair, self.relative_strength, relative_strength(*continued_state[:3]))
             return self.relative_strength
         else:
             logger.debug(':RSI was not calculated:: Not enough closing prices')
@@ -88,6 +89,14 @@ class Rsi(AbstractIndicator):
             return None
 
 
+    def _set_ewm_state(self, avg_gain, avg_loss, ewm_weight, nobs, last_close_price):
+        # one row of rsi_ewm_state(), the state is only kept once it gives a valid RS to continue from
+        self.relative_strength = float(relative_strength(avg_gain, avg_loss, nobs))
+        if nobs >= RSI_MIN_PERIODS and np.isfinite([avg_gain, avg_loss, ewm_weight]).all():
+            self.avg_gain, self.avg_loss, self.ewm_weight = float(avg_gain), float(avg_loss), float(ewm_weight)
+            self.last_close_price = None if np.isnan(last_close_price) else int(last_close_price)
+
+
     @staticmethod
     def compute_all(cls, **kwargs):
 
@@ -102,7 +111,214 @@ class Rsi(AbstractIndicator):
             logger.info("       RSI was not saved (either no value or debug model")
 
 
+    @staticmethod
+    def compute_all_pairs(cls, resampl_dfs, **kwargs):
+        '''
+        compute_all() for many pairs of one source at once, saved with one insert
+        :param resampl_dfs: dict of (transaction_currency, counter_currency): get_n_last_resampl_df() DataFrame
+        covering at least get_rsi_resampl_records()
+        :param kwargs: timestamp, source and resample_period
+        '''
+        pairs = [pair for pair, df in resampl_dfs.items() if not df.empty]
+        if not pairs:
+            return
+        (timestamp, resample_period) = (kwargs['timestamp'], kwargs['resample_period'])
+
+        previous_rsis = get_previous_rsis(kwargs['source'], pairs, resample_period, timestamp)
+        continued_states = continue_rsi_ewm_states(previous_rsis, {
+            pair: resampl_dfs[pair].close_price[resampl_dfs[pair].index > previous_rsi.timestamp].values
+            for pair, previous_rsi in previous_rsis.items()
+        })
+        recompute = is_rsi_recompute_run(timestamp, resample_period)
+        states = {} if recompute else dict(continued_states)
+
+        full_pairs = [pair for pair in pairs if pair not in states]
+        if full_pairs:
+            close_prices, offsets = price_resampl.stack_resampl_column([resampl_dfs[pair] for pair in full_pairs], 'close_price')
+            # only the prices compute_rs() would query for each pair
+            start_time = datetime.now() - timedelta(minutes=resample_period * get_rsi_resampl_records(resample_period))
+            starts = offsets + np.array([resampl_dfs[pair].index.searchsorted(start_time) for pair in full_pairs], dtype=int)
+            first_start = starts.min()
+            close_prices = close_prices[:, first_start:]
+            starts = starts - first_start
+            close_prices[np.arange(close_prices.shape[1]) < starts[:, np.newaxis]] = np.nan
+
+            for pair, n_prices, *state in zip(full_pairs, close_prices.shape[1] - starts,
+                                              *rsi_ewm_state(close_prices), close_prices[:, -1]):
+                if n_prices > RSI_MIN_PRICES:
+                    states[pair] = tuple(state)
+
+        rsi_instances = []
+        for (transaction_currency, counter_currency), state in states.items():
+            rsi = cls(**kwargs, transaction_currency=transaction_currency, counter_currency=counter_currency)
+            rsi._set_ewm_state(*state)
+            if rsi.relative_strength:
+                rsi_instances.append(rsi)
+            if recompute and (transaction_currency, counter_currency) in continued_states:
+                log_rsi_drift((transaction_currency, counter_currency), rsi.relative_strength,
+                              relative_strength(*continued_states[(transaction_currency, counter_currency)][:3]))
+        if MODIFY_DB:
+            cls.objects.bulk_create(rsi_instances)
+        logger.info(f"   ...RS calculation completed for {len(rsi_instances)} of {len(pairs)} pairs, "
+                    f"{len(states) - len(full_pairs)} continued from the previous RSI.")
+
+
+def get_rsi_bracket_values(rsi_values) -> np.ndarray:
+    '''
+    Rsi.get_rsi_bracket_value() for an array of rsi values, 0 for nan and the extreme values 0 and 100
+    '''
+    rsi_values = np.asarray(rsi_values, dtype=float)
+    with np.errstate(invalid='ignore'):
+        return np.select([
+            np.isnan(rsi_values) | (rsi_values <= 0) | (rsi_values >= 100),
+            rsi_values >= 80,  # Extremely overbought
+            rsi_values >= 75,  # very overbought
+            rsi_values >= 70,  # overbought
+            rsi_values <= 20,  # Extremely oversold
+            rsi_values <= 25,  # very oversold
+            rsi_values <= 30,  # oversold
+        ], [0, -3, -2, -1, 3, 2, 1], default=0)
+
+
+def get_rsi_resampl_records(resample_period) -> int:
+    # n for get_n_last_resampl_df()
+    return 20 * resample_period
+
+
+def is_rsi_recompute_run(timestamp, resample_period) -> bool:
+    # every RSI_RECOMPUTE_PERIODS resample periods the EWMA is recomputed from the whole window
+    return int(timestamp // (resample_period * 60)) % RSI_RECOMPUTE_PERIODS == 0
+
+
+def get_previous_rsis(source, pairs, resample_period, timestamp) -> dict:
+    '''
+    the last Rsi before timestamp with an ewm state for each pair, if it is within the window compute_rs() reads
+    :param pairs: list of (transaction_currency, counter_currency)
+    :param timestamp: unix time of the Rsi being computed
+    :return: dict of (transaction_currency, counter_currency): Rsi
+    '''
+    previous_rsis = Rsi.objects.filter(
+        source=source,
+        resample_period=resample_period,
+        transaction_currency__in={transaction_currency for (transaction_currency, _) in pairs},
+        counter_currency__in={counter_currency for (_, counter_currency) in pairs},
+        timestamp__lt=datetime.utcfromtimestamp(timestamp),
+        timestamp__gte=datetime.now() - timedelta(minutes=resample_period * get_rsi_resampl_records(resample_period)),
+        ewm_weight__isnull=False,
+    ).order_by('transaction_currency', 'counter_currency', '-timestamp').distinct('transaction_currency', 'counter_currency')
+
+    pairs = {tuple(pair) for pair in pairs}
+    return {
+        (rsi.transaction_currency, rsi.counter_currency): rsi for rsi in previous_rsis
+        if (rsi.transaction_currency, rsi.counter_currency) in pairs
+    }
+
+
+def get_close_prices_since(previous_rsi, timestamp) -> np.ndarray:
+    # close prices resampled after previous_rsi up to timestamp, in time order
+    return np.array(price_resampl.PriceResampl.objects.filter(
+        source=previous_rsi.source,
+        resample_period=previous_rsi.resample_period,
+        transaction_currency=previous_rsi.transaction_currency,
+        counter_currency=previous_rsi.counter_currency,
+        timestamp__gt=previous_rsi.timestamp,
+        timestamp__lte=datetime.utcfromtimestamp(timestamp),
+    ).order_by('timestamp').values_list('close_price', flat=True), dtype=float)
+
+
+def continue_rsi_ewm_states(previous_rsis: dict, new_close_prices: dict) -> dict:
+    '''
+    step the ewm state of each pair's previous Rsi through the close prices resampled since
+    :param previous_rsis: dict of pair: Rsi with an ewm state
+    :param new_close_prices: dict of pair: 1-D array of close prices after that Rsi, in time order
+    :return: dict of pair: (avg_gain, avg_loss, ewm_weight, nobs, last_close_price)
+    '''
+    pairs_by_length = {}
+    for pair in previous_rsis:
+        pairs_by_length.setdefault(len(new_close_prices[pair]), []).append(pair)
+
+    states = {}
+    # pairs with as many new prices step together, nan padding would still decay the ewm weights
+    for pairs in pairs_by_length.values():
+        close_prices = np.array([
+            [previous_rsis[pair].last_close_price] + list(new_close_prices[pair]) for pair in pairs
+        ], dtype=float)  # a null last close price becomes nan
+        previous_state = tuple(
+            np.array([getattr(previous_rsis[pair], field) for pair in pairs], dtype=float)
+            for field in ('avg_gain', 'avg_loss', 'ewm_weight')
+        )
+        for pair, *state in zip(pairs, *rsi_ewm_state(close_prices, previous_state), close_prices[:, -1]):
+            states[pair] = tuple(state)
+    return states
+
+
+def log_rsi_drift(pair, relative_strength, continued_relative_strength):
+    drift = abs(relative_strength - continued_relative_strength) / max(abs(relative_strength), 1e-12)
+    if drift > RSI_DRIFT_TOLERANCE:
+        logger.warning(f"RSI of {pair} drifted by {drift:.2e}: recomputed {relative_strength}, "
+                       f"continued {continued_relative_strength}")
+
+
+def rsi_ewm_state(close_prices, previous_state=None) -> tuple:
+    '''
+    the up/down EWMA of Rsi.compute_rs() for many pairs at once
+    :param close_prices: 2-D array, one row of close prices in time order per pair, nan before a pair's first price
+    :param previous_state: (avg_gain, avg_loss, ewm_weight) arrays to continue from,
+    the first close price of each row is then the last close price of that state
+    :return: (avg_gain, avg_loss, ewm_weight, nobs) arrays, avg_loss is positive
+    '''
+    deltas = np.diff(close_prices, axis=1)
+    gains = np.where(deltas < 0, 0, deltas)  # nan stays nan, like up[up < 0] = 0
+    losses = np.where(deltas > 0, 0, -deltas)  # like np.abs() of down[down > 0] = 0
+
+    gain_state, loss_state = None, None
+    if previous_state is not None:
+        (avg_gain, avg_loss, ewm_weight) = previous_state
+        nobs = np.full(len(ewm_weight), RSI_MIN_PERIODS)  # a state is only saved with enough observations
+        gain_state, loss_state = (avg_gain, ewm_weight, nobs), (avg_loss, ewm_weight, nobs)
+
+    (avg_gain, ewm_weight, nobs) = ewm_mean_state(gains, com=RSI_COM, state=gain_state)
+    (avg_loss, _, _) = ewm_mean_state(losses, com=RSI_COM, state=loss_state)
+    return avg_gain, avg_loss, ewm_weight, nobs
+
+
+def relative_strength(avg_gain, avg_loss, nobs=RSI_MIN_PERIODS):
+    # rUp / rDown of rsi_ewm_state(), nan until ewm min_periods
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(nobs >= RSI_MIN_PERIODS, np.divide(avg_gain, np.abs(avg_loss)), np.nan)
+
+
+def ewm_mean_state(values, com, state=None) -> tuple:
+    '''
+    step ewm(com=com).mean() with the pandas defaults adjust=True and ignore_na=False
+    through time for all rows together
+    :param values: 2-D array, one row per series in time order
+    :param state: (weighted_avg, old_wt, nobs) arrays returned for earlier values of the same series
+    :return: (weighted_avg, old_wt, nobs) arrays, weighted_avg is the last ewm mean
+    '''
+    old_wt_factor = 1. - 1. / (1. + com)
+    new_wt = 1.
+
+    if state is None:
+        weighted_avg = np.full(values.shape[0], np.nan)
+        old_wt = np.ones(values.shape[0])
+        nobs = np.zeros(values.shape[0], dtype=int)
+    else:
+        weighted_avg, old_wt = np.array(state[0], dtype=float), np.array(state[1], dtype=float)
+        nobs = np.array(state[2], dtype=int)
+
+    for cur in values.T:
+        is_observation = ~np.isnan(cur)
+        has_avg = ~np.isnan(weighted_avg)
+        nobs = nobs + is_observation
+
+        old_wt = np.where(has_avg, old_wt * old_wt_factor, old_wt)
+        update = has_avg & is_observation
+        weighted_avg = np.where(update, (old_wt * weighted_avg + new_wt * cur) / (old_wt + new_wt), weighted_avg)
+        old_wt = np.where(update, old_wt + new_wt, old_wt)
+        weighted_avg = np.where(~has_avg & is_observation, cur, weighted_avg)
 
+    return weighted_avg, old_wt, nobs
 
 #################
 # get last RS value object
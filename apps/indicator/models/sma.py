@@ -1,4 +1,4 @@
-from django.db import models
+from django.db import models, transaction
 from apps.indicator.models.abstract_indicator import AbstractIndicator
 from apps.indicator.models import price_resampl
 from settings import time_speed, MODIFY_DB
@@ -9,6 +9,9 @@ import logging
 
 logger = logging.getLogger(__name__)
 SMA_LIST = [9, 20, 26, 30, 50, 52, 60, 120, 200]
+# (PriceResampl column, Sma field)
+SMA_PRICE_COLUMNS = [('close_price', 'sma_close_price'), ('high_price', 'sma_high_price'),
+                     ('midpoint_price', 'sma_midpoint_price')]
 
 class Sma(AbstractIndicator):
 
@@ -27,61 +30,186 @@ class Sma(AbstractIndicator):
     def _compute_sma(self):
         # get neccesary records from price_resample
         resampl_prices_df = price_resampl.get_n_last_resampl_df(
-            self.resample_period * self.sma_period + 5,
+            get_sma_resampl_records(self.resample_period, self.sma_period),
             self.source,
             self.transaction_currency,
             self.counter_currency,
             self.resample_period
         )
-        resampl_close_price_ts = resampl_prices_df.close_price
-        resampl_high_price_ts = resampl_prices_df.high_price
-        resampl_midpoint_price_ts = resampl_prices_df.midpoint_price
-        time_max = np.max(resampl_prices_df.index)
+        if resampl_prices_df.empty:
+            logger.debug(' Not enough prices for SMA calculation, resample_period=' + str(self.resample_period))
+            return
 
-        # reduce sma window if we are in test mode
-        sma_window = int(self.sma_period/time_speed)
+        sma_window = get_sma_window(self.sma_period)
+        sma_values = multi_window_sma(get_sma_price_values(resampl_prices_df),
+                                      windows=[sma_window], starts=[0], min_periods=[get_sma_min_periods(sma_window)])
+        self._set_sma_values(sma_values[:, 0])
 
-        #calculte sma if one third of the nessesary time points are present
-        min_per = int(sma_window/4) if sma_window > 10 else None
 
-        if not resampl_close_price_ts.empty:
-            sma_close_ts = resampl_close_price_ts.rolling(window=sma_window, center=False, min_periods=min_per).mean()
-            if not np.isnan(sma_close_ts[time_max]):
-                self.sma_close_price = int(sma_close_ts[time_max])
-        else:
-            logger.debug(' Not enough CLOSE prices for SMA calculation, resample_period=' + str(self.resample_period) )
-
-        if not resampl_high_price_ts.empty:
-            # calculate SMA
-            sma_high_ts = resampl_high_price_ts.rolling(window=sma_window, center=False, min_periods=min_per).mean()
-            if not np.isnan(sma_high_ts[time_max]):
-                self.sma_high_price = int(sma_high_ts[time_max])
-        else:
-            logger.debug(' Not enough HIGH prices for SMA calculation, resample_period=' + str(self.resample_period) )
-
-
-        if not resampl_midpoint_price_ts.empty:
-            sma_midpoint_ts = resampl_midpoint_price_ts.rolling(window=sma_window, center=False, min_periods=min_per).mean()
-            if not np.isnan(sma_midpoint_ts[time_max]):
-                self.sma_midpoint_price = int(sma_midpoint_ts[time_max])
-        else:
-            logger.debug(' Not enough MIDPOINT prices for SMA calculation, resample_period=' + str(self.resample_period))
+    def _set_sma_values(self, sma_values):
+        # sma_values: one value per SMA_PRICE_COLUMNS, nan if not enough prices
+        for (price_column, sma_field), sma_value in zip(SMA_PRICE_COLUMNS, sma_values):
+            if not np.isnan(sma_value):
+                setattr(self, sma_field, int(sma_value))
+            else:
+                logger.debug(f' Not enough {price_column} for SMA calculation, resample_period={self.resample_period}')
 
 
     @staticmethod
     def compute_all(cls,**kwargs):
         # todo - avoid creation empty record if no sma was computed..it also mith be fine
-        for sma_period in SMA_LIST:
+        # all SMA_LIST periods from one query and one numpy pass, saved with one insert
+        # an exception still only loses the periods it happens in
+        resample_period = kwargs['resample_period']
+        try:
+            resampl_prices_df = price_resampl.get_n_last_resampl_df(
+                get_sma_resampl_records(resample_period, SMA_LIST[-1]),
+                kwargs['source'],
+                kwargs['transaction_currency'],
+                kwargs['counter_currency'],
+                resample_period
+            )
+            if resampl_prices_df.empty:
+                logger.debug(' Not enough prices for SMA calculation, resample_period=' + str(resample_period))
+                return
+
+            # each sma_period only uses the prices _compute_sma() would query for it
+            now = datetime.now()
+            starts = [
+                resampl_prices_df.index.searchsorted(
+                    now - timedelta(minutes=resample_period * get_sma_resampl_records(resample_period, sma_period)))
+                for sma_period in SMA_LIST
+            ]
+            windows = [get_sma_window(sma_period) for sma_period in SMA_LIST]
+            sma_values = multi_window_sma(get_sma_price_values(resampl_prices_df), windows=windows, starts=starts,
+                                          min_periods=[get_sma_min_periods(window) for window in windows])
+        except Exception as e:
+            logger.error(" SMA Compute Exception: " + str(e) + ", computing each period on its own")
+            sma_values = None
+
+        sma_instances = []
+        for sma_index, sma_period in enumerate(SMA_LIST):
             try:
-                sma_instance = cls(**kwargs, sma_period = sma_period)
-                sma_instance._compute_sma()
-                if MODIFY_DB: sma_instance.save()
+                sma_instance = cls(**kwargs, sma_period=sma_period)
+                if sma_values is None:
+                    sma_instance._compute_sma()
+                else:
+                    sma_instance._set_sma_values(sma_values[:, sma_index])
+                sma_instances.append(sma_instance)
             except Exception as e:
                 logger.error(" SMA " + str(sma_period) + " Compute Exception: " + str(e))
+        if MODIFY_DB: save_sma_instances(cls, sma_instances)
         logger.info("   ...All SMA calculations have been done and saved.")
 
 
+    @staticmethod
+    def compute_all_pairs(cls, resampl_dfs, **kwargs):
+        '''
+        compute_all() for many pairs of one source at once, saved with one insert
+        :param resampl_dfs: dict of (transaction_currency, counter_currency): get_n_last_resampl_df() DataFrame
+        for the longest SMA period
+        :param kwargs: timestamp, source and resample_period
+        '''
+        pairs = [pair for pair, df in resampl_dfs.items() if not df.empty]
+        if not pairs:
+            return
+        resample_period = kwargs['resample_period']
+
+        # one row per pair and price column: pair 0 close, pair 0 high, pair 0 midpoint, pair 1 close...
+        stacked_columns = [price_resampl.stack_resampl_column([resampl_dfs[pair] for pair in pairs], price_column)
+                           for (price_column, _) in SMA_PRICE_COLUMNS]
+        values = np.stack([column_values for (column_values, _) in stacked_columns], axis=1)
+        values = values.reshape(len(pairs) * len(SMA_PRICE_COLUMNS), -1)
+        offsets = stacked_columns[0][1]
+
+        now = datetime.now()
+        starts = np.array([
+            [offset + resampl_dfs[pair].index.searchsorted(
+                now - timedelta(minutes=resample_period * get_sma_resampl_records(resample_period, sma_period)))
+             for sma_period in SMA_LIST]
+            for pair, offset in zip(pairs, offsets)
+        ], dtype=int)
+        windows = [get_sma_window(sma_period) for sma_period in SMA_LIST]
+        sma_values = multi_window_sma(values, windows=windows, starts=np.repeat(starts, len(SMA_PRICE_COLUMNS), axis=0),
+                                      min_periods=[get_sma_min_periods(window) for window in windows])
+        sma_values = sma_values.reshape(len(pairs), len(SMA_PRICE_COLUMNS), len(SMA_LIST))
+
+        sma_instances = []
+        for pair_index, (transaction_currency, counter_currency) in enumerate(pairs):
+            for sma_index, sma_period in enumerate(SMA_LIST):
+                sma_instance = cls(**kwargs, transaction_currency=transaction_currency,
+                                   counter_currency=counter_currency, sma_period=sma_period)
+                sma_instance._set_sma_values(sma_values[pair_index, :, sma_index])
+                sma_instances.append(sma_instance)
+        if MODIFY_DB: cls.objects.bulk_create(sma_instances, batch_size=1000)
+        logger.info(f"   ...All SMA calculations have been done and saved for {len(pairs)} pairs.")
+
+
+def save_sma_instances(cls, sma_instances):
+    # one insert, or one save per instance if it fails, so one bad row doesn't lose the others
+    try:
+        with transaction.atomic():  # a savepoint, so the saves below still work inside an outer transaction
+            cls.objects.bulk_create(sma_instances)
+    except Exception as e:
+        logger.error(" SMA bulk insert Exception: " + str(e) + ", saving each period on its own")
+        for sma_instance in sma_instances:
+            try:
+                sma_instance.save()
+            except Exception as e:
+                logger.error(" SMA " + str(sma_instance.sma_period) + " Save Exception: " + str(e))
+
+
+def get_sma_resampl_records(resample_period, sma_period) -> int:
+    # n for get_n_last_resampl_df()
+    return resample_period * sma_period + 5
+
+
+def get_sma_window(sma_period) -> int:
+    # reduce sma window if we are in test mode
+    return int(sma_period/time_speed)
+
+
+def get_sma_min_periods(sma_window) -> int:
+    #calculte sma if one fourth of the nessesary time points are present
+    return int(sma_window/4) if sma_window > 10 else sma_window
+
+
+def get_sma_price_values(resampl_prices_df) -> np.ndarray:
+    # one row per SMA_PRICE_COLUMNS, in time order
+    return resampl_prices_df[[price_column for (price_column, _) in SMA_PRICE_COLUMNS]].values.astype(float).T
+
+
+def multi_window_sma(values, windows, starts, min_periods) -> np.ndarray:
+    '''
+    The last value of rolling(window, min_periods).mean() for several windows at once, nan values are skipped.
+    Sums come from one cumulative sum over the longest window, read backwards from the newest value,
+    so they stay exact for satoshi prices.
+    :param values: 2-D array, one row per price column, values in time order
+    :param windows: number of values in each window
+    :param starts: first index of values each window may use, one per window or a 2-D array of one per row and window
+    :param min_periods: least number of values for each window, else nan
+    :return: 2-D array of SMA values, one row per price column, one column per window
+    '''
+    n_rows, n_values = values.shape
+    windows, min_periods = np.asarray(windows), np.asarray(min_periods)
+    starts = np.broadcast_to(np.asarray(starts), (n_rows, len(windows)))
+    window_lengths = n_values - np.maximum(n_values - windows, starts)
+
+    sma_values = np.full((n_rows, len(windows)), np.nan)
+    if n_values == 0 or window_lengths.max() <= 0:
+        return sma_values
+
+    newest_first = values[:, n_values - window_lengths.max():][:, ::-1]
+    is_value = ~np.isnan(newest_first)
+    sums = np.cumsum(np.where(is_value, newest_first, 0), axis=1)
+    counts = np.cumsum(is_value, axis=1)
 
+    last_indexes = np.maximum(window_lengths - 1, 0)
+    rows = np.arange(n_rows)[:, np.newaxis]
+    window_sums, window_counts = sums[rows, last_indexes], counts[rows, last_indexes]
+    has_enough = (window_counts >= min_periods) & (window_lengths > 0) & (window_counts > 0)
+    sma_values[has_enough] = window_sums[has_enough] / window_counts[has_enough]
+    return sma_values
 
 
 ####################### get n last sma records as a DataFrame
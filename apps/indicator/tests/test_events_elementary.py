@@ -0,0 +1,124 @@
+import time
+
+import numpy as np
+import pandas as pd
+from django.test import SimpleTestCase
+
+from apps.indicator.models.events_elementary import evaluate_elementary_rules, _rsi_events, \
+    _sma_crossover_events, _ben_volume_events, _ichimoku_events, SMA_LOW, SMA_HIGH, VBI_PRICE_PERIOD
+
+resample_period = 60
+
+
+def get_features_df(close_prices, minutes_between_rows=60, last_time=None) -> pd.DataFrame:
+    # a feature frame like get_elementary_features_df(), by default the last row a few minutes ago
+    if last_time is None:
+        last_time = pd.to_datetime(time.time(), unit='s') - pd.Timedelta(minutes=5)
+    index = pd.date_range(end=last_time, periods=len(close_prices), freq=f'{minutes_between_rows}min')
+    close_prices = np.array(close_prices, dtype=float)
+    return pd.DataFrame({
+        'open_price': close_prices,
+        'high_price': close_prices * 1.01,
+        'low_price': close_prices * 0.99,
+        'close_price': close_prices,
+        'close_volume': 10.0,
+        'mean_volume': 10.0,
+        f'sma{SMA_LOW}': close_prices,
+        f'sma{SMA_HIGH}': close_prices,
+        f'sma{VBI_PRICE_PERIOD}': close_prices,
+        'rsi': np.nan,
+    }, index=index)
+
+
+class SmaCrossoverEventsTestCase(SimpleTestCase):
+
+    def test_crossovers_at_the_last_row(self):
+        features_df = get_features_df([100, 100, 100, 100])
+        features_df[f'sma{SMA_LOW}'] = [90, 90, 90, 110]  # crosses the price up on the last row
+        features_df[f'sma{SMA_HIGH}'] = [120, 120, 120, 95]  # crosses the price down on the last row
+
+        fired_events = evaluate_elementary_rules([('sma', _sma_crossover_events, features_df)])
+        self.assertEqual(fired_events, {
+            'sma50_cross_price_up': 1,
+            'sma200_cross_price_down': 1,
+            'sma50_cross_sma200_up': 1,
+            'sma50_above_sma200': 1,
+        })
+
+    def test_no_crossover_at_the_last_row(self):
+        features_df = get_features_df([100, 100, 100, 100])
+        features_df[f'sma{SMA_LOW}'] = [90, 110, 110, 110]  # crossed before the last row
+        features_df[f'sma{SMA_HIGH}'] = [120, 120, 120, 120]
+
+        fired_events = evaluate_elementary_rules([('sma', _sma_crossover_events, features_df)])
+        self.assertEqual(fired_events, {'sma50_below_sma200': 1})
+
+
+class IchimokuEventsTestCase(SimpleTestCase):
+
+    def setUp(self):
+        # rising, then falling through the cloud
+        self.close_prices = [100 + i for i in range(200)] + [300 - 3 * i for i in range(100)]
+
+    def test_hour_values_spread_to_sub_hour_rows(self):
+        on_the_hour_df = get_features_df(self.close_prices, last_time=pd.Timestamp('2018-06-01 12:00'))
+        sub_hour_df = get_features_df(self.close_prices, last_time=pd.Timestamp('2018-06-01 12:10'))
+
+        on_the_hour_events = _ichimoku_events(on_the_hour_df, resample_period=resample_period)
+        sub_hour_events = _ichimoku_events(sub_hour_df, resample_period=resample_period)
+
+        self.assertTrue(sub_hour_events.index.equals(sub_hour_df.index))
+        np.testing.assert_array_equal(sub_hour_events.values, on_the_hour_events.values)
+        self.assertFalse(sub_hour_events.iloc[-1].isnull().all())
+
+    def test_several_rows_per_hour(self):
+        features_df = get_features_df(np.repeat(self.close_prices, 3), minutes_between_rows=20,
+                                      last_time=pd.Timestamp('2018-06-01 12:50'))
+
+        events_df = _ichimoku_events(features_df, resample_period=resample_period)
+
+        self.assertTrue(events_df.index.equals(features_df.index))
+        for _, hour_events_df in events_df.groupby(events_df.index.floor('H')):
+            # each row is forward filled from the start of its hour
+            np.testing.assert_array_equal(hour_events_df.values, hour_events_df.iloc[[0] * len(hour_events_df)].values)
+        self.assertIn('close_below_cloud', evaluate_elementary_rules([('ichimoku', _ichimoku_events, features_df)],
+                                                                     resample_period=resample_period))
+
+
+class BenVolumeEventsTestCase(SimpleTestCase):
+
+    def test_last_row_without_means_is_trimmed(self):
+        features_df = get_features_df([100, 100, 100, 100, 100])
+        features_df['close_price'] = [100, 100, 100, 110, 110]  # crosses the mean by more than 2% on the 4th row
+        features_df.iloc[-1, features_df.columns.get_loc(f'sma{VBI_PRICE_PERIOD}')] = np.nan  # no mean yet
+
+        fired_events = evaluate_elementary_rules([('ben_volume', _ben_volume_events, features_df)])
+        # the events of the last row with both means
+        self.assertEqual(fired_events, {'vbi_price_cross_from_below': 1, 'vbi_price_gt_mean_by_percent': 1})
+
+    def test_no_rows_with_means(self):
+        features_df = get_features_df([100, 100, 100])
+        features_df['mean_volume'] = np.nan
+
+        self.assertEqual(evaluate_elementary_rules([('ben_volume', _ben_volume_events, features_df)]), {})
+
+
+class EvaluateElementaryRulesTestCase(SimpleTestCase):
+
+    def test_raising_rule_is_skipped(self):
+        features_df = get_features_df([100, 100, 100])
+        features_df.iloc[-1, features_df.columns.get_loc('rsi')] = 85  # extremely overbought
+
+        def raising_rule(frame, **kwargs):
+            raise ValueError("bad rule")
+
+        timings = {}
+        fired_events = evaluate_elementary_rules([
+            ('raising', raising_rule, features_df),
+            ('rsi', _rsi_events, features_df),
+            ('no_data', _rsi_events, features_df.iloc[:0]),
+        ], timings)
+
+        self.assertEqual(fired_events, {'rsi_bracket': -3})
+        self.assertEqual(set(timings), {'raising', 'rsi', 'no_data'})
+        self.assertTrue(all(seconds >= 0 for seconds in timings.values()))
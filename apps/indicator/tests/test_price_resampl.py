@@ -0,0 +1,80 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+from django.test import TestCase, SimpleTestCase
+
+from apps.indicator.models.price_resampl import PriceResampl, get_n_last_resampl_df, get_n_last_resampl_dfs, \
+    stack_resampl_column
+from settings import BINANCE, BTC, USDT
+
+resample_period = 60
+
+
+def create_price_resampls(transaction_currency, counter_currency, close_prices, source=BINANCE):
+    # one resampled price per period, the last one is the newest
+    now = datetime.now()
+    for periods_back, close_price in enumerate(reversed(close_prices)):
+        PriceResampl.objects.create(
+            source=source, transaction_currency=transaction_currency, counter_currency=counter_currency,
+            resample_period=resample_period, timestamp=now - timedelta(minutes=resample_period * periods_back),
+            close_price=close_price, open_price=close_price, low_price=close_price, high_price=close_price,
+            midpoint_price=close_price, mean_price=close_price, price_variance=0.0,
+            close_volume=1.5, open_volume=1.5, low_volume=1.5, high_volume=1.5, volume_variance=0.0,
+        )
+
+
+class GetNLastResamplDfsTestCase(TestCase):
+
+    def setUp(self):
+        create_price_resampls("ETH", BTC, [100, 101, 102, 103])
+        create_price_resampls("LTC", BTC, [200, 201])
+        create_price_resampls("ETH", USDT, [300, 301, 302])  # not requested, though both currencies are
+        create_price_resampls("LTC", USDT, [400])
+
+    def test_matches_get_n_last_resampl_df(self):
+        pairs = [("ETH", BTC), ("LTC", BTC), ("ETH", USDT), ("XRP", BTC)]
+        resampl_dfs = get_n_last_resampl_dfs(10, BINANCE, pairs, resample_period)
+
+        self.assertEqual(set(resampl_dfs), set(pairs))
+        for (transaction_currency, counter_currency), resampl_df in resampl_dfs.items():
+            pd.testing.assert_frame_equal(resampl_df, get_n_last_resampl_df(
+                10, BINANCE, transaction_currency, counter_currency, resample_period
+            ))
+        self.assertEqual(list(resampl_dfs[("ETH", BTC)].close_price), [100, 101, 102, 103])
+        self.assertTrue(resampl_dfs[("XRP", BTC)].empty)
+
+    def test_only_requested_pairs(self):
+        resampl_dfs = get_n_last_resampl_dfs(10, BINANCE, [("ETH", BTC), ("LTC", USDT)], resample_period)
+        self.assertEqual(set(resampl_dfs), {("ETH", BTC), ("LTC", USDT)})
+        self.assertEqual(list(resampl_dfs[("LTC", USDT)].close_price), [400])
+
+    def test_window(self):
+        resampl_dfs = get_n_last_resampl_dfs(2, BINANCE, [("ETH", BTC)], resample_period)
+        self.assertEqual(list(resampl_dfs[("ETH", BTC)].close_price), [102, 103])
+
+
+class StackResamplColumnTestCase(SimpleTestCase):
+
+    def test_rows_aligned_on_last_value(self):
+        index = pd.date_range("2018-01-01", periods=3, freq="H")
+        resampl_dfs = [
+            pd.DataFrame({'close_price': [1, 2, 3]}, index=index),
+            pd.DataFrame({'close_price': [4]}, index=index[-1:]),
+            pd.DataFrame(),
+        ]
+
+        values, offsets = stack_resampl_column(resampl_dfs, 'close_price')
+
+        np.testing.assert_array_equal(values, [
+            [1, 2, 3],
+            [np.nan, np.nan, 4],
+            [np.nan, np.nan, np.nan],
+        ])
+        np.testing.assert_array_equal(offsets, [0, 2, 3])
+        self.assertEqual(values.dtype, float)
+
+    def test_no_dataframes(self):
+        values, offsets = stack_resampl_column([], 'close_price')
+        self.assertEqual(values.shape, (0, 0))
+        self.assertEqual(len(offsets), 0)
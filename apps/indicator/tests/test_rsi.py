@@ -0,0 +1,112 @@
+import time
+
+import numpy as np
+import pandas as pd
+from django.test import TestCase, SimpleTestCase
+
+from apps.indicator.models.price_resampl import get_n_last_resampl_dfs
+from apps.indicator.models.rsi import Rsi, RSI_COM, RSI_MIN_PERIODS, RSI_DRIFT_TOLERANCE, \
+    continue_rsi_ewm_states, ewm_mean_state, relative_strength, rsi_ewm_state
+from apps.indicator.models.sma import SMA_LIST, get_sma_resampl_records
+from apps.indicator.tests.test_price_resampl import create_price_resampls, resample_period
+from settings import BINANCE, BTC
+
+
+class RsiComputeAllPairsTestCase(TestCase):
+
+    def setUp(self):
+        self.close_prices = {
+            ("ETH", BTC): [100 + (i * 7) % 11 - (i * 3) % 5 for i in range(30)],
+            ("LTC", BTC): [200 + (i * 5) % 13 for i in range(40)],
+            ("XRP", BTC): [300, 301, 302],  # too few prices for an RSI
+        }
+        for (transaction_currency, counter_currency), close_prices in self.close_prices.items():
+            create_price_resampls(transaction_currency, counter_currency, close_prices)
+        self.params_dict = dict(timestamp=time.time(), source=BINANCE, resample_period=resample_period)
+
+    def get_relative_strengths(self):
+        return {
+            (rsi.transaction_currency, rsi.counter_currency): rsi.relative_strength for rsi in Rsi.objects.all()
+        }
+
+    def test_each_pair_matches_compute_all(self):
+        for (transaction_currency, counter_currency) in self.close_prices:
+            Rsi.compute_all(Rsi, **self.params_dict,
+                            transaction_currency=transaction_currency, counter_currency=counter_currency)
+        expected = self.get_relative_strengths()
+        self.assertEqual(set(expected), {("ETH", BTC), ("LTC", BTC)})
+        Rsi.objects.all().delete()
+
+        resampl_dfs = get_n_last_resampl_dfs(get_sma_resampl_records(resample_period, SMA_LIST[-1]),
+                                             BINANCE, list(self.close_prices), resample_period)
+        Rsi.compute_all_pairs(Rsi, resampl_dfs, **self.params_dict)
+
+        relative_strengths = self.get_relative_strengths()
+        self.assertEqual(set(relative_strengths), set(expected))
+        for pair, relative_strength in expected.items():
+            self.assertAlmostEqual(relative_strengths[pair], relative_strength, places=9)
+
+
+class RsiEwmStateTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.close_prices = np.array([
+            [100 + (i * 7) % 11 - (i * 3) % 5 for i in range(40)],
+            [200 + (i * 5) % 13 for i in range(40)],
+            [np.nan] * 25 + [300 + (i * 3) % 7 for i in range(15)],  # a pair with a later first price
+            [np.nan] * 38 + [400, 402],  # too few prices for min_periods
+        ], dtype=float)
+        self.close_prices[0, [5, 6, 20]] = np.nan  # gaps in the middle of a series
+
+    def test_ewm_mean_state_matches_pandas(self):
+        (weighted_avg, _, nobs) = ewm_mean_state(self.close_prices, com=RSI_COM)
+        for row, avg, row_nobs in zip(self.close_prices, weighted_avg, nobs):
+            expected = pd.Series(row).ewm(com=RSI_COM, min_periods=RSI_MIN_PERIODS).mean().iloc[-1]
+            if row_nobs >= RSI_MIN_PERIODS:
+                self.assertAlmostEqual(avg, expected, places=9)
+            else:
+                self.assertTrue(np.isnan(expected))
+
+    def test_ewm_mean_state_continues_in_steps(self):
+        (weighted_avg, _, _) = ewm_mean_state(self.close_prices, com=RSI_COM)
+        state = ewm_mean_state(self.close_prices[:, :17], com=RSI_COM)
+        state = ewm_mean_state(self.close_prices[:, 17:30], com=RSI_COM, state=state)
+        (continued_avg, _, _) = ewm_mean_state(self.close_prices[:, 30:], com=RSI_COM, state=state)
+        np.testing.assert_allclose(continued_avg, weighted_avg, rtol=1e-12)
+
+    def test_rsi_ewm_state_matches_pandas(self):
+        (avg_gain, avg_loss, _, nobs) = rsi_ewm_state(self.close_prices)
+        relative_strengths = relative_strength(avg_gain, avg_loss, nobs)
+        for row, rs in zip(self.close_prices, relative_strengths):
+            # the pandas up/down EWMA Rsi.compute_rs() used before the ewm state
+            delta = pd.Series(row).diff()
+            up, down = delta.copy(), delta.copy()
+            up[up < 0] = 0
+            down[down > 0] = 0
+            r_up = up.ewm(com=RSI_COM, min_periods=RSI_MIN_PERIODS).mean()
+            r_down = down.ewm(com=RSI_COM, min_periods=RSI_MIN_PERIODS).mean().abs()
+            expected = (r_up / r_down).iloc[-1]
+            if np.isnan(expected):
+                self.assertTrue(np.isnan(rs))
+            else:
+                self.assertAlmostEqual(rs, expected, places=9)
+
+    def test_continued_state_matches_full_recompute(self):
+        close_prices = self.close_prices[:2]
+        new_prices_counts = {("ETH", BTC): 1, ("LTC", BTC): 6}  # pairs with different numbers of new prices
+
+        previous_rsis, new_close_prices = {}, {}
+        for pair, row, k in zip(new_prices_counts, close_prices, new_prices_counts.values()):
+            (avg_gain, avg_loss, ewm_weight, _) = rsi_ewm_state(row[np.newaxis, :-k])
+            previous_rsis[pair] = Rsi(avg_gain=float(avg_gain[0]), avg_loss=float(avg_loss[0]),
+                                      ewm_weight=float(ewm_weight[0]), last_close_price=int(row[-k - 1]))
+            new_close_prices[pair] = row[-k:]
+
+        states = continue_rsi_ewm_states(previous_rsis, new_close_prices)
+        (avg_gains, avg_losses, _, nobs_array) = rsi_ewm_state(close_prices)
+        recomputed = relative_strength(avg_gains, avg_losses, nobs_array)
+        for pair, row, rs in zip(new_prices_counts, close_prices, recomputed):
+            (avg_gain, avg_loss, ewm_weight, nobs, last_close_price) = states[pair]
+            self.assertEqual(last_close_price, row[-1])
+            drift = abs(relative_strength(avg_gain, avg_loss, nobs) - rs) / abs(rs)
+            self.assertLess(drift, RSI_DRIFT_TOLERANCE)
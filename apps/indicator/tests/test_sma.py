@@ -0,0 +1,97 @@
+import time
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+from django.test import TestCase, SimpleTestCase
+
+from apps.indicator.models import sma
+from apps.indicator.models.sma import Sma, SMA_LIST, multi_window_sma
+from apps.indicator.tests.test_price_resampl import create_price_resampls, resample_period
+from settings import BINANCE, BTC
+
+
+def rolling_sma(row, window, min_periods, start=0) -> float:
+    # the last value of the pandas rolling mean multi_window_sma() replaces
+    return pd.Series(row[start:]).rolling(window=window, min_periods=min_periods).mean().iloc[-1]
+
+
+class MultiWindowSmaTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.values = np.array([
+            [100 + (i * 7) % 11 for i in range(30)],
+            [200 + (i * 5) % 13 for i in range(30)],
+            [300 + (i * 3) % 7 for i in range(30)],
+        ], dtype=float)
+        self.values[0, [27, 22, 5]] = np.nan  # gaps inside the short windows
+        self.values[1, :26] = np.nan  # only the newest 4 values
+        self.values[2, -1] = np.nan  # no newest value
+
+    def assert_matches_rolling(self, values, windows, min_periods, starts=None):
+        starts = np.zeros((len(values), len(windows)), dtype=int) if starts is None else starts
+        sma_values = multi_window_sma(values, windows=windows, starts=starts, min_periods=min_periods)
+        self.assertEqual(sma_values.shape, (len(values), len(windows)))
+        for row_index, row in enumerate(values):
+            for window_index, (window, min_period) in enumerate(zip(windows, min_periods)):
+                expected = rolling_sma(row, window, min_period, starts[row_index][window_index])
+                if np.isnan(expected):
+                    self.assertTrue(np.isnan(sma_values[row_index, window_index]), (row_index, window))
+                else:
+                    self.assertAlmostEqual(sma_values[row_index, window_index], expected, places=9)
+
+    def test_matches_rolling_mean_with_nans(self):
+        self.assert_matches_rolling(self.values, windows=[3, 5, 9, 20, 26], min_periods=[3, 5, 9, 5, 6])
+        self.assert_matches_rolling(self.values, windows=[3, 5, 9, 20, 26], min_periods=[1, 2, 3, 3, 4])
+
+    def test_windows_longer_than_values(self):
+        self.assert_matches_rolling(self.values, windows=[30, 50, 200], min_periods=[7, 12, 50])
+        self.assert_matches_rolling(self.values[:, -4:], windows=[3, 9, 20], min_periods=[3, 9, 5])
+
+    def test_starts_limit_each_window(self):
+        starts = np.array([[0, 25, 28], [0, 10, 29], [29, 29, 29]])
+        self.assert_matches_rolling(self.values, windows=[9, 9, 20], min_periods=[1, 1, 1], starts=starts)
+
+    def test_no_values(self):
+        sma_values = multi_window_sma(np.empty((3, 0)), windows=[9, 20], starts=[0, 0], min_periods=[9, 5])
+        self.assertTrue(np.isnan(sma_values).all())
+
+
+class SmaComputeAllTestCase(TestCase):
+
+    def setUp(self):
+        create_price_resampls("ETH", BTC, [100 + (i * 7) % 11 for i in range(250)])
+        self.params_dict = dict(timestamp=time.time(), source=BINANCE, resample_period=resample_period,
+                                transaction_currency="ETH", counter_currency=BTC)
+
+    def get_sma_close_prices(self):
+        return {sma_instance.sma_period: sma_instance.sma_close_price for sma_instance in Sma.objects.all()}
+
+    def test_one_failing_period_keeps_the_others(self):
+        set_sma_values = Sma._set_sma_values
+
+        def failing_set_sma_values(sma_instance, sma_values):
+            if sma_instance.sma_period == 20:
+                raise ValueError("bad sma")
+            return set_sma_values(sma_instance, sma_values)
+
+        with mock.patch.object(Sma, '_set_sma_values', autospec=True, side_effect=failing_set_sma_values):
+            Sma.compute_all(Sma, **self.params_dict)
+
+        self.assertEqual(set(self.get_sma_close_prices()), set(SMA_LIST) - {20})
+
+    def test_failing_batch_computes_each_period(self):
+        Sma.compute_all(Sma, **self.params_dict)
+        expected = self.get_sma_close_prices()
+        Sma.objects.all().delete()
+
+        def failing_multi_window_sma(values, windows, starts, min_periods):
+            if len(windows) > 1:
+                raise ValueError("bad batch")
+            return multi_window_sma(values, windows, starts, min_periods)
+
+        with mock.patch.object(sma, 'multi_window_sma', side_effect=failing_multi_window_sma):
+            Sma.compute_all(Sma, **self.params_dict)
+
+        self.assertEqual(set(expected), set(SMA_LIST))
+        self.assertEqual(self.get_sma_close_prices(), expected)
@@ -1,5 +1,6 @@
 from taskapp.helpers.common import get_exchanges, get_tickers, get_source_name, quad_formatted
 
-from taskapp.helpers.indicators import _compute_ann, _compute_indicators_for
+from taskapp.helpers.indicators import _compute_ann, _compute_indicators_for, _compute_indicators_for_all_pairs, \
+    _check_events_and_strategies_for
 
 from taskapp.helpers.backtesting import _backtest_all_strategies
@@ -1,17 +1,19 @@
 import datetime
 import logging
 import time
+from contextlib import ExitStack
 
 from django.db import connection
 
 from apps.common.utilities.sqs import send_sqs
-from apps.indicator.models.price_resampl import PriceResampl
+from apps.indicator.models.price_resampl import PriceResampl, resampl_df_cache, get_n_last_resampl_df, \
+    get_n_last_resampl_dfs, set_resampl_df_cache, resample_all_pairs
 from apps.indicator.models.rsi import Rsi
-from apps.indicator.models.sma import Sma
+from apps.indicator.models.sma import Sma, SMA_LIST, get_sma_resampl_records
 from apps.strategy.models.strategy_ref import get_all_strategy_classes
 from apps.user.models.user import get_horizon_value_from_string
 from settings import SHORT, MEDIUM, HORIZONS_TIME2NAMES, RUN_ANN, MODIFY_DB
-from taskapp.helpers.common import get_tickers, quad_formatted
+from taskapp.helpers.common import get_tickers, quad_formatted, get_source_name
 
 # from taskapp.helpers.backtesting import _backtest_all_strategies
 
@@ -129,6 +131,128 @@ def _compute_indicators_for(source, transaction_currency, counter_currency, resa
     # ################# Can be commented after first time run
 
     # 1 ############################
+    _resample_price(indicator_params_dict)
+
+    # all indicators, events and strategies below read the same resampled prices,
+    # load the longest window (the longest SMA) once and share it for this run
+    with resampl_df_cache(source, transaction_currency, counter_currency, resample_period):
+        get_n_last_resampl_df(get_sma_resampl_records(resample_period, SMA_LIST[-1]),
+                              source, transaction_currency, counter_currency, resample_period)
+
+        # 2 ###########################
+        # calculate and save simple indicators
+        indicators_list = [Sma, Rsi]
+        for ind in indicators_list:
+            try:
+                ind.compute_all(ind, **indicator_params_dict)
+                # logger.debug("  ... Regular indicators completed,  ELAPSED Time: " + str(time.time() - timestamp))
+                logger.debug(
+                    f">>>>{quad_formatted(source, transaction_currency, counter_currency, resample_period)} ... Regular indicators completed,  ELAPSED Time: {time.time() - timestamp}")
+            except Exception as e:
+                # logger.error(str(ind) + " Indicator Exception: " + str(e))
+                logger.error(
+                    f">>>>{quad_formatted(source, transaction_currency, counter_currency, resample_period)} {(ind)} Indicator Exception: {e}")
+
+        # 4, 5 ##########################
+        _check_events_and_strategies(indicator_params_dict, horizon)
+
+
+def _compute_indicators_for_all_pairs(source, pairs, resample_period):
+    '''
+    _compute_indicators_for() every pair of a source in one run.
+    All pairs are resampled with one query, resampled prices of all pairs are loaded with one query, SMA and RSI are computed for all pairs
+    together and saved with one insert each.
+    Events and strategies are left to _check_events_and_strategies_for(), so the caller can spread them over workers.
+    :param pairs: list of (transaction_currency, counter_currency)
+    :return: list of indicator_params_dict, one per pair, with the timestamp the indicators were saved at
+    '''
+    pairs = [tuple(pair) for pair in pairs]
+    logger.info(f"### Starting calcs for {len(pairs)} pairs of {get_source_name(source)}, period {resample_period}")
+
+    timestamp = time.time() // (1 * 60) * (1 * 60)  # current time rounded to a minute
+
+    source_params_dict = {
+        'timestamp': timestamp,
+        'source': source,
+        'resample_period': resample_period
+    }
+    pair_params_dicts = [
+        dict(source_params_dict, transaction_currency=transaction_currency, counter_currency=counter_currency)
+        for (transaction_currency, counter_currency) in pairs
+    ]
+
+    # 1 ############################
+    # resample all pairs with one query
+    try:
+        if MODIFY_DB:
+            resampled_pairs = resample_all_pairs(source, pairs, resample_period, timestamp)
+            logger.debug(f">>>> {resampled_pairs} of {len(pairs)} pairs ... Resampled completed,  ELAPSED Time: {time.time() - timestamp}")
+    except Exception as e:
+        logger.error(f">>>> {get_source_name(source)}_{resample_period} -> RESAMPLE EXCEPTION: {e}")
+
+    with ExitStack() as cache_stack:
+        resampl_dfs = _load_resampl_df_caches(cache_stack, source, pairs, resample_period)
+
+        # 2 ###########################
+        for ind in [Sma, Rsi]:
+            try:
+                ind.compute_all_pairs(ind, resampl_dfs, **source_params_dict)
+                logger.debug(f">>>> {len(pairs)} pairs ... Regular indicators completed,  ELAPSED Time: {time.time() - timestamp}")
+            except Exception as e:
+                logger.error(f">>>> {get_source_name(source)}_{resample_period} {(ind)} Indicator Exception: {e}")
+
+    logger.info(f"### {len(pairs)} pairs of {get_source_name(source)}, period {resample_period} "
+                f"... batched indicators completed,  ELAPSED Time: {time.time() - timestamp}")
+    return pair_params_dicts
+
+
+def _check_events_and_strategies_for(pair_params_dicts):
+    '''
+    steps 4 and 5 of _compute_indicators_for() for some of the pairs from _compute_indicators_for_all_pairs()
+    the resampled prices of these pairs are loaded with one query and shared by all events and strategies
+    :param pair_params_dicts: list of indicator_params_dict
+    '''
+    start_time = time.time()
+    pairs_by_source_period = {}
+    for indicator_params_dict in pair_params_dicts:
+        pairs_by_source_period.setdefault(
+            (indicator_params_dict['source'], indicator_params_dict['resample_period']), []
+        ).append((indicator_params_dict['transaction_currency'], indicator_params_dict['counter_currency']))
+
+    with ExitStack() as cache_stack:
+        for (source, resample_period), pairs in pairs_by_source_period.items():
+            _load_resampl_df_caches(cache_stack, source, pairs, resample_period)
+
+        for indicator_params_dict in pair_params_dicts:
+            horizon = get_horizon_value_from_string(
+                display_string=HORIZONS_TIME2NAMES[indicator_params_dict['resample_period']])
+            _check_events_and_strategies(indicator_params_dict, horizon)
+    logger.info(f"### events and strategies for {len(pair_params_dicts)} pairs completed,  "
+                f"ELAPSED Time: {time.time() - start_time}")
+
+
+def _load_resampl_df_caches(cache_stack, source, pairs, resample_period) -> dict:
+    '''
+    enter resampl_df_cache() for each pair on cache_stack and fill them with one query,
+    loading the longest window (the longest SMA) like _compute_indicators_for()
+    :return: dict of (transaction_currency, counter_currency): resampled price DataFrame
+    '''
+    for (transaction_currency, counter_currency) in pairs:
+        cache_stack.enter_context(resampl_df_cache(source, transaction_currency, counter_currency, resample_period))
+
+    n = get_sma_resampl_records(resample_period, SMA_LIST[-1])
+    resampl_dfs = get_n_last_resampl_dfs(n, source, pairs, resample_period)
+    for (transaction_currency, counter_currency), resampl_df in resampl_dfs.items():
+        set_resampl_df_cache(n, resampl_df, source, transaction_currency, counter_currency, resample_period)
+    return resampl_dfs
+
+
+def _resample_price(indicator_params_dict):
+    (source, transaction_currency, counter_currency, resample_period, timestamp) = [
+        indicator_params_dict[key]
+        for key in ('source', 'transaction_currency', 'counter_currency', 'resample_period', 'timestamp')
+    ]
+
     # calculate and save resampling price
     # todo - prevent adding an empty record if no value was computed (static method below)
     try:
@@ -144,20 +268,11 @@ def _compute_indicators_for(source, transaction_currency, counter_currency, resa
             f">>>>{quad_formatted(source, transaction_currency, counter_currency, resample_period)} -> RESAMPLE EXCEPTION: {e}")
 
 
-
-    # 2 ###########################
-    # calculate and save simple indicators
-    indicators_list = [Sma, Rsi]
-    for ind in indicators_list:
-        try:
-            ind.compute_all(ind, **indicator_params_dict)
-            # logger.debug("  ... Regular indicators completed,  ELAPSED Time: " + str(time.time() - timestamp))
-            logger.debug(
-                f">>>>{quad_formatted(source, transaction_currency, counter_currency, resample_period)} ... Regular indicators completed,  ELAPSED Time: {time.time() - timestamp}")
-        except Exception as e:
-            # logger.error(str(ind) + " Indicator Exception: " + str(e))
-            logger.error(
-                f">>>>{quad_formatted(source, transaction_currency, counter_currency, resample_period)} {(ind)} Indicator Exception: {e}")
+def _check_events_and_strategies(indicator_params_dict, horizon):
+    (source, transaction_currency, counter_currency, resample_period, timestamp) = [
+        indicator_params_dict[key]
+        for key in ('source', 'transaction_currency', 'counter_currency', 'resample_period', 'timestamp')
+    ]
 
     # 4 #############################
     # check for events and save if any
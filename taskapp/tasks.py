@@ -8,6 +8,8 @@ from taskapp.celery import app as celery_app
 
 logger = logging.getLogger(__name__)
 
+EVENTS_PAIRS_PER_TASK = 5  # pairs per events and strategies task after a batched indicators run
+
 ## Periodic tasks
 
 ############ Indicators
@@ -15,8 +17,29 @@ logger = logging.getLogger(__name__)
 def compute_indicators_for_all_sources(resample_period):
     from taskapp.helpers.common import get_tickers
     #logger.info(f"Tickers: {get_tickers(source='all')}")
+    # one task per source, computing all its pairs together
+    pairs_by_source = {}
     for (source, transaction_currency, counter_currency) in get_tickers(source='all'):
-        compute_indicators_for.delay(source, transaction_currency, counter_currency, resample_period)
+        pairs_by_source.setdefault(source, []).append((transaction_currency, counter_currency))
+    for source, pairs in pairs_by_source.items():
+        compute_indicators_for_all_pairs.delay(source, pairs, resample_period)
+
+@celery_app.task(retry=False)
+def compute_indicators_for_all_pairs(source, pairs, resample_period):
+    logger.info("###### Start _compute_indicators_for_all_pairs job #######")
+    from celery import group
+    from taskapp.helpers.indicators import _compute_indicators_for_all_pairs
+    pair_params_dicts = _compute_indicators_for_all_pairs(source, pairs, resample_period)
+    # events and strategies are still queried pair by pair, spread them over the workers again
+    group(
+        check_events_and_strategies_for.s(pair_params_dicts[i:i + EVENTS_PAIRS_PER_TASK])
+        for i in range(0, len(pair_params_dicts), EVENTS_PAIRS_PER_TASK)
+    ).delay()
+
+@celery_app.task(retry=False)
+def check_events_and_strategies_for(pair_params_dicts):
+    from taskapp.helpers.indicators import _check_events_and_strategies_for
+    _check_events_and_strategies_for(pair_params_dicts)
 
 @celery_app.task(retry=False)
 def compute_indicators_for(source, transaction_currency, counter_currency, resample_period):